@@ -0,0 +1,356 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Replay requests against completion.py and report how fast it answers.
+
+Requests come from recordings made with `completion.py --record=<file>`,
+or from corpora built from the test fixtures in src/test/pythonFiles:
+
+    python benchmarks/completion_replay.py --corpus=autocomp,definition \
+        --jedi=<jedi directory> -- --workers=2
+
+Options after `--` are passed on to completion.py. The report has the
+latency percentiles of each lookup, the throughput and the peak memory of
+the server, along with the time spent in each phase of the lookups as
+reported by `--metrics`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import keyword
+import os
+import os.path
+import subprocess
+import sys
+import threading
+import time
+import tokenize
+
+
+BENCHMARKS_ROOT = os.path.dirname(os.path.abspath(__file__))
+SRC_ROOT = os.path.dirname(BENCHMARKS_ROOT)
+PROJECT_ROOT = os.path.dirname(SRC_ROOT)
+FIXTURES_ROOT = os.path.join(PROJECT_ROOT, 'src', 'test', 'pythonFiles')
+COMPLETION = os.path.join(SRC_ROOT, 'completion.py')
+
+CONTROL_MESSAGES = ('cancel', 'open', 'change', 'close')
+CONFIG = {'extraPaths': [], 'useSnippets': False,
+          'caseInsensitiveCompletion': True, 'showDescriptions': True,
+          'fuzzyMatcher': False}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay requests against completion.py.')
+    parser.add_argument('recordings', nargs='*',
+                        help='files recorded with completion.py --record')
+    parser.add_argument('--corpus', default='',
+                        help='comma separated fixture directories of '
+                             'src/test/pythonFiles to build requests from')
+    parser.add_argument('--jedi', help='directory to import Jedi from')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='requests sent without waiting for a response')
+    parser.add_argument('--paced', action='store_true',
+                        help='send recorded requests at their recorded times')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds to wait for a response before counting '
+                             'the request as an error')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='number of times the requests are replayed')
+    parser.add_argument('--warmup', action='store_true',
+                        help='replay once more first, without measuring')
+    parser.add_argument('--write-corpus', metavar='FILE',
+                        help='save the requests as a recording and exit')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results as JSON')
+    if argv is None:
+        argv = sys.argv[1:]
+    server_args = []
+    if '--' in argv:
+        index = argv.index('--')
+        argv, server_args = argv[:index], argv[index + 1:]
+    args = parser.parse_args(argv)
+    args.server_args = server_args
+    return args
+
+
+def _source_files(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                yield os.path.join(root, name)
+
+
+def fixture_requests(path):
+    """Build the lookups VSCode sends while a file is being edited.
+
+    Completions follow every `.`, arguments every call, definitions and
+    tooltips alternate over the names and usages are looked up for every
+    definition, the file's names are looked up once.
+    """
+    with io.open(path, encoding='utf-8') as source_file:
+        source = source_file.read()
+    requests = [{'lookup': 'names', 'path': path, 'source': source}]
+    previous = None
+    names = 0
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, IndentationError):
+        tokens = []
+    for token_type, text, start, end, _ in tokens:
+        lookup = None
+        line, column = start[0] - 1, start[1]
+        if token_type == tokenize.OP and text == '.':
+            lookup, column = 'completions', end[1]
+        elif token_type == tokenize.OP and text == '(' \
+                and previous is not None and previous[0] == tokenize.NAME:
+            lookup, column = 'arguments', end[1]
+        elif token_type == tokenize.NAME and not keyword.iskeyword(text):
+            if previous is not None and previous[1] in ('def', 'class'):
+                lookup = 'usages'
+            else:
+                names += 1
+                lookup = 'definitions' if names % 2 else 'tooltip'
+        if lookup is not None:
+            requests.append({'lookup': lookup, 'path': path, 'source': source,
+                             'line': line, 'column': column})
+        if token_type not in (tokenize.NL, tokenize.COMMENT):
+            previous = token_type, text
+    return requests
+
+
+def corpus(directories):
+    """Requests for the fixtures in directories of src/test/pythonFiles."""
+    requests = []
+    for directory in directories:
+        for path in _source_files(os.path.join(FIXTURES_ROOT, directory)):
+            requests.extend(fixture_requests(path))
+    return [{'time': 0.0, 'request': request} for request in requests]
+
+
+def load_recording(path):
+    with io.open(path, encoding='utf-8') as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Replay(object):
+    """Sends requests to a completion.py process and times the responses.
+
+    Requests get new ids, the ids recorded for them are replaced in the
+    cancel and resolve requests referring to them.
+
+    Args:
+        command: Command starting completion.py.
+        concurrency: Requests sent without waiting for a response.
+        paced: Send the requests at their recorded times.
+        timeout: Seconds after which a request still not answered is
+            counted as an error.
+    """
+
+    def __init__(self, command, concurrency=1, paced=False, timeout=30.0):
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=SRC_ROOT)
+        self._concurrency = max(concurrency, 1)
+        self._paced = paced
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        # Request id -> (lookup, time sent).
+        self._pending = {}
+        self._answered = threading.Condition(self._lock)
+        self.results = []
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _send(self, request):
+        line = json.dumps(request) + '\n'
+        self._process.stdin.write(line.encode('utf-8'))
+        self._process.stdin.flush()
+
+    def _read(self):
+        for line in iter(self._process.stdout.readline, b''):
+            try:
+                response = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if 'id' not in response or response.get('incomplete'):
+                continue
+            with self._lock:
+                sent = self._pending.pop(response['id'], None)
+                if sent is None:
+                    continue
+                lookup, start = sent
+                self.results.append({
+                    'lookup': lookup, 'latency': time.time() - start,
+                    'cancelled': bool(response.get('cancelled')),
+                    'error': 'error' in response,
+                    'metrics': response.get('metrics')})
+                self._answered.notify_all()
+        with self._lock:
+            self._pending.clear()
+            self._answered.notify_all()
+
+    def _wait(self):
+        """Wait for a response, under the lock, dropping the requests not
+        answered within the timeout."""
+        self._answered.wait(min(self._timeout, 1.0))
+        now = time.time()
+        for identifier, (lookup, start) in list(self._pending.items()):
+            if now - start > self._timeout:
+                del self._pending[identifier]
+                self.results.append({
+                    'lookup': lookup, 'latency': now - start,
+                    'cancelled': False, 'error': True, 'metrics': None})
+
+    def run(self, recording, first_id=1):
+        """Replay a recording, returns the time it took to be answered."""
+        start = time.time()
+        identifier = first_id
+        # Recorded request id -> id it was sent with.
+        ids = {}
+        for entry in recording:
+            request = dict(entry['request'])
+            if self._paced:
+                delay = start + entry['time'] - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            lookup = request.get('lookup', 'completions')
+            if lookup == 'cancel':
+                request['id'] = ids.get(request.get('id'), request.get('id'))
+                self._send(request)
+                continue
+            if 'id' in request:
+                ids[request['id']] = identifier
+            request['id'] = identifier
+            identifier += 1
+            if lookup in CONTROL_MESSAGES:
+                self._send(request)
+                continue
+            if lookup == 'resolve' or 'resolve' in request.get('lookups', ()):
+                request['completionId'] = ids.get(request.get('completionId'),
+                                                  request.get('completionId'))
+            if 'lookups' in request:
+                lookup = ','.join(request['lookups'])
+            request.setdefault('config', CONFIG)
+            with self._lock:
+                while len(self._pending) >= self._concurrency:
+                    self._wait()
+                self._pending[request['id']] = lookup, time.time()
+            self._send(request)
+        with self._lock:
+            while self._pending:
+                self._wait()
+        return time.time() - start, identifier
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+
+def summarize(results, duration):
+    """Latency percentiles, phases and memory of each lookup."""
+    lookups = {}
+    for result in results:
+        lookups.setdefault(result['lookup'], []).append(result)
+    summary = {'requests': len(results), 'duration': duration,
+               'throughput': len(results) / duration if duration else None,
+               'peakRss': None, 'lookups': {}}
+    for lookup, lookup_results in sorted(lookups.items()):
+        latencies = sorted(r['latency'] for r in lookup_results)
+        phases = {}
+        for result in lookup_results:
+            metrics = result['metrics'] or {}
+            for phase, seconds in metrics.get('phases', {}).items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+            if metrics.get('peakRss'):
+                summary['peakRss'] = max(summary['peakRss'] or 0,
+                                         metrics['peakRss'])
+        summary['lookups'][lookup] = {
+            'count': len(latencies),
+            'cancelled': sum(1 for r in lookup_results if r['cancelled']),
+            'errors': sum(1 for r in lookup_results if r['error']),
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'phases': dict((phase, seconds / len(latencies))
+                           for phase, seconds in phases.items()),
+        }
+    return summary
+
+
+def report(summary, out=sys.stdout):
+    columns = ('count', 'p50', 'p95', 'p99', 'mean')
+    print('%-24s %7s %9s %9s %9s %9s' % (('lookup',) + columns), file=out)
+    for lookup, stats in sorted(summary['lookups'].items()):
+        print('%-24s %7d %8.1fms %8.1fms %8.1fms %8.1fms' % (
+            (lookup, stats['count']) +
+            tuple(stats[column] * 1000 for column in columns[1:])), file=out)
+    print('', file=out)
+    print('phases (mean ms)', file=out)
+    for lookup, stats in sorted(summary['lookups'].items()):
+        phases = ', '.join('%s %.1f' % (phase, seconds * 1000)
+                           for phase, seconds in sorted(stats['phases'].items()))
+        print('  %-22s %s' % (lookup, phases), file=out)
+    print('', file=out)
+    print('%d requests in %.2fs, %.1f requests/s' % (
+        summary['requests'], summary['duration'], summary['throughput'] or 0),
+        file=out)
+    if summary['peakRss']:
+        print('peak RSS %.1f MiB' % (summary['peakRss'] / 1024.0 / 1024), file=out)
+
+
+def main(args):
+    recording = []
+    for path in args.recordings:
+        recording.extend(load_recording(path))
+    recording.extend(corpus([d for d in args.corpus.split(',') if d]))
+    if not recording:
+        print('Nothing to replay, give recordings or --corpus.', file=sys.stderr)
+        return 2
+    if args.write_corpus:
+        with io.open(args.write_corpus, 'w', encoding='utf-8') as corpus_file:
+            for entry in recording:
+                corpus_file.write(json.dumps(entry) + u'\n')
+        return 0
+
+    command = [sys.executable, COMPLETION, '--metrics=response']
+    command.extend(args.server_args)
+    if args.jedi:
+        command.extend(['custom', args.jedi])
+    replay = Replay(command, args.concurrency, args.paced, args.timeout)
+    try:
+        next_id = 1
+        if args.warmup:
+            _, next_id = replay.run(recording, next_id)
+            del replay.results[:]
+        duration = 0.0
+        for _ in range(args.rounds):
+            elapsed, next_id = replay.run(recording, next_id)
+            duration += elapsed
+    finally:
+        replay.close()
+
+    summary = summarize(replay.results, duration)
+    report(summary)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(summary, json_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,214 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Time normalizeForInterpreter on large generated selections.
+
+Compares the time and peak memory of the current implementation with the
+previous one, kept below as the baseline, then running a process for each
+selection with sending it to `normalizeForInterpreter.py --server`:
+
+    python benchmarks/normalize_benchmark.py --lines=1000,5000,20000
+"""
+
+from __future__ import print_function
+
+import argparse
+import ast
+import json
+import operator
+import os.path
+import subprocess
+import sys
+import timeit
+import token
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SRC_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NORMALIZE = os.path.join(SRC_ROOT, 'normalizeForInterpreter.py')
+
+sys.path.insert(0, SRC_ROOT)
+
+import normalizeForInterpreter  # noqa: E402
+
+
+def _baseline_global_statement_blocks(source, lines):
+    tree = ast.parse(source)
+    line_numbers = [node.lineno for node in tree.body if node.col_offset == 0]
+    end_line_numbers = [line_number - 1 for line_number in line_numbers[1:]]
+    end_line_numbers.append(len(lines))
+
+    statement_ranges = []
+    for line_number, end_line_number in zip(line_numbers, end_line_numbers):
+        current_statement_is_oneline = line_number == end_line_number
+
+        if len(statement_ranges) == 0:
+            statement_ranges.append((line_number, end_line_number, current_statement_is_oneline))
+            continue
+
+        previous_statement = statement_ranges[-1]
+        previous_statement_is_oneline = previous_statement[2]
+        if previous_statement_is_oneline and current_statement_is_oneline:
+            statement_ranges[-1] = previous_statement[0], end_line_number, True
+        else:
+            statement_ranges.append((line_number, end_line_number, current_statement_is_oneline))
+
+    return statement_ranges
+
+
+def baseline_normalize(source):
+    """normalize before it was made a single pass over the lines."""
+    lines = source.splitlines(False)
+    if (len(lines) > 1 and len(''.join(lines[-2:])) == 0) \
+        or source.endswith(('\n\n', '\r\n\r\n')):
+        trailing_newline = '\n' * 2
+    elif len(lines[-1].strip()) == 0 or source.endswith(('\n', '\r\n')):
+        trailing_newline = '\n'
+    else:
+        trailing_newline = ''
+
+    tokens = normalizeForInterpreter._tokenize(source)
+    newlines_indexes_to_remove = (spos[0] for (toknum, tokval, spos, epos, line) in tokens
+                                  if len(line.strip()) == 0
+                                     and token.tok_name[toknum] == 'NL'
+                                     and spos[0] == epos[0])
+
+    for line_number in reversed(list(newlines_indexes_to_remove)):
+        del lines[line_number-1]
+
+    source = '\n'.join(lines)
+    global_statement_ranges = _baseline_global_statement_blocks(source, lines)
+    start_positions = map(operator.itemgetter(0), reversed(global_statement_ranges))
+    for line_number in filter(lambda x: x > 1, start_positions):
+        lines.insert(line_number-1, '')
+
+    return '\n'.join(lines) + trailing_newline
+
+
+def generate_source(line_count):
+    """Selection of about `line_count` lines mixing one-line statements,
+    blocks and blank lines, like a script sent to the REPL."""
+    chunks = []
+    lines = 0
+    index = 0
+    while lines < line_count:
+        if index % 3 == 0:
+            chunk = 'value_{0} = {0}\nresult_{0} = value_{0} * 2\n\n'.format(index)
+        elif index % 3 == 1:
+            chunk = ('def function_{0}(a, b):\n'
+                     '    total = a + b\n'
+                     '\n'
+                     '    if total > {0}:\n'
+                     '        return total\n'
+                     '    return -total\n'
+                     '\n').format(index)
+        else:
+            chunk = ('class Class_{0}(object):\n'
+                     '    def method(self):\n'
+                     '        return [{0},\n'
+                     '                {0}]\n'
+                     '\n').format(index)
+        chunks.append(chunk)
+        lines += chunk.count('\n')
+        index += 1
+    return ''.join(chunks)
+
+
+def _best(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def _peak_memory(function):
+    """Peak of the memory allocated by Python while running function."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_normalize(source, repeat):
+    """Time and peak memory of the baseline, then of the current version."""
+    assert baseline_normalize(source) == normalizeForInterpreter.normalize(source), \
+        'Normalized code differs from the baseline'
+    results = []
+    for normalize in (baseline_normalize, normalizeForInterpreter.normalize):
+        results.append((_best(lambda: normalize(source), repeat),
+                        _peak_memory(lambda: normalize(source))))
+    return results
+
+
+def benchmark_server(source, runs):
+    """Mean time to normalize a selection in a new process, then through a
+    running server."""
+    def run_process():
+        subprocess.check_output([sys.executable, NORMALIZE, source])
+
+    server = subprocess.Popen([sys.executable, NORMALIZE, '--server'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    request = (json.dumps({'id': 1, 'code': source}) + '\n').encode('utf-8')
+
+    def send():
+        server.stdin.write(request)
+        server.stdin.flush()
+        response = json.loads(server.stdout.readline().decode('utf-8'))
+        assert 'normalized' in response, response
+
+    try:
+        # Warm up the server.
+        send()
+        return (timeit.timeit(run_process, number=runs) / runs,
+                timeit.timeit(send, number=runs) / runs)
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', default='1000,5000,20000',
+                        help='comma separated sizes of the generated sources')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each measurement, the best one is kept')
+    parser.add_argument('--server-runs', type=int, default=20,
+                        help='selections sent to the server, 0 to skip')
+    parser.add_argument('--server-lines', type=int, default=20,
+                        help='size of the selections sent to the server')
+    args = parser.parse_args(argv)
+
+    print('%-34s %8s %12s %12s %8s' % ('', 'lines', 'baseline', 'current', 'speedup'))
+    memory = []
+    for line_count in [int(count) for count in args.lines.split(',')]:
+        source = generate_source(line_count)
+        (baseline, baseline_memory), (current, current_memory) = \
+            benchmark_normalize(source, args.repeat)
+        memory.append((line_count, baseline_memory, current_memory))
+        print('%-34s %8d %10.1fms %10.1fms %7.1fx' % (
+            'normalize', line_count, baseline * 1000, current * 1000,
+            baseline / current))
+
+    if args.server_runs:
+        process, server = benchmark_server(
+            generate_source(args.server_lines), args.server_runs)
+        print('%-34s %8d %10.2fms %10.2fms %7.1fx' % (
+            'process per selection / --server', args.server_lines,
+            process * 1000, server * 1000, process / server))
+
+    if tracemalloc is not None:
+        print('')
+        print('%-34s %8s %12s %12s' % ('peak memory', 'lines', 'baseline', 'current'))
+        for line_count, baseline_memory, current_memory in memory:
+            print('%-34s %8d %9.1fMiB %9.1fMiB' % (
+                'normalize', line_count, baseline_memory / 1024.0 / 1024,
+                current_memory / 1024.0 / 1024))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
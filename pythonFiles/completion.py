@@ -4,27 +4,1577 @@ import io
 import re
 import sys
 import json
+import hashlib
 import traceback
+import subprocess
 import platform
+import time
+import threading
+import contextlib
+import collections
+import copy
+import heapq
+import itertools
+import weakref
 
 jediPreview = False
 
-class RedirectStdout(object):
-    def __init__(self, new_stdout=None):
-        """If stdout is None, redirect to /dev/null"""
-        self._new_stdout = new_stdout or open(os.devnull, 'w')
+try:
+    import ujson
+    ujson.dumps('/', escape_forward_slashes=False)
+except Exception:
+    # Not installed, or too old.
+    ujson = None
 
-    def __enter__(self):
-        sys.stdout.flush()
-        self.oldstdout_fno = os.dup(sys.stdout.fileno())
-        os.dup2(self._new_stdout.fileno(), 1)
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._new_stdout.flush()
-        os.dup2(self.oldstdout_fno, 1)
-        os.close(self.oldstdout_fno)
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
 
-class JediCompletion(object):
+
+def _dumps(value):
+    """Encode a message for VSCode as compact JSON, with ujson if installed."""
+    if ujson is not None:
+        return ujson.dumps(value, escape_forward_slashes=False)
+    return _json_encoder.encode(value)
+
+
+def _redirect_stdout():
+    """Send stdout to /dev/null for good, so nothing printed by Jedi or the
+    modules it imports ends up among the responses.
+
+    Returns:
+        File descriptor of a copy of the original stdout, for the responses.
+    """
+    sys.stdout.flush()
+    output = os.dup(sys.stdout.fileno())
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    return output
+
+
+class Document(object):
+    """In-memory copy of an open buffer, kept in sync by incremental edits."""
+    _line_pattern = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+    def __init__(self, source, version=None):
+        self.version = version
+        self._lines = self._split_lines(source)
+        self._source = source
+
+    @classmethod
+    def _split_lines(cls, text):
+        return cls._line_pattern.findall(text)
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = ''.join(self._lines)
+        return self._source
+
+    def _line(self, index):
+        return self._lines[index] if index < len(self._lines) else ''
+
+    def apply_change(self, change):
+        """Apply one edit to the buffer.
+
+        Args:
+            change: Dictionary with the new `text` and the `range` it
+                replaces, given as zero based `line` and `character`
+                positions. Without a range the whole buffer is replaced.
+        """
+        if 'range' not in change:
+            self._lines = self._split_lines(change['text'])
+            self._source = change['text']
+            return
+        start = change['range']['start']
+        end = change['range']['end']
+        start_line = self._line(start['line'])
+        end_line = self._line(end['line'])
+        text = (start_line[:start['character']] + change['text'] +
+                end_line[end['character']:])
+        self._lines[start['line']:end['line'] + 1] = self._split_lines(text)
+        self._source = None
+
+
+class DocumentStore(object):
+    """Open documents by path, so requests do not have to send the source.
+
+    Only used from the thread reading the requests, which resolves the
+    source of each request before it is queued.
+    """
+
+    def __init__(self):
+        self._documents = {}
+
+    def open(self, path, source, version=None):
+        self._documents[path] = Document(source, version)
+
+    def change(self, path, changes, version=None):
+        """Apply edits to an open document.
+
+        Raises:
+            ValueError: If the path is not open.
+        """
+        document = self._documents.get(path)
+        if document is None:
+            raise ValueError('Document %s is not open' % path)
+        for change in changes:
+            document.apply_change(change)
+        document.version = version
+
+    def close(self, path):
+        self._documents.pop(path, None)
+
+    def get(self, path, version=None):
+        """Get the document for a request.
+
+        Returns:
+            Open document, None if the path is not open.
+
+        Raises:
+            ValueError: If a version is given and the document is not open
+                or is at a different one.
+        """
+        document = self._documents.get(path)
+        if version is None:
+            return document
+        if document is None:
+            raise ValueError('Document %s is not open' % path)
+        if document.version != version:
+            raise ValueError('Document %s is at version %s, not %s' % (
+                path, document.version, version))
+        return document
+
+
+class RequestRecorder(object):
+    """Records the requests read, to replay them without VSCode.
+
+    Each line of the recording is a JSON object with the `time` a request
+    was read, in seconds since the first one, and the `request`. Lookups
+    for files that are neither sent nor open get a snapshot of the file
+    as their source, so a replay does not depend on the files on disk.
+    """
+
+    control_messages = ('cancel', 'open', 'change', 'close')
+
+    def __init__(self, path):
+        self._file = io.open(path, 'a', encoding='utf-8')
+        self._start = None
+
+    def record(self, request, documents):
+        now = time.time()
+        if self._start is None:
+            self._start = now
+        path = request.get('path')
+        if 'source' not in request and path \
+                and request.get('lookup') not in self.control_messages \
+                and documents.get(path) is None:
+            try:
+                with io.open(path, encoding='utf-8') as source_file:
+                    request = dict(request, source=source_file.read())
+            except (IOError, OSError, ValueError):
+                pass
+        # Timings added when the request was read are not part of it.
+        request = dict((key, value) for key, value in request.items()
+                       if key != '_received')
+        line = json.dumps({'time': now - self._start, 'request': request})
+        self._file.write(line + u'\n')
+        self._file.flush()
+
+
+class RequestQueue(object):
+    """Requests waiting for a worker, which can be dropped before they run.
+
+    When superseding is turned on, a new request for one of the lookups sent
+    on every keystroke drops any older request of the same lookup and path
+    still waiting in the queue, nobody is going to read their results.
+    """
+    supersedable_lookups = ('completions', 'tooltip', 'arguments')
+
+    def __init__(self, supersede=False):
+        self._supersede = supersede
+        self._pending = collections.deque()
+        self._running = set()
+        self._cancelled = set()
+        self._condition = threading.Condition()
+
+    def _supersede_key(self, request):
+        lookups = request.get('lookups') or [request.get('lookup', 'completions')]
+        if any(lookup not in self.supersedable_lookups for lookup in lookups):
+            return None
+        return tuple(lookups), request.get('path', '')
+
+    def put(self, request):
+        """Queue a request.
+
+        Returns:
+            List of the queued requests superseded by this one.
+        """
+        with self._condition:
+            superseded = []
+            key = self._supersede_key(request) if self._supersede else None
+            if key is not None:
+                superseded = [r for r in self._pending
+                              if self._supersede_key(r) == key]
+                for r in superseded:
+                    self._pending.remove(r)
+            self._pending.append(request)
+            self._condition.notify()
+            return superseded
+
+    def get(self):
+        """Wait for the next request and mark it as running."""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            request = self._pending.popleft()
+            self._running.add(request.get('id'))
+            return request
+
+    def done(self, request):
+        """Mark a request as finished.
+
+        Returns:
+            True if the request was cancelled while it was running.
+        """
+        with self._condition:
+            identifier = request.get('id')
+            self._running.discard(identifier)
+            self._condition.notify_all()
+            if identifier in self._cancelled:
+                self._cancelled.discard(identifier)
+                return True
+            return False
+
+    def cancelled(self, request):
+        """Whether nobody is waiting for the results of a running request.
+
+        That is the case once it was cancelled, or, when superseding is
+        turned on, once a newer request for the same lookup and path is
+        queued. Unlike `done` this leaves the request running.
+        """
+        with self._condition:
+            if request.get('id') in self._cancelled:
+                return True
+            key = self._supersede_key(request) if self._supersede else None
+            return key is not None and any(
+                self._supersede_key(r) == key for r in self._pending)
+
+    def wait_until_idle(self, timeout):
+        """Wait until no requests are queued or running.
+
+        Returns:
+            True if idle, False if the timeout expired first.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._pending or self._running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def cancel(self, identifier):
+        """Cancel a request.
+
+        Queued requests are dropped, running ones cannot be interrupted but
+        their results are discarded once they finish.
+
+        Returns:
+            The dropped request, None if it was not queued.
+        """
+        with self._condition:
+            for request in self._pending:
+                if request.get('id') == identifier:
+                    self._pending.remove(request)
+                    return request
+            if identifier in self._running:
+                self._cancelled.add(identifier)
+            return None
+
+
+def _reset_limits(script):
+    """Let a lookup on a script that already ran lookups infer as much as
+    on a new one.
+
+    Jedi counts recursions, function executions and the inferences of each
+    node against limits of the evaluator that are only reset when a script is
+    created. Later lookups sharing the evaluator would silently find nothing
+    once they are reached.
+    """
+    evaluator = getattr(script, '_evaluator', None)
+    reset = getattr(evaluator, 'reset_recursion_limitations', None)
+    if reset is not None:
+        reset()
+    counts = getattr(evaluator, 'inferred_element_counts', None)
+    if counts is not None:
+        counts.clear()
+
+
+def _script_at(script, line, column):
+    """Copy of a jedi.Script for another position in the same source.
+
+    The copy shares the parsed module and the evaluator, along with all the
+    inference results it has cached, with the original script. The limits
+    of the evaluator are reset for the lookups on the copy.
+    """
+    code_lines = script._code_lines
+    if not (0 < line <= len(code_lines)):
+        raise ValueError('`line` parameter is not in a valid range.')
+    line_string = code_lines[line - 1]
+    line_len = len(line_string.rstrip('\r\n'))
+    if not (0 <= column <= line_len):
+        raise ValueError('`column` parameter is not in a valid range.')
+    positioned = copy.copy(script)
+    positioned._pos = line, column
+    _reset_limits(positioned)
+    return positioned
+
+
+def _word_before(script):
+    """Part of the name before the position of a script."""
+    line, column = script._pos
+    text = script._code_lines[line - 1][:column]
+    return re.search(r'\w*$', text).group(0)
+
+
+def _match_rank(name, word):
+    """How well a name matches the word typed, lower is better.
+
+    Names starting with the word come first, case sensitive matches before
+    insensitive ones. Names containing the letters of the word in order
+    follow, those with the fewest gaps between the letters first.
+    """
+    if name.startswith(word):
+        return 0, 0
+    lower_name = name.lower()
+    lower_word = word.lower()
+    if lower_name.startswith(lower_word):
+        return 1, 0
+    gaps = 0
+    position = 0
+    for char in lower_word:
+        index = lower_name.find(char, position)
+        if index < 0:
+            return 3, 0
+        if index != position:
+            gaps += 1
+        position = index + 1
+    return 2, gaps
+
+
+def _ranked(items, word, get_name):
+    """Items sorted by how well their names match the word typed.
+
+    Items that match equally well keep their order.
+    """
+    return sorted(items, key=lambda item: _match_rank(get_name(item), word))
+
+
+def _parsed_modules(path):
+    """Module trees parso keeps for a path, by grammar."""
+    try:
+        from parso.cache import parser_cache
+    except ImportError:
+        return []
+    return [modules for modules in parser_cache.values() if path in modules]
+
+
+class ParserCacheGuard(object):
+    """Keeps parso from changing module trees that are in use.
+
+    Jedi parses sources with parso's diff parser, which updates the tree it
+    cached for the path in place. Another lookup working on that tree, as
+    the script or as an imported module, would see it change under it. The
+    diff parser is only let loose when no other lookup is running, otherwise
+    the cached tree is dropped so the source gets a tree of its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = 0
+
+    @contextlib.contextmanager
+    def lookup(self):
+        """Hold while a lookup is using module trees."""
+        with self._lock:
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    @contextlib.contextmanager
+    def parsing(self, path, allow_in_place=True):
+        """Hold while creating a jedi.Script for the path.
+
+        Args:
+            path: Path of the script.
+            allow_in_place: False to always parse into a tree of its own.
+
+        Yields:
+            True if the tree cached for the path may be updated in place,
+            trees of previously created scripts can't be trusted then.
+        """
+        with self._lock:
+            modules = _parsed_modules(path)
+            in_place = allow_in_place and bool(modules) and self._running <= 1
+            if not in_place:
+                for cached in modules:
+                    cached.pop(path, None)
+            yield in_place
+
+
+parser_cache_guard = ParserCacheGuard()
+
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+def _peak_rss():
+    """Peak resident set size of the process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class SlowestProfiles(object):
+    """Profiles requests and keeps the profiles of the slowest ones.
+
+    Profiles are dumped to the directory as `.prof` files readable with
+    pstats, the file of a profile is removed once `count` slower requests
+    have been seen. Only one request is profiled at a time, requests
+    running alongside it are not profiled.
+    """
+
+    def __init__(self, directory, count=10):
+        self._directory = directory
+        self._count = count
+        # Heap of (duration, file) of the profiles kept.
+        self._kept = []
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @contextlib.contextmanager
+    def profile(self, request):
+        if not self._profiling.acquire(False):
+            yield
+            return
+        try:
+            import cProfile
+            profiler = cProfile.Profile()
+            start = time.time()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self._keep(time.time() - start, profiler, request)
+        finally:
+            self._profiling.release()
+
+    def _keep(self, duration, profiler, request):
+        with self._lock:
+            if len(self._kept) >= self._count and duration <= self._kept[0][0]:
+                return
+            path = os.path.join(self._directory, '%.3f-%s-%d-%s.prof' % (
+                duration, request.get('lookup', 'completions'), os.getpid(),
+                request.get('id')))
+            profiler.dump_stats(path)
+            heapq.heappush(self._kept, (duration, path))
+            while len(self._kept) > self._count:
+                _, removed = heapq.heappop(self._kept)
+                try:
+                    os.remove(removed)
+                except OSError:
+                    pass
+
+
+class RequestMetrics(object):
+    """Opt-in timings and statistics of each request.
+
+    The phases of the request being handled by a thread are timed with
+    `phase` or `timed`, wherever they run, and other values are added with
+    `note`. Nothing is recorded unless configured.
+
+    Phases:
+        decode: Decoding the JSON request.
+        queue: Waiting for a worker.
+        script: Creating jedi.Script objects.
+        inference: Calls to Jedi's API. Inference Jedi does lazily while
+            results are serialized is counted as serialization.
+        serialize: The rest of the time spent on the lookups.
+        encode: Encoding the JSON response.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.in_response = False
+        self._log = None
+        self._log_lock = threading.Lock()
+        self._profiles = None
+        self._local = threading.local()
+
+    def configure(self, destination=None, profile_dir=None, profile_count=10):
+        """Turn metrics on.
+
+        Args:
+            destination: `response` to add the metrics to each response,
+                otherwise the path of a file to append them to as JSON lines.
+            profile_dir: Directory to keep the profiles of the slowest
+                requests in, no profiling if not given.
+            profile_count: Number of profiles to keep.
+        """
+        self.enabled = True
+        if destination == 'response':
+            self.in_response = True
+        elif destination:
+            self._log = io.open(destination, 'a', encoding='utf-8')
+        if profile_dir:
+            self._profiles = SlowestProfiles(profile_dir, profile_count)
+
+    def received(self, request, decode_time):
+        """Record when a request was read, and how long decoding took."""
+        if self.enabled:
+            request['_received'] = time.time(), decode_time
+
+    @contextlib.contextmanager
+    def request(self, request):
+        """Record the metrics of a request handled by this thread.
+
+        Yields:
+            Dictionary with the metrics, None when turned off.
+        """
+        if not self.enabled:
+            yield None
+            return
+        start = time.time()
+        received, decode_time = request.pop('_received', (start, 0.0))
+        source = request.get('source')
+        metrics = {
+            'lookup': request.get('lookups', request.get('lookup', 'completions')),
+            'sourceBytes': len(source) if source is not None else None,
+            'phases': {'decode': decode_time, 'queue': start - received},
+        }
+        self._local.metrics = metrics
+        try:
+            if self._profiles is not None:
+                with self._profiles.profile(request):
+                    yield metrics
+            else:
+                yield metrics
+        finally:
+            self._local.metrics = None
+            phases = metrics['phases']
+            phases['serialize'] = max(0.0, phases.pop('lookups', 0.0) -
+                                      phases.get('script', 0.0) -
+                                      phases.get('inference', 0.0))
+            metrics['total'] = time.time() - start
+            metrics['peakRss'] = _peak_rss()
+            if self._log is not None:
+                line = json.dumps(dict(metrics, id=request.get('id')))
+                with self._log_lock:
+                    self._log.write(line + u'\n')
+                    self._log.flush()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        metrics = getattr(self._local, 'metrics', None)
+        if metrics is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            phases = metrics['phases']
+            phases[name] = phases.get(name, 0.0) + time.time() - start
+
+    def timed(self, name, function, *args, **kwargs):
+        """Call a function, timing it as a phase."""
+        with self.phase(name):
+            return function(*args, **kwargs)
+
+    def note(self, name, value):
+        metrics = getattr(self._local, 'metrics', None)
+        if metrics is not None:
+            metrics[name] = value
+
+
+request_metrics = RequestMetrics()
+
+
+class _CachedScript(object):
+    def __init__(self, source):
+        self.lock = threading.Lock()
+        self.source = source
+        self.script = None
+
+
+class ScriptCache(object):
+    """Least recently used cache of jedi.Script objects.
+
+    Scripts are keyed by path, source and search path, so lookups sent
+    together for unchanged source (hover, signature help, definitions) only
+    parse the module once. A cached script is only used by one lookup at a
+    time, as Jedi's evaluator is not thread safe.
+
+    Args:
+        max_entries: Number of scripts to keep, 0 turns caching off.
+        max_bytes: Limit on the total size of the cached sources.
+    """
+
+    # All caches, scripts of one workspace may use trees of another.
+    _caches = weakref.WeakSet()
+
+    def __init__(self, max_entries=8, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        ScriptCache._caches.add(self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _entry(self, path, source, sys_path):
+        key = (path, hash(source), tuple(sys_path))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.source == source:
+                self.hits += 1
+                request_metrics.note('scriptCacheHit', True)
+            else:
+                self.misses += 1
+                request_metrics.note('scriptCacheHit', False)
+                if entry is not None:
+                    self._bytes -= len(entry.source)
+                entry = _CachedScript(source)
+                self._bytes += len(source)
+            self._entries[key] = entry
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_entries or
+                    self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.source)
+                self.evictions += 1
+            return entry
+
+    def clear(self, keep=None):
+        """Drop the cached scripts, except for the entry to keep."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry is not keep:
+                    del self._entries[key]
+                    self._bytes -= len(entry.source)
+
+    def _cached_entry(self, script):
+        """Entry of a script created for a position by the cache."""
+        evaluator = getattr(script, '_evaluator', None)
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.script is not None and entry.script._evaluator is evaluator:
+                    return entry
+        return None
+
+    def holds(self, script):
+        return self._cached_entry(script) is not None
+
+    @contextlib.contextmanager
+    def reuse(self, script):
+        """Use a script created by the cache again, after its lookup.
+
+        Yields:
+            True if the script is still cached and can be used. Scripts that
+            were dropped may refer to trees that have been updated since.
+        """
+        entry = self._cached_entry(script)
+        if entry is None:
+            yield False
+            return
+        with entry.lock:
+            with self._lock:
+                cached = entry in self._entries.values()
+            yield cached
+
+    def create(self, keep=None, **kwargs):
+        """Create a jedi.Script, dropping the cached scripts it invalidates.
+
+        Args:
+            keep: Entry the script is created for.
+            kwargs: Arguments of jedi.Script.
+        """
+        with parser_cache_guard.parsing(kwargs.get('path')) as in_place:
+            if in_place:
+                for cache in list(ScriptCache._caches):
+                    cache.clear(keep)
+            with request_metrics.phase('script'):
+                return jedi.Script(**kwargs)
+
+    @contextlib.contextmanager
+    def script(self, source, line, column, path, sys_path, environment):
+        """Get a jedi.Script for the position, creating it if needed.
+
+        Sources that are not given (read from disk by Jedi) and sources
+        larger than the cache are never cached.
+        """
+        if self.max_entries <= 0 or source is None or len(source) > self.max_bytes:
+            yield self.create(
+                source=source, line=line, column=column, path=path,
+                sys_path=sys_path, environment=environment)
+            return
+        entry = self._entry(path, source, sys_path)
+        with entry.lock:
+            if entry.script is None:
+                entry.script = self.create(
+                    keep=entry, source=source, path=path, sys_path=sys_path,
+                    environment=environment)
+            yield _script_at(entry.script, line, column)
+
+
+def _write_file(path, data):
+    """Replace the contents of a file, without leaving it half written."""
+    temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(data)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+class ImportProfile(object):
+    """Counts of the modules imported by the files of a workspace.
+
+    Each file is counted once per session. The counts are kept on disk, so
+    the next session can preload the modules imported most often.
+    """
+    version = 1
+    _import_pattern = re.compile(
+        r'^[ \t]*(?:from[ \t]+([\w.]+)[ \t]+import\b|import[ \t]+([\w., \t]+))',
+        re.MULTILINE)
+
+    def __init__(self, path=None):
+        self._path = path
+        self._counts = {}
+        self._recorded = set()
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with io.open(self._path, encoding='utf-8') as profile:
+                data = json.load(profile)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') == self.version:
+            self._counts = data.get('modules', {})
+
+    def save(self):
+        if not self._path:
+            return
+        with self._lock:
+            data = json.dumps({'version': self.version, 'modules': self._counts})
+        try:
+            _write_file(self._path, data)
+        except (IOError, OSError):
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+
+    def record(self, path, source):
+        """Count the modules imported by a file, if not done already."""
+        if not source or path in self._recorded:
+            return
+        modules = set()
+        for from_name, import_names in self._import_pattern.findall(source):
+            if from_name:
+                modules.add(from_name)
+                continue
+            for name in import_names.split(','):
+                name = name.split()
+                if name:
+                    modules.add(name[0])
+        with self._lock:
+            self._recorded.add(path)
+            for module in modules:
+                if module and not module.startswith('.'):
+                    self._counts[module] = self._counts.get(module, 0) + 1
+
+    def most_imported(self, count):
+        with self._lock:
+            counts = sorted(self._counts.items(), key=lambda item: (-item[1], item[0]))
+        return [module for module, _ in counts[:count]]
+
+
+class ModulePreloader(object):
+    """Preloads modules in the background while requests are served.
+
+    The modules given on the command line are loaded first, followed by the
+    modules imported most often according to the import profile. Each module
+    is only loaded once no requests are waiting, and progress is reported as
+    `{"event": "preload"}` messages so the editor can show readiness.
+
+    Args:
+        modules: Names of the modules to always load.
+        profile: ImportProfile of the workspace.
+        count: Number of modules to take from the profile.
+    """
+
+    # How long to wait for the requests to be handled before loading the
+    # next module anyway.
+    idle_timeout = 1.0
+
+    def __init__(self, modules=(), profile=None, count=10):
+        self.profile = profile or ImportProfile()
+        self._modules = list(modules)
+        for module in self.profile.most_imported(count):
+            if module not in self._modules:
+                self._modules.append(module)
+
+    def start(self, requests, write):
+        """Start preloading on a background thread.
+
+        Args:
+            requests: RequestQueue, preloading gives way to its requests.
+            write: Function writing a message to VSCode.
+        """
+        thread = threading.Thread(target=self._preload, args=(requests, write))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _progress(self, loaded, module=None):
+        return _dumps({'event': 'preload', 'module': module,
+                           'loaded': loaded, 'total': len(self._modules),
+                           'done': loaded == len(self._modules)})
+
+    def _preload(self, requests, write):
+        write(self._progress(0))
+        for loaded, module in enumerate(self._modules, 1):
+            requests.wait_until_idle(self.idle_timeout)
+            try:
+                with parser_cache_guard.lookup():
+                    source = 'import %s as x; x.' % module
+                    # The script has no path, like scripts for unsaved
+                    # files which may be cached, so never update in place.
+                    with parser_cache_guard.parsing(None, allow_in_place=False):
+                        script = jedi.Script(source, 1, len(source), None)
+                    script.completions()
+            except Exception:
+                sys.stderr.write(traceback.format_exc() + '\n')
+                sys.stderr.flush()
+            write(self._progress(loaded, module))
+
+
+class SearchPathResolver(object):
+    """Works out the search path for each request and remembers it.
+
+    The search path is the default one plus the configured extra paths and
+    the top level package of the file. Finding that package takes a stat
+    call per directory level, so whether a directory is a package is
+    remembered. It is checked again after `revalidate_after` seconds, and
+    only if the directory was modified, which is the case when an
+    `__init__.py` file was added to it or removed from it.
+
+    The same list is returned for the same extra paths and package, so
+    scripts cached for it stay valid until the path really changes.
+    """
+
+    def __init__(self, default_sys_path, revalidate_after=5.0, max_entries=256):
+        self._default_sys_path = list(default_sys_path)
+        self._revalidate_after = revalidate_after
+        self._max_entries = max_entries
+        # Directory -> (is package, modification time, when it was checked).
+        self._packages = {}
+        self._sys_paths = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _modification_time(self, directory):
+        try:
+            return os.stat(directory or os.curdir).st_mtime
+        except OSError:
+            return None
+
+    def _is_package(self, directory, now):
+        entry = self._packages.get(directory)
+        if entry is not None and now - entry[2] < self._revalidate_after:
+            return entry[0]
+        mtime = self._modification_time(directory)
+        if entry is not None and entry[1] == mtime:
+            is_package = entry[0]
+        else:
+            is_package = os.path.isfile(os.path.join(directory, '__init__.py'))
+        self._packages[directory] = (is_package, mtime, now)
+        return is_package
+
+    def top_level_module(self, path):
+        """Walk up through the directories looking for top level module.
+
+        Jedi will use current filepath to look for another modules at same
+        path, but it will not be able to see modules **above**, so our goal
+        is to find the higher python module available from filepath.
+        """
+        if not path:
+            return path
+        now = time.time()
+        with self._lock:
+            directory = os.path.dirname(path)
+            while self._is_package(directory, now):
+                path = directory
+                directory = os.path.dirname(path)
+                if directory == path:
+                    break
+        return path
+
+    def sys_path(self, extra_paths, path):
+        """Get the search path for a file.
+
+        The returned list is shared and must not be modified.
+        """
+        top_level = self.top_level_module(path)
+        key = (tuple(extra_paths), top_level)
+        with self._lock:
+            sys_path = self._sys_paths.pop(key, None)
+            if sys_path is None:
+                sys_path = list(self._default_sys_path)
+                for extra_path in extra_paths:
+                    if extra_path and extra_path not in sys_path:
+                        sys_path.insert(0, extra_path)
+                if len(top_level) > 0 and top_level not in sys_path:
+                    sys_path.insert(0, top_level)
+                if len(self._sys_paths) >= self._max_entries:
+                    self._sys_paths.popitem(last=False)
+            self._sys_paths[key] = sys_path
+            return sys_path
+
+
+class WorkspaceContext(object):
+    """State kept for one workspace root.
+
+    Args:
+        identifier: Workspace id sent with the requests, None for requests
+            without one.
+        environment: Jedi environment of the interpreter used by the root.
+        default_sys_path: Search path of the interpreter.
+        scripts: ScriptCache of the root.
+        python_path: Interpreter the environment was created for, None for
+            the interpreter running this script.
+        index: CompletionIndex of the interpreter, if any.
+        references: ReferenceIndex of the root, if any.
+    """
+
+    def __init__(self, identifier, environment, default_sys_path, scripts,
+                 python_path=None, index=None, references=None):
+        self.identifier = identifier
+        self.environment = environment
+        self.default_sys_path = default_sys_path
+        self.search_paths = SearchPathResolver(default_sys_path)
+        self.scripts = scripts
+        self.python_path = python_path
+        self.index = index
+        self.references = references
+        # Config of the last request, for requests that do not send one.
+        self.config = {}
+        # Last lazy result set: request id, script, completions by name and
+        # when it was created.
+        self.resolvable = (None, None, {}, 0)
+        self.resolvable_lock = threading.Lock()
+        self.active = 0
+        self.last_used = time.time()
+
+    def memory(self):
+        """Bytes accounted to the root, the sources of its cached scripts."""
+        return self.scripts.stats()['bytes']
+
+    def close(self):
+        """Stop the background work for a root that is dropped."""
+        if self.references is not None:
+            self.references.stop()
+
+
+class WorkspaceContexts(object):
+    """Contexts of the workspace roots served by one process.
+
+    Each root gets its own search path, environment, caches and settings,
+    so roots do not thrash each other's caches. When there are more than
+    `max_contexts` roots, or their accounted memory is over `max_bytes`, the
+    least recently used roots without running requests are dropped.
+
+    Args:
+        create: Function creating the context for a workspace id and the
+            interpreter configured for it.
+        max_contexts: Number of roots to keep.
+        max_bytes: Limit on the memory accounted to all roots.
+    """
+
+    def __init__(self, create, max_contexts=4, max_bytes=32 * 1024 * 1024):
+        self._create = create
+        self.max_contexts = max_contexts
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._contexts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [{'workspace': c.identifier, 'bytes': c.memory(),
+                     'active': c.active, 'idle': now - c.last_used}
+                    for c in self._contexts.values()]
+
+    def _evict(self):
+        for identifier, context in list(self._contexts.items()):
+            if len(self._contexts) <= self.max_contexts and \
+                    sum(c.memory() for c in self._contexts.values()) <= self.max_bytes:
+                break
+            if context.active == 0:
+                del self._contexts[identifier]
+                context.close()
+                self.evictions += 1
+
+    @contextlib.contextmanager
+    def context(self, identifier, config=None):
+        """Use the context of a workspace, creating it if needed.
+
+        Args:
+            identifier: Workspace id.
+            config: Config sent with the request, the context keeps the
+                last one. The context is created again when the interpreter
+                (`pythonPath`) configured for the root changes.
+        """
+        with self._lock:
+            context = self._contexts.pop(identifier, None)
+            if config is not None:
+                python_path = config.get('pythonPath')
+                if context is not None and context.python_path != python_path:
+                    context.close()
+                    context = None
+            elif context is not None:
+                python_path = context.python_path
+            else:
+                python_path = None
+            if context is None:
+                context = self._create(identifier, python_path)
+            if config is not None:
+                context.config = config
+            self._contexts[identifier] = context
+            context.active += 1
+            self._evict()
+        try:
+            yield context
+        finally:
+            with self._lock:
+                context.active -= 1
+                context.last_used = time.time()
+
+
+def _module_bound_by_import(module_node, name):
+    """Find the module a name refers to in a parsed module.
+
+    Returns:
+        Dotted name of the module, None unless every definition of the name
+        is an `import` statement of the same module.
+    """
+    module = None
+    for leaf in module_node.get_used_names().get(name, []):
+        definition = leaf.get_definition()
+        if definition is None:
+            continue
+        if definition.type != 'import_name':
+            return None
+        path = '.'.join(n.value for n in definition.get_path_for_name(leaf))
+        if module is not None and module != path:
+            return None
+        module = path
+    return module
+
+
+class CompletionIndex(object):
+    """Persistent index of results for the attributes of installed modules.
+
+    Jedi infers the same installed packages again in every new process. The
+    completions and tooltips of the attributes of modules from the standard
+    library and site-packages are kept on disk instead. There is one index
+    per interpreter, keyed on its prefix, version and the installed
+    distributions, so installing or upgrading a package starts a new index.
+    Entries are also dropped when the module file is modified. Modules found
+    in the workspace are never indexed.
+
+    Args:
+        directory: Directory to keep the indexes in.
+        sys_path: Default search path of the interpreter.
+        revalidate_after: Seconds after which directory listings are checked
+            for changes.
+    """
+    version = 2
+    _extension_suffixes = ('.so', '.pyd')
+
+    def __init__(self, directory, sys_path, revalidate_after=5.0):
+        self._revalidate_after = revalidate_after
+        prefixes = set(os.path.normcase(p) for p in (
+            sys.prefix, sys.exec_prefix, getattr(sys, 'base_prefix', None),
+            getattr(sys, 'real_prefix', None)) if p)
+        self._installed_paths = set(p for p in sys_path if p and (
+            'site-packages' in p or 'dist-packages' in p or
+            any(os.path.normcase(p).startswith(prefix) for prefix in prefixes)))
+        self._directory = os.path.join(directory, self._interpreter_key())
+        # Module -> index entry, False if there is no entry on disk.
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        # Directory -> (names, modification time, when it was checked).
+        self._listings = {}
+        self._lock = threading.Lock()
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+        except OSError:
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+
+    def _interpreter_key(self):
+        distributions = []
+        for path in self._installed_paths:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            distributions.extend(n for n in names
+                                 if n.endswith(('.dist-info', '.egg-info')))
+        key = json.dumps([self.version, sys.prefix, sys.version, sorted(distributions)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _listing(self, directory, now):
+        listing = self._listings.get(directory)
+        if listing is not None and now - listing[2] < self._revalidate_after:
+            return listing[0]
+        try:
+            mtime = os.stat(directory or os.curdir).st_mtime
+        except OSError:
+            mtime = None
+        if listing is not None and listing[1] == mtime:
+            names = listing[0]
+        else:
+            try:
+                names = frozenset(os.listdir(directory or os.curdir))
+            except OSError:
+                names = frozenset()
+        self._listings[directory] = (names, mtime, now)
+        return names
+
+    def _find_in(self, directory, name, now):
+        names = self._listing(directory, now)
+        if name in names:
+            package = os.path.join(directory, name)
+            init = os.path.join(package, '__init__.py')
+            return init if os.path.isfile(init) else package
+        if name + '.py' in names:
+            return os.path.join(directory, name + '.py')
+        for filename in names:
+            if filename.startswith(name + '.') and \
+                    filename.endswith(self._extension_suffixes):
+                return os.path.join(directory, filename)
+        return None
+
+    def find_installed(self, module, search_path):
+        """Find an installed module.
+
+        Args:
+            module: Dotted name of the module.
+            search_path: Directories the module is imported from, in order.
+
+        Returns:
+            Location of the module as a list with its file and modification
+            time, None if it is not installed or is shadowed by a module in
+            the workspace.
+        """
+        name = module.split('.')[0]
+        if name in sys.builtin_module_names:
+            return [name, None]
+        now = time.time()
+        with self._lock:
+            for directory in search_path:
+                path = self._find_in(directory, name, now)
+                if path is not None:
+                    break
+            else:
+                return None
+        if directory not in self._installed_paths:
+            return None
+        try:
+            return [path, os.stat(path).st_mtime]
+        except OSError:
+            return None
+
+    def _entry(self, module):
+        entry = self._entries.get(module)
+        if entry is None:
+            entry = False
+            try:
+                with io.open(os.path.join(self._directory, module + '.json'),
+                             encoding='utf-8') as index_file:
+                    data = json.load(index_file)
+                if data.get('version') == self.version:
+                    entry = data
+            except (IOError, OSError, ValueError):
+                pass
+            self._entries[module] = entry
+        return entry
+
+    def get(self, module, location, key):
+        """Get indexed results, None if there are none for the location."""
+        with self._lock:
+            entry = self._entry(module)
+            results = None
+            if entry and entry['location'] == location:
+                results = entry['results'].get(key)
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            request_metrics.note('indexHit', results is not None)
+            return results
+
+    def stats(self):
+        with self._lock:
+            return {'modules': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+    def put(self, module, location, key, results):
+        with self._lock:
+            entry = self._entry(module)
+            if not entry or entry['location'] != location:
+                entry = {'version': self.version, 'module': module,
+                         'location': location, 'results': {}}
+                self._entries[module] = entry
+            entry['results'][key] = results
+            data = json.dumps(entry)
+        try:
+            _write_file(os.path.join(self._directory, module + '.json'), data)
+        except (IOError, OSError):
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+
+
+class ReferenceIndex(object):
+    """Names referred to by each module of a workspace root.
+
+    Jedi looks for usages by reading every module next to the definitions
+    and parsing those containing the name. The index narrows that down to
+    the modules of the root referring to the name, so Jedi only confirms
+    the usages in those. It is built and kept up to date by a background
+    thread, so usage searches never wait for a scan, and kept on disk.
+    Modules are read again when their modification time and size change,
+    unless their content hash did not change.
+
+    Args:
+        root: Directory indexed.
+        directory: Directory to keep the index in, None to keep it in
+            memory only.
+        rescan_after: Seconds between two scans of the root for changes.
+        max_files: Modules indexed at most.
+    """
+
+    version = 1
+    skipped_directories = ('node_modules', '__pycache__', 'site-packages')
+    _name = re.compile(r'[^\W\d]\w*', re.UNICODE)
+
+    def __init__(self, root, directory=None, rescan_after=5.0, max_files=20000):
+        self.root = os.path.normcase(os.path.abspath(root))
+        self.rescan_after = rescan_after
+        self.max_files = max_files
+        self._path = None
+        if directory is not None:
+            key = hashlib.sha1(self.root.encode('utf-8')).hexdigest()
+            self._path = os.path.join(directory, key + '.json')
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            except OSError:
+                sys.stderr.write(traceback.format_exc() + '\n')
+                sys.stderr.flush()
+        # Path -> [modification time, size, content hash, names].
+        self._files = {}
+        # Name -> paths of the modules referring to it.
+        self._modules = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = False
+        self._rescan = threading.Event()
+        self.ready = threading.Event()
+
+    def __contains__(self, path):
+        path = os.path.normcase(os.path.abspath(path))
+        return path.startswith(os.path.join(self.root, ''))
+
+    def candidates(self, name):
+        """Modules of the root that may refer to a name.
+
+        Returns:
+            Set of paths, None until the index is built.
+        """
+        if not self.ready.is_set():
+            return None
+        with self._lock:
+            return set(self._modules.get(name, ()))
+
+    def start(self):
+        """Start building and rescanning the index in the background."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        thread = threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        """Scan the root for changes now, instead of at the next rescan."""
+        self._rescan.set()
+
+    def stop(self):
+        """Stop rescanning, the index can still be used as it is."""
+        self._stopped = True
+        self._rescan.set()
+
+    def _watch(self):
+        while not self._stopped:
+            self._refresh()
+            self._rescan.wait(self.rescan_after)
+            self._rescan.clear()
+
+    def _refresh(self):
+        try:
+            if not self._files:
+                self._load()
+            if self._scan():
+                self._save()
+        except Exception:
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+        finally:
+            self.ready.set()
+
+    def _sources(self):
+        count = 0
+        for directory, directories, files in os.walk(self.root):
+            directories[:] = [d for d in directories
+                              if not d.startswith('.') and
+                              d not in self.skipped_directories and
+                              not os.path.exists(os.path.join(directory, d, 'pyvenv.cfg'))]
+            for name in files:
+                if name.endswith('.py'):
+                    count += 1
+                    if count > self.max_files:
+                        return
+                    yield os.path.normcase(os.path.join(directory, name))
+
+    def _scan(self):
+        """Update the modules that changed, returns whether any did."""
+        changed = False
+        seen = set()
+        for path in self._sources():
+            seen.add(path)
+            try:
+                stat = os.stat(path)
+                entry = self._files.get(path)
+                if entry is not None and entry[:2] == [stat.st_mtime, stat.st_size]:
+                    continue
+                with open(path, 'rb') as source_file:
+                    content = source_file.read()
+            except (IOError, OSError):
+                continue
+            digest = hashlib.sha1(content).hexdigest()
+            if entry is not None and entry[2] == digest:
+                entry[:2] = [stat.st_mtime, stat.st_size]
+            else:
+                names = sorted(set(self._name.findall(content.decode('utf-8', 'replace'))))
+                self._update(path, [stat.st_mtime, stat.st_size, digest, names])
+            changed = True
+        for path in set(self._files) - seen:
+            self._update(path, None)
+            changed = True
+        return changed
+
+    def _update(self, path, entry):
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                for name in old[3]:
+                    paths = self._modules.get(name)
+                    paths.discard(path)
+                    if not paths:
+                        del self._modules[name]
+            if entry is not None:
+                self._files[path] = entry
+                for name in entry[3]:
+                    self._modules.setdefault(name, set()).add(path)
+
+    def _load(self):
+        if self._path is None:
+            return
+        try:
+            with io.open(self._path, encoding='utf-8') as index_file:
+                data = json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != self.version or data.get('root') != self.root:
+            return
+        for path, entry in data['files'].items():
+            self._update(path, entry)
+
+    def _save(self):
+        if self._path is None:
+            return
+        with self._lock:
+            data = json.dumps({'version': self.version, 'root': self.root,
+                               'files': self._files})
+        try:
+            _write_file(self._path, data)
+        except (IOError, OSError):
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+
+
+class RequestDispatcher(object):
+    """Reads the requests sent by VSCode and queues them.
+
+    Control messages are handled straight away, the lookups are queued for
+    the subclass to run and to answer with `_write_response`.
+
+    Args:
+        supersede: Drop queued requests superseded by newer ones.
+        profile: ImportProfile recording the imports of the files.
+    """
+
+    def __init__(self, supersede=False, profile=None):
+        self._input = io.open(sys.stdin.fileno(), encoding='utf-8')
+        # Responses are written to a private copy of stdout, the real one is
+        # redirected once for all lookups.
+        self._output = _redirect_stdout()
+        self._output_lock = threading.Lock()
+        self._requests = RequestQueue(supersede)
+        self._documents = DocumentStore()
+        self._profile = profile or ImportProfile()
+        # RequestRecorder saving the requests read, if any.
+        self.recorder = None
+
+    def _serialize_cancelled(self, identifier):
+        """Response for a request that was cancelled or superseded."""
+        return _dumps({'id': identifier, 'results': [], 'cancelled': True})
+
+    def _serialize_error(self, identifier, message):
+        return _dumps({'id': identifier, 'results': [], 'error': message})
+
+    def _deserialize(self, request):
+        """Deserialize request from VSCode.
+
+        Args:
+            request: String with raw request from VSCode.
+
+        Returns:
+            Python dictionary with request data.
+        """
+        return json.loads(request)
+
+    def _write_response(self, response):
+        """Write a response line, encoded or not, with as few writes as the
+        pipe allows."""
+        if not isinstance(response, bytes):
+            response = response.encode('utf-8')
+        data = memoryview(response + b'\n')
+        with self._output_lock:
+            while data:
+                data = data[os.write(self._output, data):]
+
+    def _dispatch(self, request):
+        """Handle control messages and queue the lookups.
+
+        Control messages are handled in the order they were received, and
+        do not get a response of their own unless they fail. Documents are
+        kept in sync with `open`, `change` and `close` messages, see
+        `DocumentStore`.
+        """
+        lookup = request.get('lookup', 'completions')
+        if lookup == 'cancel':
+            if self._requests.cancel(request['id']) is not None:
+                self._write_response(self._serialize_cancelled(request['id']))
+            return
+        if lookup == 'open':
+            self._documents.open(request['path'], request['source'],
+                                 request.get('version'))
+            self._profile.record(request['path'], request['source'])
+            return
+        if lookup == 'change':
+            try:
+                self._documents.change(request['path'], request['changes'],
+                                       request.get('version'))
+            except ValueError as e:
+                self._write_response(self._serialize_error(request.get('id'), str(e)))
+            return
+        if lookup == 'close':
+            self._documents.close(request['path'])
+            return
+        if 'source' not in request and 'path' in request:
+            # Requests for open documents refer to them by path and version.
+            try:
+                document = self._documents.get(request['path'],
+                                               request.get('version'))
+            except ValueError as e:
+                self._write_response(self._serialize_error(request['id'], str(e)))
+                return
+            if document is not None:
+                request['source'] = document.source
+        else:
+            self._profile.record(request.get('path'), request.get('source'))
+        for superseded in self._requests.put(request):
+            self._write_response(self._serialize_cancelled(superseded['id']))
+
+    def _read_requests(self):
+        """Dispatch the requests read from stdin, until it is closed."""
+        while True:
+            try:
+                rq = self._input.readline()
+                if len(rq) == 0:
+                    # Reached EOF - indication our parent process is gone.
+                    sys.stderr.write('Received EOF from the standard input,exiting' + '\n')
+                    sys.stderr.flush()
+                    self._profile.save()
+                    return
+                start = time.time()
+                request = self._deserialize(rq)
+                request_metrics.received(request, time.time() - start)
+                if self.recorder is not None:
+                    self.recorder.record(request, self._documents)
+                self._dispatch(request)
+
+            except Exception:
+                sys.stderr.write(traceback.format_exc() + '\n')
+                sys.stderr.flush()
+
+
+class JediCompletion(RequestDispatcher):
     basic_types = {
         'module': 'import',
         'instance': 'variable',
@@ -32,10 +1582,38 @@ class JediCompletion(object):
         'param': 'variable',
     }
 
-    def __init__(self):
-        self.default_sys_path = sys.path
+    # Lookups that pull most of the project into the evaluator, their
+    # scripts are not worth keeping around.
+    uncached_lookups = ('usages',)
+    # Seconds for which completions sent with only name and kind can be
+    # resolved.
+    resolve_timeout = 60.0
+
+    _from_import_pattern = re.compile(
+        r'^\s*from\s+(\w[\w.]*)\s+import\s+(?:\(\s*)?(?:\w+(?:\s+as\s+\w+)?\s*,\s*)*(\w*)$')
+    _attribute_pattern = re.compile(r'(?:^|[^\w.])([A-Za-z_]\w*)\.(\w*)$')
+
+    def __init__(self, workers=1, supersede=False, script_cache_entries=8,
+                 script_cache_bytes=8 * 1024 * 1024, preloader=None,
+                 index=None, max_workspaces=4,
+                 workspace_bytes=32 * 1024 * 1024, reference_dir=None):
+        self.default_sys_path = list(sys.path)
         self.environment = jedi.api.environment.Environment(sys.prefix, sys.executable)
-        self._input = io.open(sys.stdin.fileno(), encoding='utf-8')
+        self._script_cache_size = script_cache_entries, script_cache_bytes
+        self._workspaces = WorkspaceContexts(
+            self._create_workspace, max_workspaces, workspace_bytes)
+        self._settings = _isolate_request_settings()
+        self._preloader = preloader or ModulePreloader()
+        super(JediCompletion, self).__init__(supersede, self._preloader.profile)
+        self._index = index
+        # Directory of the reference indexes used for usages, None when
+        # roots are not indexed.
+        self._reference_dir = reference_dir
+        self._usage_search = _narrow_usage_search() if reference_dir else None
+        self._worker_count = max(1, workers)
+        # Per request settings and workspace context, requests are handled
+        # concurrently.
+        self._config = threading.local()
         if (os.path.sep == '/') and (platform.uname()[2].find('Microsoft') > -1):
             # WSL; does not support UNC paths
             self.drive_mount = '/mnt/'
@@ -48,6 +1626,49 @@ class JediCompletion(object):
             # However, this may have more false positives trying to identify Windows/*nix hybrids
             self.drive_mount = ''
 
+    def _create_workspace(self, identifier, python_path):
+        """Create the context of a workspace root.
+
+        Roots configured with another interpreter get an environment for it,
+        falling back to this interpreter if it cannot be used.
+        """
+        scripts = ScriptCache(*self._script_cache_size)
+        references = self._reference_index(identifier)
+        if python_path and python_path != sys.executable:
+            try:
+                # The prefix is only informative in Jedi's environments.
+                prefix = os.path.dirname(python_path)
+                if os.path.basename(prefix) in ('bin', 'Scripts'):
+                    prefix = os.path.dirname(prefix)
+                environment = jedi.api.environment.Environment(prefix, python_path)
+                return WorkspaceContext(
+                    identifier, environment, list(environment.get_sys_path()),
+                    scripts, python_path, references=references)
+            except Exception:
+                sys.stderr.write(traceback.format_exc() + '\n')
+                sys.stderr.flush()
+        return WorkspaceContext(identifier, self.environment,
+                                self.default_sys_path, scripts, python_path,
+                                self._index, references)
+
+    def _reference_index(self, identifier):
+        """Index of the references in a root, started in the background.
+
+        The root is the workspace id when it is a directory, and the working
+        directory VSCode starts this script in for requests without one.
+        """
+        if self._usage_search is None:
+            return None
+        if identifier is None:
+            root = os.getcwd()
+        elif os.path.isdir(identifier):
+            root = identifier
+        else:
+            return None
+        references = ReferenceIndex(root, self._reference_dir)
+        references.start()
+        return references
+
     def _get_definition_type(self, definition):
         # if definition.type not in ['import', 'keyword'] and is_built_in():
         #    return 'builtin'
@@ -70,19 +1691,6 @@ class JediCompletion(object):
                            in nodes_to_display).replace('\n', '')
         return ''
 
-    @classmethod
-    def _get_top_level_module(cls, path):
-        """Recursively walk through directories looking for top level module.
-
-        Jedi will use current filepath to look for another modules at same
-        path, but it will not be able to see modules **above**, so our goal
-        is to find the higher python module available from filepath.
-        """
-        _path, _ = os.path.split(path)
-        if os.path.isfile(os.path.join(_path, '__init__.py')):
-            return cls._get_top_level_module(_path)
-        return path
-
     def _generate_signature(self, completion):
         """Generate signature with function arguments.
         """
@@ -100,7 +1708,7 @@ class JediCompletion(object):
         """
         _signatures = []
         try:
-            call_signatures = script.call_signatures()
+            call_signatures = request_metrics.timed('inference', script.call_signatures)
         except KeyError:
             call_signatures = []
         except :
@@ -139,7 +1747,7 @@ class JediCompletion(object):
         """
         _signatures = []
         try:
-            call_signatures = script.call_signatures()
+            call_signatures = request_metrics.timed('inference', script.call_signatures)
         except KeyError:
             call_signatures = []
         for signature in call_signatures:
@@ -176,22 +1784,32 @@ class JediCompletion(object):
                 sig["params"].append({"name": name, "value": value, "docstring": paramDocstring, "description": param.description})
         return _signatures
 
-    def _serialize_completions(self, script, identifier=None, prefix=''):
-        """Serialize response to be read from VSCode.
+    def _serialize_completions(self, script, prefix='', rank=False,
+                               resolvable=None):
+        """Serialize completions to be read from VSCode.
+
+        Function arguments come first, followed by the completions, which are
+        only serialized as they are consumed. When results are limited, the
+        ones never sent are never serialized.
 
         Args:
             script: Instance of jedi.api.Script object.
-            identifier: Unique completion identifier to pass back to VSCode.
             prefix: String with prefix to filter function arguments.
                 Used only when fuzzy matcher turned off.
+            rank: Order the completions by how well they match the name
+                being completed, instead of the order given by Jedi.
+            resolvable: Dictionary to fill with the completions by name, to
+                only send their name and kind and resolve the rest later.
 
-        Returns:
-            Serialized string to send to VSCode.
+        Yields:
+            Completions to send to VSCode.
         """
         _completions = []
+        # Name -> function arguments and completions with the name.
+        by_name = {}
 
         for signature, name, value in self._get_call_signatures(script):
-            if not self.fuzzy_matcher and not name.lower().startswith(
+            if not self._config.fuzzy_matcher and not name.lower().startswith(
                     prefix.lower()):
                 continue
             _completion = {
@@ -211,40 +1829,97 @@ class JediCompletion(object):
                 _completion['text'] = name
                 _completion['displayText'] = name
             _completions.append(_completion)
+            by_name.setdefault(name, []).append(_completion)
 
         try:
-            completions = script.completions()
+            completions = request_metrics.timed('inference', script.completions)
         except KeyError:
             completions = []
         except :
             completions = []
+        remaining = []
         for completion in completions:
+            same_name = by_name.get(completion.name)
+            if same_name is not None:
+                # ignore function arguments we already have
+                for c in same_name:
+                    if c['text'] == completion.name:
+                        try:
+                            c['type'] = self._get_definition_type(completion)
+                            c['raw_type'] = completion.type
+                        except Exception:
+                            pass
+                continue
+            by_name[completion.name] = []
+            remaining.append(completion)
+
+        if rank:
+            word = _word_before(script)
+            remaining = _ranked(remaining, word, lambda c: c.name)
+
+        lazy = resolvable is not None
+        if lazy:
+            resolvable.update((c.name, c) for c in remaining)
+        for _completion in _completions:
+            yield _completion
+        for completion in remaining:
             try:
-                _completion = {
-                    'text': completion.name,
-                    'type': self._get_definition_type(completion),
-                    'raw_type': completion.type,
-                    'rightLabel': self._additional_info(completion)
-                }
+                yield self._serialize_completion(completion, lazy)
             except Exception:
                 continue
 
-            for c in _completions:
-                if c['text'] == _completion['text']:
-                    c['type'] = _completion['type']
-                    c['raw_type'] = _completion['raw_type']
+    def _serialize_completion(self, completion, lazy=False):
+        _completion = {
+            'text': completion.name,
+            'type': self._get_definition_type(completion),
+            'raw_type': completion.type,
+        }
+        if not lazy:
+            _completion['rightLabel'] = self._additional_info(completion)
+        return _completion
 
-            if any([c['text'].split('=')[0] == _completion['text']
-                    for c in _completions]):
-                # ignore function arguments we already have
-                continue
-            _completions.append(_completion)
-        return json.dumps({'id': identifier, 'results': _completions})
+    def _resolve_completion(self, request):
+        """Serialize the details of a completion sent with only its name.
 
-    def _serialize_methods(self, script, identifier=None, prefix=''):
+        Completions are resolved from the last lazy result set, for as long
+        as its script is cached and `resolve_timeout` has not passed. Result
+        sets answered from the index have no script and keep their details.
+
+        Returns:
+            List with the completion, empty if it is not in the result set.
+        """
+        context = self._config.context
+        with context.resolvable_lock:
+            identifier, script, completions, created = context.resolvable
+        if identifier is None or identifier != request.get('completionId') \
+                or time.time() - created > self.resolve_timeout:
+            return []
+        completion = completions.get(request.get('text'))
+        if completion is None:
+            return []
+        if isinstance(completion, dict):
+            # Completion from the index, serialized with its details.
+            return [dict(completion)]
+        with context.scripts.reuse(script) as cached:
+            if not cached:
+                return []
+            _reset_limits(script)
+            return [self._resolved_completion(completion)]
+
+    def _resolved_completion(self, completion):
+        """Serialize a completion along with its docstring and signature."""
+        _completion = self._serialize_completion(completion)
+        try:
+            _completion['docstring'] = completion.docstring()
+        except Exception:
+            _completion['docstring'] = ''
+        _completion['signature'] = self._generate_signature(completion)
+        return _completion
+
+    def _serialize_methods(self, script):
         _methods = []
         try:
-            completions = script.completions()
+            completions = request_metrics.timed('inference', script.completions)
         except KeyError:
             return []
 
@@ -270,19 +1945,18 @@ class JediCompletion(object):
                 'line': completion.line,
                 'column': completion.column,
               })
-        return json.dumps({'id': identifier, 'results': _methods})
+        return _methods
 
-    def _serialize_arguments(self, script, identifier=None):
-        """Serialize response to be read from VSCode.
+    def _serialize_arguments(self, script):
+        """Serialize call signatures to be read from VSCode.
 
         Args:
             script: Instance of jedi.api.Script object.
-            identifier: Unique completion identifier to pass back to VSCode.
 
         Returns:
-            Serialized string to send to VSCode.
+            List of call signatures to send to VSCode.
         """
-        return json.dumps({"id": identifier, "results": self._get_call_signatures_with_args(script)})
+        return self._get_call_signatures_with_args(script)
 
     def _top_definition(self, definition):
         for d in definition.goto_assignments():
@@ -403,15 +2077,14 @@ class JediCompletion(object):
                 pass
         return _definitions
 
-    def _serialize_definitions(self, definitions, identifier=None):
-        """Serialize response to be read from VSCode.
+    def _serialize_definitions(self, definitions):
+        """Serialize definitions to be read from VSCode.
 
         Args:
             definitions: List of jedi.api.classes.Definition objects.
-            identifier: Unique completion identifier to pass back to VSCode.
 
         Returns:
-            Serialized string to send to VSCode.
+            List of definitions to send to VSCode.
         """
         _definitions = []
         for definition in definitions:
@@ -447,9 +2120,9 @@ class JediCompletion(object):
                     _definitions.append(_definition)
             except Exception as e:
                 pass
-        return json.dumps({'id': identifier, 'results': _definitions})
+        return _definitions
 
-    def _serialize_tooltip(self, definitions, identifier=None):
+    def _get_tooltips(self, definitions):
         _definitions = []
         for definition in definitions:
             signature = definition.name
@@ -480,9 +2153,9 @@ class JediCompletion(object):
                 'signature': signature
             }
             _definitions.append(_definition)
-        return json.dumps({'id': identifier, 'results': _definitions})
+        return _definitions
 
-    def _serialize_usages(self, usages, identifier=None):
+    def _serialize_usages(self, usages):
         _usages = []
         for usage in usages:
             _usages.append({
@@ -492,38 +2165,30 @@ class JediCompletion(object):
                 'line': usage.line,
                 'column': usage.column,
             })
-        return json.dumps({'id': identifier, 'results': _usages})
-
-    def _deserialize(self, request):
-        """Deserialize request from VSCode.
-
-        Args:
-            request: String with raw request from VSCode.
-
-        Returns:
-            Python dictionary with request data.
-        """
-        return json.loads(request)
+        return _usages
 
     def _set_request_config(self, config):
         """Sets config values for current request.
 
-        This includes sys.path modifications which is getting restored to
-        default value on each request so each project should be isolated
-        from each other.
+        This includes the extra search paths, which are added to the default
+        search path of each request so each project should be isolated from
+        each other. The global sys.path is left untouched as other requests
+        may be running at the same time.
 
         Args:
             config: Dictionary with config values.
         """
-        sys.path = self.default_sys_path
-        self.use_snippets = config.get('useSnippets')
-        self.show_doc_strings = config.get('showDescriptions', True)
-        self.fuzzy_matcher = config.get('fuzzyMatcher', False)
-        jedi.settings.case_insensitive_completion = config.get(
+        self._config.use_snippets = config.get('useSnippets')
+        self._config.show_doc_strings = config.get('showDescriptions', True)
+        self._config.fuzzy_matcher = config.get('fuzzyMatcher', False)
+        self._config.case_insensitive = config.get(
             'caseInsensitiveCompletion', True)
-        for path in config.get('extraPaths', []):
-            if path and path not in sys.path:
-                sys.path.insert(0, path)
+        if self._settings is not None:
+            self._settings.set('case_insensitive_completion',
+                               self._config.case_insensitive)
+        else:
+            jedi.settings.case_insensitive_completion = self._config.case_insensitive
+        self._config.extra_paths = config.get('extraPaths', [])
 
     def _normalize_request_path(self, request):
         """Normalize any Windows paths received by a *nix build of
@@ -545,101 +2210,802 @@ class JediCompletion(object):
                 request['path'] = newPath
 
     def _process_request(self, request):
-        """Accept serialized request from VSCode and write response.
+        """Accept deserialized request from VSCode and return response.
+
+        A request with a list of `lookups` runs all of them on one script for
+        the same source and position, the response has the results of each
+        lookup by name.
+
+        Requests with a `workspace` id run in the context of that root, see
+        `WorkspaceContexts`. Requests without a config use the config sent
+        last for their root.
         """
-        request = self._deserialize(request)
+        with self._workspaces.context(request.get('workspace'),
+                                      request.get('config')) as context:
+            self._config.context = context
+            self._set_request_config(context.config)
+
+            self._normalize_request_path(request)
+            sys_path = context.search_paths.sys_path(self._config.extra_paths,
+                                                     request.get('path', ''))
+            lookups = request.get('lookups')
+            with request_metrics.phase('lookups'):
+                if lookups is None:
+                    lookup = request.get('lookup', 'completions')
+                    results = self._process_lookups(request, [lookup], sys_path)[lookup]
+                else:
+                    results = self._process_lookups(request, lookups, sys_path)
+            if request_metrics.enabled:
+                request_metrics.note('scriptCache', context.scripts.stats())
+                if self._index is not None:
+                    request_metrics.note('index', self._index.stats())
+        return {'id': request['id'], 'results': results}
 
-        self._set_request_config(request.get('config', {}))
+    def _process_lookups(self, request, lookups, sys_path):
+        """Run the lookups of a request.
 
-        self._normalize_request_path(request)
-        path = self._get_top_level_module(request.get('path', ''))
-        if len(path) > 0 and path not in sys.path:
-            sys.path.insert(0, path)
-        lookup = request.get('lookup', 'completions')
+        Returns:
+            Dictionary with the results of each lookup.
+        """
+        results = {}
+        if 'resolve' in lookups:
+            results['resolve'] = self._resolve_completion(request)
+            lookups = [lookup for lookup in lookups if lookup != 'resolve']
+            if not lookups:
+                return results
+        context = self._config.context
+        if 'names' in lookups:
+            path = request.get('path', '')
+            with parser_cache_guard.parsing(path) as in_place:
+                if in_place:
+                    for cache in list(ScriptCache._caches):
+                        cache.clear()
+                definitions = request_metrics.timed(
+                    'inference', jedi.api.names,
+                    source=request.get('source', None), path=path,
+                    all_scopes=True, environment=context.environment)
+            results['names'] = self._serialize_definitions(definitions)
+            lookups = [lookup for lookup in lookups if lookup != 'names']
+            if not lookups:
+                return results
+
+        cached = not any(lookup in self.uncached_lookups for lookup in lookups)
+        with self._script(request, sys_path, cached) as script:
+            if len(lookups) == 1:
+                results[lookups[0]] = self._process_lookup(
+                    script, lookups[0], request, sys_path)
+                return results
+            for lookup in lookups:
+                _reset_limits(script)
+                # One failing lookup does not take the results of the others.
+                try:
+                    results[lookup] = self._process_lookup(
+                        script, lookup, request, sys_path)
+                except Exception:
+                    sys.stderr.write(traceback.format_exc() + '\n')
+                    sys.stderr.flush()
+                    results[lookup] = []
+        return results
+
+    @contextlib.contextmanager
+    def _script(self, request, sys_path, cached=True):
+        """Get the jedi.Script for the source and position of a request."""
+        context = self._config.context
+        if not cached:
+            yield context.scripts.create(
+                source=request.get('source', None), line=request['line'] + 1,
+                column=request['column'], path=request.get('path', ''),
+                sys_path=sys_path, environment=context.environment)
+            return
+        with context.scripts.script(
+                request.get('source', None), request['line'] + 1,
+                request['column'], request.get('path', ''), sys_path,
+                context.environment) as script:
+            yield script
+
+    def _index_context(self, script, lookup):
+        """Find out if a lookup is about an attribute of an imported module.
 
-        if lookup == 'names':
-            return self._serialize_definitions(
-                jedi.api.names(
-                    source=request.get('source', None),
-                    path=request.get('path', ''),
-                    all_scopes=True,
-                    environment=self.environment),
-                request['id'])
+        Returns:
+            Tuple with the kind of results, the name of the module and the
+            attribute (or the prefix of it being completed), None for any
+            other lookup.
+        """
+        line, column = script._pos
+        line_string = script._code_lines[line - 1]
+        if lookup == 'tooltip':
+            column += len(re.match(r'\w*', line_string[column:]).group(0))
+        text = line_string[:column]
+        if '#' in text or text.count('"') % 2 or text.count("'") % 2:
+            return None
+        match = self._from_import_pattern.match(text)
+        if match is not None:
+            if lookup != 'completions':
+                return None
+            return 'import_names', match.group(1), match.group(2)
+        match = self._attribute_pattern.search(text)
+        if match is None:
+            return None
+        name, attribute = match.groups()
+        if lookup == 'tooltip' and not attribute:
+            return None
+        module = _module_bound_by_import(script._module_node, name)
+        if module is None:
+            return None
+        if lookup == 'tooltip':
+            return 'tooltip', module, attribute
+        return 'attributes', module, attribute
+
+    def _index_results(self, kind, module, name):
+        """Run a lookup for an attribute of a module outside of any file."""
+        if kind == 'import_names':
+            source = 'from %s import ' % module
+        elif kind == 'attributes':
+            source = 'import %s\n%s.' % (module, module)
+        else:
+            source = 'import %s\n%s.%s' % (module, module, name)
+        lines = source.split('\n')
+        column = len(module) + 1 if kind == 'tooltip' else len(lines[-1])
+        with parser_cache_guard.parsing(None, allow_in_place=False):
+            script = jedi.Script(
+                source=source, line=len(lines), column=column, path=None,
+                sys_path=self.default_sys_path, environment=self.environment)
+        if kind == 'tooltip':
+            return self._get_tooltips(
+                request_metrics.timed('inference', script.goto_definitions))
+        results = []
+        # Completions are indexed with their details, so they can be
+        # resolved without a script.
+        for completion in request_metrics.timed('inference', script.completions):
+            try:
+                results.append(self._resolved_completion(completion))
+            except Exception:
+                continue
+        return results
 
-        script = jedi.Script(
-            source=request.get('source', None), line=request['line'] + 1,
-            column=request['column'], path=request.get('path', ''),
-            sys_path=sys.path, environment=self.environment)
+    def _lookup_index(self, script, lookup, sys_path):
+        """Answer a lookup from the index of installed modules.
 
+        Returns:
+            List of results, None if the lookup has to be run on the script.
+        """
+        try:
+            context = self._index_context(script, lookup)
+        except Exception:
+            # Jedi or parso version without the attributes used, or a tree
+            # parso can't make sense of, the lookup is run on the script.
+            return None
+        if context is None:
+            return None
+        kind, module, name = context
+        search_path = sys_path
+        if script.path:
+            search_path = [os.path.dirname(script.path)] + sys_path
+        index = self._config.context.index
+        location = index.find_installed(module, search_path)
+        if location is None:
+            return None
+        key = kind if kind != 'tooltip' else 'tooltip:' + name
+        results = index.get(module, location, key)
+        if results is None:
+            try:
+                results = self._index_results(kind, module, name)
+            except Exception:
+                sys.stderr.write(traceback.format_exc() + '\n')
+                sys.stderr.flush()
+                return None
+            index.put(module, location, key, results)
+        if kind == 'tooltip':
+            return results
+        if self._config.case_insensitive:
+            name = name.lower()
+            return [r for r in results if r['text'].lower().startswith(name)]
+        return [r for r in results if r['text'].startswith(name)]
+
+    def _process_lookup(self, script, lookup, request, sys_path):
+        """Run a lookup on the script for the request position.
+
+        Returns:
+            List of results to send to VSCode.
+        """
+        context = self._config.context
+        if context.index is not None and lookup in ('completions', 'tooltip') \
+                and not (jediPreview and lookup == 'tooltip'):
+            results = self._lookup_index(script, lookup, sys_path)
+            if results is not None and lookup == 'completions':
+                return self._indexed_completions(script, results, request)
+            if results is not None:
+                return results
         if lookup == 'definitions':
-            defs = self._get_definitionsx(script.goto_assignments(follow_imports=True), request['id'])
-            return json.dumps({'id': request['id'], 'results': defs})
+            definitions = request_metrics.timed(
+                'inference', script.goto_assignments, follow_imports=True)
+            return self._get_definitionsx(definitions, request['id'])
         if lookup == 'tooltip':
             if jediPreview:
                 defs = []
                 try:
-                    defs = self._get_definitionsx(script.goto_definitions(), request['id'], True)
+                    defs = self._get_definitionsx(request_metrics.timed(
+                        'inference', script.goto_definitions), request['id'], True)
                 except:
                     pass
                 try:
                     if len(defs) == 0:
-                        defs = self._get_definitionsx(script.goto_assignments(), request['id'], True)
+                        defs = self._get_definitionsx(request_metrics.timed(
+                            'inference', script.goto_assignments), request['id'], True)
                 except:
                     pass
-                return json.dumps({'id': request['id'], 'results': defs})
+                return defs
             else:
                 try:
-                    return self._serialize_tooltip(script.goto_definitions(), request['id'])
+                    return self._get_tooltips(request_metrics.timed(
+                        'inference', script.goto_definitions))
                 except:
-                    return json.dumps({'id': request['id'], 'results': []})
+                    return []
         elif lookup == 'arguments':
-            return self._serialize_arguments(
-                script, request['id'])
+            return self._serialize_arguments(script)
         elif lookup == 'usages':
-            return self._serialize_usages(
-                script.usages(), request['id'])
+            references = self._config.context.references
+            if references is None:
+                return self._serialize_usages(
+                    request_metrics.timed('inference', script.usages))
+            with self._usage_search.narrowed(references):
+                return self._serialize_usages(
+                    request_metrics.timed('inference', script.usages))
         elif lookup == 'methods':
-          return self._serialize_methods(script, request['id'],
-                                      request.get('prefix', ''))
+          return self._serialize_methods(script)
         else:
-            return self._serialize_completions(script, request['id'],
-                                            request.get('prefix', ''))
+            # Completions can only be resolved later on a cached script.
+            resolvable = None
+            if request.get('lazy') and context.scripts.holds(script):
+                resolvable = {}
+            completions = self._serialize_completions(
+                script, request.get('prefix', ''),
+                rank=bool(request.get('maxResults')), resolvable=resolvable)
+            results = self._limit_results(completions, request)
+            if resolvable is not None:
+                with context.resolvable_lock:
+                    context.resolvable = (request['id'], script, resolvable,
+                                        time.time())
+            return results
+
+    def _indexed_completions(self, script, results, request):
+        """Send completions found in the index like the ones run on the script.
+
+        Indexed completions come with the details sent when they are
+        resolved, those are left out of the results and kept for `resolve`
+        requests when the request is lazy.
+        """
+        if request.get('maxResults'):
+            results = _ranked(results, _word_before(script), lambda r: r['text'])
+        details = ['docstring', 'signature']
+        if request.get('lazy'):
+            details.append('rightLabel')
+            context = self._config.context
+            with context.resolvable_lock:
+                context.resolvable = (
+                    request['id'], None, dict((r['text'], r) for r in results),
+                    time.time())
+        return self._limit_results(
+            (dict((key, value) for key, value in result.items()
+                  if key not in details) for result in results), request)
+
+    def _limit_results(self, results, request):
+        """Take the results to send for a request with `maxResults`.
+
+        With `stream` set, the best results are sent straight away in a
+        response marked as `incomplete`, so large namespaces show up without
+        waiting for all of them to be serialized. The final response has all
+        the results, best first, so clients can ignore the incomplete one.
+        Requests cancelled or superseded meanwhile get no incomplete response.
+        Otherwise only the best results are sent.
 
-    def _write_response(self, response):
-        sys.stdout.write(response + '\n')
-        sys.stdout.flush()
+        Args:
+            results: Iterator over the results, best first.
+            request: Request being handled.
 
-    def watch(self):
+        Returns:
+            List of the results for the final response.
+        """
+        max_results = request.get('maxResults')
+        if not max_results:
+            return list(results)
+        top = list(itertools.islice(results, max_results))
+        if not request.get('stream') or 'lookups' in request:
+            return top
+        if self._requests.cancelled(request):
+            return top + list(results)
+        self._write_response(_dumps(
+            {'id': request['id'], 'results': top, 'incomplete': True}))
+        return top + list(results)
+
+    def _handle_request(self, request):
+        try:
+            with parser_cache_guard.lookup():
+                with request_metrics.request(request) as metrics:
+                    response = self._process_request(request)
+                    # Metrics sent along are only complete once the request
+                    # is, so they leave out encoding the response they are in.
+                    in_response = metrics is not None and request_metrics.in_response
+                    if not in_response:
+                        with request_metrics.phase('encode'):
+                            response = _dumps(response)
+            if in_response:
+                response['metrics'] = metrics
+                response = _dumps(response)
+            if self._requests.done(request):
+                response = self._serialize_cancelled(request['id'])
+            self._write_response(response)
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc() + '\n')
+            sys.stderr.flush()
+            # VSCode waits for a response to every request.
+            response = self._serialize_error(request['id'], str(e))
+            if self._requests.done(request):
+                response = self._serialize_cancelled(request['id'])
+            self._write_response(response)
+
+    def _serve(self):
+        """Worker loop, handles queued requests."""
         while True:
+            self._handle_request(self._requests.get())
+
+    def _start_workers(self):
+        for _ in range(self._worker_count):
+            worker = threading.Thread(target=self._serve)
+            worker.daemon = True
+            worker.start()
+
+    def watch(self):
+        """Read requests from stdin and hand them to the worker threads.
+
+        Reading continues while lookups are running, so a slow lookup (such
+        as usages) does not hold up the ones sent after it. Responses carry
+        the request id and may be written out of order.
+        """
+        self._start_workers()
+        self._preloader.start(self._requests, self._write_response)
+        self._read_requests()
+
+
+class WorkerProcess(object):
+    """Completion server process the supervisor hands requests to.
+
+    A worker runs one request at a time, so a stuck request can be ended by
+    killing its worker without taking other requests with it.
+    """
+
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.created = time.time()
+        self.served = 0
+        self.request = None
+        self.started = None
+        # Path of the last request, its script is likely to be cached.
+        self.path = None
+        self.alive = True
+
+    def send(self, request):
+        self.served += 1
+        self.request = request
+        self.started = time.time()
+        self.path = request.get('path')
+        self.process.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+
+    def kill(self):
+        self.alive = False
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+
+class Supervisor(RequestDispatcher):
+    """Hands requests out to worker processes, with crash isolation.
+
+    A lookup that runs away (deep recursion, huge generated modules) only
+    takes down its own worker: requests running longer than `timeout` get
+    their worker killed and an error response, and workers that die are
+    replaced, with `spares` started workers kept ready to take over. The
+    responses of the workers keep the original request ids.
+
+    Requests for a path go to the worker that handled the last request for
+    it when it is idle, and completions sent with only their name and kind
+    are resolved by the worker that sent them. A resolve waits for that
+    worker to be done without holding up the requests queued after it.
+
+    Args:
+        command: Command line starting a worker.
+        processes: Number of workers handling requests.
+        spares: Number of workers kept ready to replace dead ones.
+        timeout: Seconds a request may run, None for no limit.
+        supersede: Drop queued requests superseded by newer ones.
+        profile: ImportProfile recording the imports of the files.
+    """
+    # Number of lazy completion result sets to remember the worker of.
+    max_resolvers = 32
+    # Workers failing to start are not replaced after this many failures,
+    # instead of being restarted over and over.
+    max_startup_failures = 3
+
+    def __init__(self, command, processes=2, spares=1, timeout=10.0,
+                 supersede=False, profile=None):
+        super(Supervisor, self).__init__(supersede, profile)
+        self._command = command
+        self._spare_count = spares
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._startup_failures = 0
+        self._workers = [self._start_worker() for _ in range(max(1, processes))]
+        self._spares = [self._start_worker() for _ in range(spares)]
+        # Completion request id -> worker holding its lazy result set.
+        self._resolvers = collections.OrderedDict()
+        # (worker, request) for the resolve requests waiting for a worker.
+        self._parked = []
+
+    def _start_worker(self):
+        worker = WorkerProcess(self._command)
+        thread = threading.Thread(target=self._read_worker, args=(worker,))
+        thread.daemon = True
+        thread.start()
+        return worker
+
+    def _replace(self, worker):
+        """Replace a dead worker by a spare, and start a new spare."""
+        worker.kill()
+        if not worker.served and time.time() - worker.created < 10:
+            self._startup_failures += 1
+        if self._startup_failures >= self.max_startup_failures:
+            for workers in (self._workers, self._spares):
+                if worker in workers:
+                    workers.remove(worker)
+            self._condition.notify_all()
+            return
+        if worker in self._spares:
+            self._spares.remove(worker)
+        if worker in self._workers:
+            self._workers.remove(worker)
+            if self._spares:
+                self._workers.append(self._spares.pop(0))
+            else:
+                self._workers.append(self._start_worker())
+        while len(self._spares) < self._spare_count:
+            self._spares.append(self._start_worker())
+        self._condition.notify_all()
+
+    def _fail(self, worker, message):
+        """End the request of a worker with an error, under the lock."""
+        request = worker.request
+        worker.request = None
+        self._replace(worker)
+        if request is not None:
+            cancelled = self._requests.done(request)
+            self._write_response(self._serialize_cancelled(request['id'])
+                                 if cancelled else
+                                 self._serialize_error(request['id'], message))
+        for parked in [p for p in self._parked if p[0] is worker]:
+            # The completions to resolve are gone with the worker.
+            self._parked.remove(parked)
+            request = parked[1]
+            cancelled = self._requests.done(request)
+            self._write_response(self._serialize_cancelled(request['id'])
+                                 if cancelled else
+                                 _dumps({'id': request['id'], 'results': []}))
+
+    def _read_worker(self, worker):
+        """Forward the responses of a worker."""
+        for line in iter(worker.process.stdout.readline, b''):
             try:
-                rq = self._input.readline()
-                if len(rq) == 0:
-                    # Reached EOF - indication our parent process is gone.
-                    sys.stderr.write('Received EOF from the standard input,exiting' + '\n')
-                    sys.stderr.flush()
-                    return
-                with RedirectStdout():
-                    response = self._process_request(rq)
-                self._write_response(response)
+                response = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            with self._condition:
+                request = worker.request
+                if request is None or response.get('id') != request['id']:
+                    # Preload progress, or a request ended by a timeout.
+                    continue
+                final = not response.get('incomplete')
+                if final:
+                    worker.request = None
+                    for parked in self._parked:
+                        if parked[0] is worker:
+                            self._parked.remove(parked)
+                            self._send(worker, parked[1])
+                            break
+                    self._condition.notify_all()
+            if final and self._requests.done(request):
+                self._write_response(self._serialize_cancelled(request['id']))
+            else:
+                # Forwarded as read, without decoding it again.
+                self._write_response(line.rstrip(b'\n'))
+        with self._condition:
+            if worker.alive:
+                self._fail(worker, 'Worker process exited')
+
+    def _idle_worker(self, request):
+        """Wait for a worker to hand the request to, under the lock."""
+        while True:
+            if not self._workers:
+                return None
+            idle = [w for w in self._workers if w.request is None]
+            for worker in idle:
+                if worker.path == request.get('path'):
+                    return worker
+            if idle:
+                return idle[0]
+            self._condition.wait()
+
+    def _send(self, worker, request):
+        """Hand a request to a worker, under the lock."""
+        try:
+            worker.send(request)
+        except (IOError, OSError):
+            self._fail(worker, 'Worker process exited')
+            return
+        if request.get('lazy'):
+            self._resolvers[request['id']] = worker
+            while len(self._resolvers) > self.max_resolvers:
+                self._resolvers.popitem(last=False)
+
+    def _serve(self):
+        """Hand the queued requests out to the workers."""
+        while True:
+            request = self._requests.get()
+            with self._condition:
+                target = None
+                if request.get('lookup') == 'resolve':
+                    target = self._resolvers.get(request.get('completionId'))
+                if target is not None and target in self._workers:
+                    if target.request is None:
+                        self._send(target, request)
+                    else:
+                        # Handed to the worker once it is done, the other
+                        # workers go on with the requests queued after it.
+                        self._parked.append((target, request))
+                    continue
+                worker = self._idle_worker(request)
+                if worker is None:
+                    self._requests.done(request)
+                    self._write_response(self._serialize_error(
+                        request['id'], 'No worker processes are running'))
+                    continue
+                self._send(worker, request)
 
-            except Exception:
-                sys.stderr.write(traceback.format_exc() + '\n')
-                sys.stderr.flush()
+    def _watch_timeouts(self):
+        while True:
+            time.sleep(min(self.timeout / 4.0, 0.5))
+            now = time.time()
+            with self._condition:
+                for worker in list(self._workers):
+                    if worker.request is not None and \
+                            now - worker.started > self.timeout:
+                        self._fail(worker, 'Timed out after %s seconds' % self.timeout)
+
+    def watch(self):
+        """Read requests from stdin and hand them to the workers."""
+        for target in (self._serve, self._watch_timeouts):
+            if target == self._watch_timeouts and not self.timeout:
+                continue
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        try:
+            self._read_requests()
+        finally:
+            with self._condition:
+                for worker in self._workers + self._spares:
+                    worker.alive = False
+                    worker.process.stdin.close()
+
+
+class _RequestSettings(object):
+    """jedi.settings, with the settings that differ between requests kept
+    for each thread."""
+
+    def __init__(self, settings):
+        self._settings = settings
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        try:
+            return getattr(self._local, name)
+        except AttributeError:
+            return getattr(self._settings, name)
+
+    def set(self, name, value):
+        setattr(self._local, name, value)
+
+
+def _isolate_request_settings():
+    """Give each worker thread its own completion settings.
+
+    Jedi reads `case_insensitive_completion` from the global settings while
+    completing, which requests for other roots change concurrently.
+
+    Returns:
+        _RequestSettings used by Jedi's completion, None if this version of
+        Jedi could not be patched and the global settings have to be used.
+    """
+    try:
+        from jedi.api import completion as jedi_completion
+    except ImportError:
+        return None
+    if not hasattr(jedi_completion, 'settings'):
+        return None
+    if not isinstance(jedi_completion.settings, _RequestSettings):
+        jedi_completion.settings = _RequestSettings(jedi_completion.settings)
+    return jedi_completion.settings
+
+
+class _UsageSearch(object):
+    """Jedi's search for the modules containing a name, narrowed down by a
+    ReferenceIndex for the threads looking up usages."""
+
+    def __init__(self, imports):
+        self._imports = imports
+        self._search = imports.get_modules_containing_name
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def narrowed(self, references):
+        """Use a ReferenceIndex for the searches of this thread."""
+        self._local.references = references
+        try:
+            yield
+        finally:
+            self._local.references = None
+
+    def __call__(self, evaluator, modules, name):
+        references = getattr(self._local, 'references', None)
+        candidates = None
+        if references is not None and \
+                self._imports.settings.dynamic_params_for_other_modules:
+            candidates = references.candidates(name)
+        if candidates is None:
+            return self._search(evaluator, modules, name)
+        request_metrics.note('referenceCandidates', len(candidates))
+        return self._narrowed(evaluator, modules, name, references, candidates)
+
+    def _narrowed(self, evaluator, modules, name, references, candidates):
+        searched = set()
+        outside = []
+        for module in modules:
+            try:
+                path = module.py__file__()
+            except AttributeError:
+                path = None
+            if path is not None:
+                searched.add(os.path.normcase(os.path.abspath(path)))
+                if path not in references:
+                    outside.append(module)
+            yield module
+        # Directories outside the root are searched the way Jedi does.
+        for module in self._search(evaluator, outside, name):
+            if module not in outside:
+                try:
+                    searched.add(os.path.normcase(module.py__file__()))
+                except (AttributeError, TypeError):
+                    pass
+                yield module
+        for path in sorted(candidates - searched):
+            module = self._load(evaluator, path)
+            if module is not None and \
+                    not isinstance(module, self._imports.compiled.CompiledObject):
+                yield module
+
+    def _load(self, evaluator, path):
+        try:
+            with open(path, 'rb') as source_file:
+                code = self._imports.python_bytes_to_unicode(
+                    source_file.read(), errors='replace')
+        except (IOError, OSError):
+            return None
+        sys_path = evaluator.get_sys_path()
+        return self._imports._load_module(
+            evaluator, path, code, sys_path=sys_path,
+            module_name=self._imports.sys_path.dotted_path_in_sys_path(sys_path, path))
+
+
+def _narrow_usage_search():
+    """Let usages be narrowed down by a ReferenceIndex.
+
+    Returns:
+        _UsageSearch patched into Jedi, None if this version of Jedi could
+        not be patched.
+    """
+    try:
+        from jedi.evaluate import imports
+    except ImportError:
+        return None
+    if not all(hasattr(imports, name) for name in (
+            'get_modules_containing_name', '_load_module', 'settings',
+            'sys_path', 'compiled', 'python_bytes_to_unicode')):
+        return None
+    if not isinstance(imports.get_modules_containing_name, _UsageSearch):
+        imports.get_modules_containing_name = _UsageSearch(imports)
+    return imports.get_modules_containing_name
+
+
+def _serialize_subprocess_access():
+    """Make Jedi's compiled subprocess safe to share between threads.
+
+    Jedi talks to the subprocess that inspects compiled modules over a single
+    pipe without any locking, so concurrent lookups corrupt each other's
+    messages. Each round trip is serialized, the rest of the inference still
+    runs concurrently.
+    """
+    try:
+        from jedi.evaluate.compiled.subprocess import _CompiledSubprocess
+    except ImportError:
+        # Other versions of Jedi, run one lookup at a time.
+        return False
+    send = _CompiledSubprocess._send
+    lock = threading.RLock()
+
+    def _send(self, *args, **kwargs):
+        with lock:
+            return send(self, *args, **kwargs)
+    _CompiledSubprocess._send = _send
+    return True
+
+
+def _parse_arguments(argv):
+    """Split the `--name=value` options from the positional arguments."""
+    options = {}
+    arguments = []
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value
+        else:
+            arguments.append(arg)
+    return options, arguments
 
 if __name__ == '__main__':
     cachePrefix = 'v'
     modulesToLoad = ''
-    if len(sys.argv) > 2 and sys.argv[1] == 'custom':
-        jediPath = sys.argv[2]
+    # Options are passed as --name=value, e.g. --workers=4 or --supersede.
+    options, args = _parse_arguments(sys.argv[1:])
+    if len(args) > 1 and args[0] == 'custom':
+        jediPath = args[1]
         jediPreview = True
         cachePrefix = 'custom_v'
-        if len(sys.argv) > 3:
-            modulesToLoad = sys.argv[3]
+        if len(args) > 2:
+            modulesToLoad = args[2]
     else:
         #release
         jediPath = os.path.join(os.path.dirname(__file__), 'lib', 'python')
-        if len(sys.argv) > 1:
-            modulesToLoad = sys.argv[1]
+        if len(args) > 0:
+            modulesToLoad = args[0]
+
+    if options.get('processes'):
+        # Supervisor mode, lookups run in worker processes started with the
+        # same arguments. The supervisor keeps the import profile and passes
+        # the modules to preload on to the workers.
+        profile = ImportProfile(options.get('preload-profile'))
+        modules = [m for m in modulesToLoad.split(',') if m]
+        for module in profile.most_imported(int(options.get('preload-count', 10))):
+            if module not in modules:
+                modules.append(module)
+        supervisor_options = ('processes', 'spares', 'timeout', 'supersede',
+                              'workers', 'preload-profile', 'preload-count',
+                              'record')
+        command = [sys.executable, os.path.abspath(__file__), '--workers=1']
+        command.extend('--%s=%s' % item for item in sorted(options.items())
+                       if item[0] not in supervisor_options)
+        if jediPreview:
+            command.extend(['custom', jediPath])
+        command.append(','.join(modules))
+        timeout = float(options.get('timeout', 10))
+        supervisor = Supervisor(command, processes=int(options['processes']),
+                                spares=int(options.get('spares', 1)),
+                                timeout=timeout if timeout > 0 else None,
+                                supersede='supersede' in options, profile=profile)
+        if options.get('record'):
+            supervisor.recorder = RequestRecorder(options['record'])
+        supervisor.watch()
+        sys.exit(0)
 
     sys.path.insert(0, jediPath)
     import jedi
@@ -648,6 +3014,44 @@ if __name__ == '__main__':
             jedi.settings.cache_directory, cachePrefix + jedi.__version__.replace('.', ''))
     # remove jedi from path after we import it so it will not be completed
     sys.path.pop(0)
-    if len(modulesToLoad) > 0:
-        jedi.preload_module(*modulesToLoad.split(','))
-    JediCompletion().watch()
+    # Modules are preloaded in the background, along with the ones imported
+    # most often according to the import profile of the workspace.
+    preloader = ModulePreloader(
+        modules=[m for m in modulesToLoad.split(',') if m],
+        profile=ImportProfile(options.get('preload-profile')),
+        count=int(options.get('preload-count', 10)))
+    # Requests are handled one at a time, unless --workers asks for more.
+    workers = int(options.get('workers', 1))
+    if not _serialize_subprocess_access():
+        workers = 1
+    # Results for installed modules are kept on disk when an index directory
+    # is given.
+    index = None
+    if options.get('index-dir'):
+        index = CompletionIndex(options['index-dir'], sys.path)
+    # Usages are looked up in the modules referring to the name, according
+    # to an index of each root kept in the given directory.
+    reference_dir = None
+    if 'reference-index' in options:
+        reference_dir = options['reference-index'] or os.path.join(
+            jedi.settings.cache_directory, 'references')
+    # Timings and statistics of each request go in the response or to a
+    # log file, profiles of the slowest requests to a directory.
+    if 'metrics' in options or options.get('profile-dir'):
+        destination = options.get('metrics')
+        request_metrics.configure(
+            destination if destination != '' else 'response',
+            options.get('profile-dir'), int(options.get('profile-slowest', 10)))
+    # Each workspace root gets its own script cache.
+    server = JediCompletion(
+        workers=workers, supersede='supersede' in options,
+        script_cache_entries=int(options.get('script-cache', 8)),
+        script_cache_bytes=int(options.get('script-cache-bytes', 8 * 1024 * 1024)),
+        preloader=preloader, index=index,
+        max_workspaces=int(options.get('workspaces', 4)),
+        workspace_bytes=int(options.get('workspace-bytes', 32 * 1024 * 1024)),
+        reference_dir=reference_dir)
+    # The requests read are saved to a file for the replay benchmark.
+    if options.get('record'):
+        server.recorder = RequestRecorder(options['record'])
+    server.watch()
@@ -1,77 +1,148 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-import ast
+import collections
 import io
-import operator
+import json
 import os
 import sys
 import token
 import tokenize
 
 
-class Visitor(ast.NodeVisitor):
-    def __init__(self, lines):
-        self._lines = lines
-        self.line_numbers_with_nodes = set()
-        self.line_numbers_with_statements = []
+def _tokenize(source, lines=None):
+    """Tokenize Python source code.
 
-    def generic_visit(self, node):
-        if hasattr(node, 'col_offset') and hasattr(node, 'lineno') and node.col_offset == 0:
-            self.line_numbers_with_nodes.add(node.lineno)
-            if isinstance(node, ast.stmt):
-                self.line_numbers_with_statements.append(node.lineno)
-
-        ast.NodeVisitor.generic_visit(self, node)
-
-
-def _tokenize(source):
-    """Tokenize Python source code."""
+    The lines read by the tokenizer are appended to `lines`, if given.
+    """
     # Using an undocumented API as the documented one in Python 2.7 does not work as needed
     # cross-version.
     if sys.version_info < (3,) and isinstance(source, str):
         source = source.decode()
-    return tokenize.generate_tokens(io.StringIO(source).readline)
+    readline = io.StringIO(source).readline
+    if lines is not None:
+        def readline(readline=readline):
+            line = readline()
+            if line:
+                lines.append(line)
+            return line
+    return tokenize.generate_tokens(readline)
+
 
+# Clauses of compound statements, starting lines at the same indentation
+# as their statement.
+_CLAUSES = ('elif', 'else', 'except', 'finally')
+_NON_LOGICAL_TOKENS = (tokenize.NL, tokenize.COMMENT, token.INDENT, token.DEDENT)
 
-def _indent_size(line):
-    for index, char in enumerate(line):
-        if not char.isspace():
-            return index
 
+def _strip_newline(line):
+    if line.endswith('\n'):
+        line = line[:-1]
+    if line.endswith('\r'):
+        line = line[:-1]
+    return line
 
-def _get_global_statement_blocks(source, lines):
-    """Return a list of all global statement blocks.
 
-    The list comprises of 3-item tuples that contain the starting line number,
-    ending line number and whether the statement is a single line.
+def _normalized_lines(source):
+    """Generate the normalized code, see `normalize`.
 
+    The source is tokenized once. Lines are kept until the global statement
+    they belong to ends, to know whether it is a single line, and are then
+    generated.
     """
-    tree = ast.parse(source)
-    visitor = Visitor(lines)
-    visitor.visit(tree)
-
-    statement_ranges = []
-    for index, line_number in enumerate(visitor.line_numbers_with_statements):
-        remaining_line_numbers = visitor.line_numbers_with_statements[index+1:]
-        end_line_number = len(lines) if len(remaining_line_numbers) == 0 else min(remaining_line_numbers) - 1
-        current_statement_is_oneline = line_number == end_line_number
-
-        if len(statement_ranges) == 0:
-            statement_ranges.append((line_number, end_line_number, current_statement_is_oneline))
+    # Lines read by the tokenizer, from line number `line_number`, that have
+    # not been handled yet.
+    lines = collections.deque()
+    line_number = 1
+    # Lines of the current global statement, or of the ones before the
+    # first one, minus the blank ones.
+    statement = []
+    in_statement = False
+    previous_statement_is_oneline = False
+    separator = ''
+    last_lines = [None, None]
+
+    def read_until(end_line_number):
+        # Keep the lines up to end_line_number in the current statement.
+        count = end_line_number - line_number + 1
+        for _ in range(count):
+            line = lines.popleft()
+            last_lines[:] = last_lines[1], line
+            statement.append(_strip_newline(line))
+        return line_number + count
+
+    tokens = _tokenize(source, lines)
+    logical_line_start = True
+    after_decorator = False
+    for (toknum, tokval, spos, epos, line) in tokens:
+        if toknum == tokenize.NL and spos[0] == epos[0] and len(line.strip()) == 0:
+            # Step 1: Remove empty lines.
+            line_number = read_until(spos[0] - 1)
+            last_lines[:] = last_lines[1], lines.popleft()
+            line_number += 1
+            continue
+        if toknum in _NON_LOGICAL_TOKENS or toknum == token.ENDMARKER:
+            continue
+        if toknum == token.NEWLINE:
+            logical_line_start = True
+            continue
+        if not logical_line_start:
+            continue
+        logical_line_start = False
+        if spos[1] != 0:
             continue
+        # Step 2: Add blank lines between each global statement block.
+        # A consequtive single lines blocks of code will be treated as a single statement,
+        # just to ensure we do not unnecessarily add too many blank lines.
+        # Decorators start the statement they decorate.
+        starts_statement = not after_decorator \
+            and not (toknum == token.NAME and tokval in _CLAUSES)
+        after_decorator = toknum == token.OP and tokval == '@'
+        if not starts_statement:
+            continue
+        line_number = read_until(spos[0] - 1)
+        for output in _statement_lines(statement, separator,
+                                       previous_statement_is_oneline):
+            yield output
+        if statement:
+            separator = '\n'
+        if in_statement:
+            previous_statement_is_oneline = len(statement) == 1
+        statement = []
+        in_statement = True
+
+    read_until(line_number + len(lines) - 1)
+    for output in _statement_lines(statement, separator,
+                                   previous_statement_is_oneline):
+        yield output
 
-        previous_statement = statement_ranges[-1]
-        previous_statement_is_oneline = previous_statement[2]
-        if previous_statement_is_oneline and current_statement_is_oneline:
-            statement_ranges[-1] = previous_statement[0], end_line_number, True
-        else:
-            statement_ranges.append((line_number, end_line_number, current_statement_is_oneline))
+    # If we have two blank lines, then add two blank lines.
+    # Do not trim the spaces, if we have blank lines with spaces, its possible
+    # we have indented code.
+    if last_lines[-1] is None:
+        return
+    last_lines = [_strip_newline(line) for line in last_lines if line is not None]
+    if (len(last_lines) > 1 and len(''.join(last_lines)) == 0) \
+        or source.endswith(('\n\n', '\r\n\r\n')):
+        yield '\n' * 2
+    # Find out if we have any trailing blank lines
+    elif len(last_lines[-1].strip()) == 0 or source.endswith(('\n', '\r\n')):
+        yield '\n'
 
-    return statement_ranges
 
+def _statement_lines(statement, separator, previous_statement_is_oneline):
+    """Generate the lines of a global statement, after a blank line unless
+    it is the first one or it and the previous one are single lines."""
+    if not statement:
+        return
+    if separator and not (previous_statement_is_oneline and len(statement) == 1):
+        yield separator
+    for line in statement:
+        yield separator + line
+        separator = '\n'
 
-def normalize_lines(source):
+
+def normalize(source):
     """Normalize blank lines for sending to the terminal.
 
     Blank lines within a statement block are removed to prevent the REPL
@@ -80,47 +151,57 @@ def normalize_lines(source):
     error.
 
     """
-    lines = source.splitlines(False)
-    # If we have two blank lines, then add two blank lines.
-    # Do not trim the spaces, if we have blank lines with spaces, its possible
-    # we have indented code.
-    if (len(lines) > 1 and len(''.join(lines[-2:])) == 0) \
-        or source.endswith(('\n\n', '\r\n\r\n')):
-        trailing_newline = '\n' * 2
-    # Find out if we have any trailing blank lines
-    elif len(lines[-1].strip()) == 0 or source.endswith(('\n', '\r\n')):
-        trailing_newline = '\n'
-    else:
-        trailing_newline = ''
-
-    # Step 1: Remove empty lines.
-    tokens = _tokenize(source)
-    newlines_indexes_to_remove = (spos[0] for (toknum, tokval, spos, epos, line) in tokens
-                                  if len(line.strip()) == 0
-                                     and token.tok_name[toknum] == 'NL'
-                                     and spos[0] == epos[0])
-
-    for line_number in reversed(list(newlines_indexes_to_remove)):
-        del lines[line_number-1]
-
-    # Step 2: Add blank lines between each global statement block.
-    # A consequtive single lines blocks of code will be treated as a single statement,
-    # just to ensure we do not unnecessarily add too many blank lines.
-    source = '\n'.join(lines)
-    tokens = _tokenize(source)
-    dedent_indexes = (spos[0] for (toknum, tokval, spos, epos, line) in tokens
-                                if toknum == token.DEDENT and _indent_size(line) == 0)
-
-    global_statement_ranges = _get_global_statement_blocks(source, lines)
-    start_positions = map(operator.itemgetter(0), reversed(global_statement_ranges))
-    for line_number in filter(lambda x: x > 1, start_positions):
-        lines.insert(line_number-1, '')
-
-    sys.stdout.write('\n'.join(lines) + trailing_newline)
+    return ''.join(_normalized_lines(source))
+
+
+def normalize_lines(source):
+    """Write the normalized source to stdout, as it is normalized."""
+    for line in _normalized_lines(source):
+        sys.stdout.write(line)
     sys.stdout.flush()
 
 
+def handle_request(request):
+    """Normalize the `code` of a request.
+
+    Responses have the `id` of the request and the `normalized` code, or an
+    `error` when it cannot be parsed.
+    """
+    response = {"id": request.get("id")}
+    try:
+        response["normalized"] = normalize(request["code"])
+    except Exception as ex:
+        response["error"] = "{0}: {1}".format(type(ex).__name__, ex)
+    return response
+
+
+def serve(input=None, output=None):
+    """Normalize code sent as requests, one JSON object per line, until the
+    input is closed.
+
+    The process is kept for all the selections run in the terminal, and the
+    code is sent in the requests instead of as an argument, which is limited
+    in size by the OS.
+    """
+    if input is None:
+        input = io.open(sys.stdin.fileno(), encoding='utf-8')
+    if output is None:
+        output = sys.stdout
+    for line in iter(input.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            response = handle_request(json.loads(line))
+        except ValueError as ex:
+            response = {"id": None, "error": "Invalid request: {0}".format(ex)}
+        output.write(json.dumps(response) + "\n")
+        output.flush()
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--server']:
+        serve()
+        sys.exit(0)
     contents = sys.argv[1]
     try:
         default_encoding = sys.getdefaultencoding()
@@ -2,11 +2,14 @@
 # 1. Working directory.
 # 2. Rope folder
 
+import collections
 import difflib
 import io
 import json
 import os
+import signal
 import sys
+import threading
 import traceback
 
 try:
@@ -112,6 +115,10 @@ class BaseRefactoring(object):
     def stop(self):
         self._handle.stop()
 
+    @property
+    def cancelled(self):
+        return self._handle.is_stopped()
+
     def refactor(self):
         try:
             self.onRefactor()
@@ -189,59 +196,118 @@ class ExtractMethodRefactor(ExtractVariableRefactor):
 
 
 class RopeRefactoring(object):
+    # Seconds to wait for the worker to stop before the project is closed
+    # anyway, a refactoring may not notice it was stopped.
+    stop_timeout = 5
 
     def __init__(self):
         self.default_sys_path = sys.path
         self._input = io.open(sys.stdin.fileno(), encoding='utf-8')
+        self._project = None
+        # Whether the client reported the files changed in the workspace
+        # since the last refactoring, otherwise rope looks for changes
+        # before the next one.
+        self._changes_reported = False
+        self._output_lock = threading.Lock()
+        # Requests waiting for the worker, the id of the one it handles and
+        # its refactoring once created. Cancelling a request that is not
+        # running yet drops it, or stops it as soon as it starts.
+        self._requests = collections.deque()
+        self._requests_changed = threading.Condition()
+        self._running = None
+        self._refactoring = None
+        self._stop_running = False
+
+    def _get_project(self, indent_size):
+        """
+        Gets the project of the workspace, kept open across refactorings so
+        that rope analyses each module once
+        """
+        if self._project is None:
+            self._project = rope.base.project.Project(
+                WORKSPACE_ROOT, ropefolder=ROPE_PROJECT_FOLDER, save_history=False)
+        elif not self._changes_reported:
+            self._project.validate()
+        self._changes_reported = False
+        self._project.prefs.set('indent_size', indent_size)
+        return self._project
+
+    def _files_changed(self, changed, created, deleted):
+        """
+        Reports files changed in the workspace to rope
+        """
+        self._changes_reported = True
+        project = self._project
+        if project is None:
+            return
+        notifications = (('resource_changed', changed),
+                         ('resource_created', created),
+                         ('resource_removed', deleted))
+        for notification, paths in notifications:
+            for path in paths:
+                resourceType = 'folder' if os.path.isdir(path) else 'file'
+                resource = libutils.path_to_resource(project, path, resourceType)
+                if resource.project is not project:
+                    continue
+                for observer in list(project.observers):
+                    getattr(observer, notification)(resource)
+
+    def _close(self):
+        """
+        Closes the project, saving rope's object DB
+        """
+        if self._project is not None:
+            self._project.close()
+            self._project = None
 
-    def _rename(self, filePath, start, newName, indent_size):
+    def _rename(self, filePath, start, newName, indent_size, progressCallback=None):
         """
         Renames a variable
         """
-        project = rope.base.project.Project(
-            WORKSPACE_ROOT, ropefolder=ROPE_PROJECT_FOLDER, save_history=False, indent_size=indent_size)
+        project = self._get_project(indent_size)
         resourceToRefactor = libutils.path_to_resource(project, filePath)
         refactor = RenameRefactor(
-            project, resourceToRefactor, startOffset=start, newName=newName)
-        refactor.refactor()
-        changes = refactor.changes
-        project.close()
-        valueToReturn = []
-        for change in changes:
-            valueToReturn.append({'diff': change.diff})
-        return valueToReturn
+            project, resourceToRefactor, progressCallback=progressCallback, startOffset=start, newName=newName)
+        return self._run(refactor)
 
-    def _extractVariable(self, filePath, start, end, newName, indent_size):
+    def _extractVariable(self, filePath, start, end, newName, indent_size, progressCallback=None):
         """
         Extracts a variable
         """
-        project = rope.base.project.Project(
-            WORKSPACE_ROOT, ropefolder=ROPE_PROJECT_FOLDER, save_history=False, indent_size=indent_size)
+        project = self._get_project(indent_size)
         resourceToRefactor = libutils.path_to_resource(project, filePath)
         refactor = ExtractVariableRefactor(
-            project, resourceToRefactor, startOffset=start, endOffset=end, newName=newName, similar=True)
-        refactor.refactor()
-        changes = refactor.changes
-        project.close()
-        valueToReturn = []
-        for change in changes:
-            valueToReturn.append({'diff': change.diff})
-        return valueToReturn
+            project, resourceToRefactor, progressCallback=progressCallback, startOffset=start, endOffset=end, newName=newName, similar=True)
+        return self._run(refactor)
 
-    def _extractMethod(self, filePath, start, end, newName, indent_size):
+    def _extractMethod(self, filePath, start, end, newName, indent_size, progressCallback=None):
         """
         Extracts a method
         """
-        project = rope.base.project.Project(
-            WORKSPACE_ROOT, ropefolder=ROPE_PROJECT_FOLDER, save_history=False, indent_size=indent_size)
+        project = self._get_project(indent_size)
         resourceToRefactor = libutils.path_to_resource(project, filePath)
         refactor = ExtractMethodRefactor(
-            project, resourceToRefactor, startOffset=start, endOffset=end, newName=newName, similar=True)
-        refactor.refactor()
-        changes = refactor.changes
-        project.close()
+            project, resourceToRefactor, progressCallback=progressCallback, startOffset=start, endOffset=end, newName=newName, similar=True)
+        return self._run(refactor)
+
+    def _run(self, refactor):
+        """
+        Runs a refactoring, which `cancel` requests can stop meanwhile.
+        Returns the diffs of its changes, None if it was stopped.
+        """
+        with self._requests_changed:
+            self._refactoring = refactor
+            if self._stop_running:
+                refactor.stop()
+        try:
+            refactor.refactor()
+        finally:
+            with self._requests_changed:
+                self._refactoring = None
+        if refactor.cancelled:
+            return None
         valueToReturn = []
-        for change in changes:
+        for change in refactor.changes:
             valueToReturn.append({'diff': change.diff})
         return valueToReturn
 
@@ -249,8 +315,32 @@ class RopeRefactoring(object):
         """
         Serializes the refactor results
         """
+        if results is None:
+            return self._serialize_cancelled(identifier)
         return json.dumps({'id': identifier, 'results': results})
 
+    def _serialize_cancelled(self, identifier):
+        """
+        Serializes the response of a cancelled refactoring
+        """
+        return json.dumps({'id': identifier, 'results': [], 'cancelled': True})
+
+    def _progress_callback(self, identifier):
+        """
+        Gets a callback writing the progress of a refactoring, when its job
+        set or percent done change
+        """
+        last = []
+
+        def callback(progress):
+            current = [progress.name, progress.percent]
+            if current == last:
+                return
+            last[:] = current
+            self._write_response(json.dumps({'id': identifier, 'progress': {
+                'name': progress.name, 'message': progress.message, 'percent': progress.percent}}))
+        return callback
+
     def _deserialize(self, request):
         """Deserialize request from VSCode.
 
@@ -262,42 +352,129 @@ class RopeRefactoring(object):
         """
         return json.loads(request)
 
-    def _process_request(self, request):
-        """Accept serialized request from VSCode and write response.
+    def _queue_request(self, request):
+        """Accept serialized request from VSCode and queue it for the worker.
+
+        Cancellations are handled straight away: a `cancel` request with the
+        `id` of a refactoring drops it if it has not started, or stops it.
         """
         request = self._deserialize(request)
+        with self._requests_changed:
+            if request.get('lookup', '') != 'cancel':
+                self._requests.append(request)
+                self._requests_changed.notify()
+                return
+            for queued in self._requests:
+                if queued.get('id') == request['id'] and queued.get('lookup') != 'files_changed':
+                    self._requests.remove(queued)
+                    self._write_response(self._serialize_cancelled(request['id']))
+                    return
+            if self._running is not None and self._running == request['id']:
+                self._stop_running = True
+                if self._refactoring is not None:
+                    self._refactoring.stop()
+
+    def _process_request(self, request):
+        """Handle a request from VSCode and write response.
+        """
         lookup = request.get('lookup', '')
+        progressCallback = None
+        if request.get('progress'):
+            progressCallback = self._progress_callback(request.get('id'))
 
         if lookup == '':
             pass
         elif lookup == 'rename':
             changes = self._rename(request['file'], int(
-                request['start']), request['name'], int(request['indent_size']))
+                request['start']), request['name'], int(request['indent_size']), progressCallback)
             return self._write_response(self._serialize(request['id'], changes))
         elif lookup == 'extract_variable':
             changes = self._extractVariable(request['file'], int(
-                request['start']), int(request['end']), request['name'], int(request['indent_size']))
+                request['start']), int(request['end']), request['name'], int(request['indent_size']), progressCallback)
             return self._write_response(self._serialize(request['id'], changes))
         elif lookup == 'extract_method':
             changes = self._extractMethod(request['file'], int(
-                request['start']), int(request['end']), request['name'], int(request['indent_size']))
+                request['start']), int(request['end']), request['name'], int(request['indent_size']), progressCallback)
             return self._write_response(self._serialize(request['id'], changes))
+        elif lookup == 'files_changed':
+            # Notification without a response.
+            self._files_changed(request.get('changed', []), request.get(
+                'created', []), request.get('deleted', []))
 
     def _write_response(self, response):
-        sys.stdout.write(response + '\n')
-        sys.stdout.flush()
+        with self._output_lock:
+            sys.stdout.write(response + '\n')
+            sys.stdout.flush()
+
+    def _write_error(self):
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        tb_info = traceback.extract_tb(exc_tb)
+        jsonMessage = {'error': True, 'message': str(exc_value), 'traceback': str(tb_info), 'type': str(exc_type)}
+        with self._output_lock:
+            sys.stderr.write(json.dumps(jsonMessage))
+            sys.stderr.flush()
+
+    def _work(self):
+        """
+        Handles the queued requests one at a time, rope is not thread safe
+        """
+        while True:
+            with self._requests_changed:
+                while not self._requests:
+                    self._requests_changed.wait()
+                request = self._requests.popleft()
+                if request is None:
+                    return
+                self._running = request.get('id')
+                self._stop_running = False
+            try:
+                self._process_request(request)
+            except Exception:
+                self._write_error()
+            finally:
+                with self._requests_changed:
+                    self._running = None
+
+    def _stop(self, cancel):
+        """
+        Stops the worker once it handled the queued requests, or with
+        `cancel` drops them and stops the running refactoring
+        """
+        with self._requests_changed:
+            if cancel:
+                self._requests.clear()
+                self._stop_running = True
+                if self._refactoring is not None:
+                    self._refactoring.stop()
+            self._requests.append(None)
+            self._requests_changed.notify()
 
     def watch(self):
         self._write_response("STARTED")
-        while True:
+        # Close the project when the extension stops the process.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # Refactorings run in a worker, so that requests are still read and
+        # refactorings can be cancelled while one is running.
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+        cancel = True
+        try:
+            while True:
+                request = self._input.readline()
+                if not request:
+                    cancel = False
+                    break
+                try:
+                    self._queue_request(request)
+                except Exception:
+                    self._write_error()
+        finally:
             try:
-                self._process_request(self._input.readline())
-            except:
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                tb_info = traceback.extract_tb(exc_tb)
-                jsonMessage = {'error': True, 'message': str(exc_value), 'traceback': str(tb_info), 'type': str(exc_type)}
-                sys.stderr.write(json.dumps(jsonMessage))
-                sys.stderr.flush()
+                self._stop(cancel)
+                worker.join(self.stop_timeout)
+            finally:
+                self._close()
 
 if __name__ == '__main__':
     RopeRefactoring().watch()
@@ -1,37 +1,55 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import argparse
 import ast
+import bisect
+import collections
+import glob
+import hashlib
+import io
 import json
+import multiprocessing
+import os
+import re
 import sys
+import tokenize
 
 
 class Visitor(ast.NodeVisitor):
-    def __init__(self):
+    # Fields holding the blocks of compound statements, last block first.
+    block_fields = ('finalbody', 'orelse', 'handlers', 'body')
+
+    def __init__(self, lines=None):
         self.symbols = {"classes": [], "methods": [], "functions": []}
+        # Lines of the source, to turn offsets into characters and to find
+        # the end of nodes on Pythons without end positions.
+        self._lines = lines
+        self._logical_line_ends = None
 
     def visit_Module(self, node):
         self.visitChildren(node)
 
     def visitChildren(self, node, namespace=""):
         for child in node.body:
-            if isinstance(child, ast.FunctionDef):
+            self.visitStatement(child, namespace)
+
+    def visitStatement(self, child, namespace=""):
+        if isinstance(child, ast.FunctionDef):
+            self.visitDef(child, namespace)
+        if isinstance(child, ast.ClassDef):
+            self.visitClassDef(child, namespace)
+        try:
+            if isinstance(child, ast.AsyncFunctionDef):
                 self.visitDef(child, namespace)
-            if isinstance(child, ast.ClassDef):
-                self.visitClassDef(child, namespace)
-            try:
-                if isinstance(child, ast.AsyncFunctionDef):
-                    self.visitDef(child, namespace)
-            except Exception:
-                pass
+        except Exception:
+            pass
 
     def visitDef(self, node, namespace=""):
-        end_position = self.getEndPosition(node)
         symbol = "functions" if namespace == "" else "methods"
         self.symbols[symbol].append(self.getDataObject(node, namespace))
 
     def visitClassDef(self, node, namespace=""):
-        end_position = self.getEndPosition(node)
         self.symbols['classes'].append(self.getDataObject(node, namespace))
 
         if len(namespace) > 0:
@@ -48,7 +66,7 @@ class Visitor(ast.NodeVisitor):
             "range": {
                 "start": {
                     "line": node.lineno - 1,
-                    "character": node.col_offset
+                    "character": self.getCharacter(node.lineno, node.col_offset)
                 },
                 "end": {
                     "line": end_position[0],
@@ -58,9 +76,258 @@ class Visitor(ast.NodeVisitor):
         }
 
     def getEndPosition(self, node):
-        if not hasattr(node, 'body') or len(node.body) == 0:
-            return (node.lineno - 1, node.col_offset)
-        return self.getEndPosition(node.body[-1])
+        """Get the line and character the node ends at."""
+        if getattr(node, 'end_lineno', None) is not None:
+            return (node.end_lineno - 1,
+                    self.getCharacter(node.end_lineno, node.end_col_offset))
+        # The node ends with the logical line of its last simple statement.
+        last = self.getLastStatement(node)
+        end = self.getLogicalLineEnds().get(last.lineno)
+        if end is None:
+            return (last.lineno - 1, last.col_offset)
+        return end
+
+    def getLastStatement(self, node):
+        """Follow the last block of compound statements down to a simple one,
+        else/except/finally blocks included."""
+        while True:
+            for field in self.block_fields:
+                children = getattr(node, field, None)
+                if isinstance(children, list) and children:
+                    node = children[-1]
+                    break
+            else:
+                return node
+
+    def getLogicalLineEnds(self):
+        """Map each line to where the logical line it is part of ends,
+        tokenizing the source once."""
+        if self._logical_line_ends is not None:
+            return self._logical_line_ends
+        ends = self._logical_line_ends = {}
+        if not self._lines:
+            return ends
+        lines = iter(self._lines)
+        skipped = (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT)
+        first = last = None
+        try:
+            for token_type, _, start, end, _ in tokenize.generate_tokens(
+                    lambda: next(lines, '')):
+                if token_type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                    if first is not None:
+                        for line in range(first, last[0] + 1):
+                            ends[line] = (last[0] - 1, last[1])
+                    first = None
+                elif token_type not in skipped:
+                    if first is None:
+                        first = start[0]
+                    last = end
+        except (tokenize.TokenError, IndentationError):
+            pass
+        return ends
+
+    def getCharacter(self, lineno, offset):
+        """Turn an offset in the UTF-8 bytes of a line into a character."""
+        if not self._lines or lineno > len(self._lines):
+            return offset
+        line = self._lines[lineno - 1]
+        if isinstance(line, bytes):
+            return offset
+        encoded = line.encode('utf-8', 'replace')
+        if len(encoded) == len(line):
+            return offset
+        return len(encoded[:offset].decode('utf-8', 'replace'))
+
+
+def get_source_lines(source):
+    """Split source into lines the way Python does, decoding bytes on
+    Python 3."""
+    if isinstance(source, bytes):
+        if str is bytes:
+            return io.BytesIO(source).readlines()
+        try:
+            encoding = tokenize.detect_encoding(io.BytesIO(source).readline)[0]
+            source = source.decode(encoding, 'replace')
+        except (LookupError, SyntaxError):
+            source = source.decode('utf-8', 'replace')
+    return io.StringIO(source, newline='').readlines()
+
+
+def get_symbols(source):
+    """Get the classes, methods and functions defined in provided code."""
+    tree = ast.parse(source)
+    visitor = Visitor(get_source_lines(source))
+    visitor.visit(tree)
+    return visitor.symbols
+
+
+class IncrementalSymbols(object):
+    """Symbols of an open document, kept up to date by parsing only the
+    top-level statements touched by each edit.
+
+    The symbols are kept per top-level statement. An edit re-parses the
+    statements it touches along with the one before, which an edit may
+    merge with, and the symbols of the statements after it are moved. When
+    those statements do not parse on their own, the whole document is
+    parsed again.
+    """
+
+    _line_pattern = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+    def __init__(self, source):
+        self._lines = self._line_pattern.findall(source)
+        # Line each top-level statement starts at, decorators included, and
+        # the symbols defined by it.
+        self._starts = []
+        self._blocks = []
+        # Whether the blocks are out of date, until the document is parsed
+        # and after an edit that did not parse.
+        self._dirty = True
+
+    @property
+    def symbols(self):
+        symbols = {"classes": [], "methods": [], "functions": []}
+        for block in self._blocks:
+            for kind, kind_symbols in block.items():
+                symbols[kind].extend(kind_symbols)
+        return symbols
+
+    def parse(self):
+        """Parse the whole document."""
+        self._starts, self._blocks = self._parse(0, len(self._lines))
+        self._dirty = False
+
+    def _parse(self, start, end):
+        """Parse the lines of a range of top-level statements.
+
+        Returns:
+            Start lines and symbols of the statements.
+
+        Raises:
+            SyntaxError: If the lines do not parse on their own.
+        """
+        lines = self._lines[start:end]
+        tree = ast.parse(''.join(lines))
+        visitor = Visitor(lines)
+        starts = []
+        blocks = []
+        for node in tree.body:
+            decorators = getattr(node, 'decorator_list', None) or [node]
+            starts.append(start + min(n.lineno for n in decorators + [node]) - 1)
+            visitor.symbols = {"classes": [], "methods": [], "functions": []}
+            visitor.visitStatement(node)
+            blocks.append(self._moved(visitor.symbols, start))
+        return starts, blocks
+
+    @staticmethod
+    def _moved(block, lines):
+        if not lines:
+            return block
+        moved = {}
+        for kind, symbols in block.items():
+            moved[kind] = []
+            for symbol in symbols:
+                symbol = dict(symbol)
+                symbol["range"] = {
+                    "start": dict(symbol["range"]["start"],
+                                  line=symbol["range"]["start"]["line"] + lines),
+                    "end": dict(symbol["range"]["end"],
+                                line=symbol["range"]["end"]["line"] + lines)}
+                moved[kind].append(symbol)
+        return moved
+
+    def apply_changes(self, changes):
+        """Apply edits and update the symbols.
+
+        Args:
+            changes: List of edits with the new `text` and the `range` it
+                replaces, given as zero based `line` and `character`
+                positions. Without a range the whole document is replaced.
+
+        Raises:
+            SyntaxError: If the document does not parse.
+        """
+        for change in changes:
+            self._apply_change(change)
+        if self._dirty:
+            self.parse()
+
+    def _line(self, index):
+        return self._lines[index] if index < len(self._lines) else ''
+
+    def _apply_change(self, change):
+        if 'range' not in change:
+            self._lines = self._line_pattern.findall(change['text'])
+            self._dirty = True
+            return
+        start = change['range']['start']
+        end = change['range']['end']
+        first, last = start['line'], min(end['line'], len(self._lines) - 1)
+        text = (self._line(first)[:start['character']] + change['text'] +
+                self._line(end['line'])[end['character']:])
+        lines = self._line_pattern.findall(text)
+        replaced = max(last - first + 1, 0)
+        self._lines[first:first + replaced] = lines
+        if self._dirty:
+            return
+
+        delta = len(lines) - replaced
+        # The line the edit ends at is left as it was when the edit ends at
+        # its start with a line break.
+        touched = end['line']
+        if end['character'] == 0 and touched > first and (
+                change['text'].endswith(('\n', '\r')) or
+                not change['text'] and start['character'] == 0):
+            touched -= 1
+        # The statements from the one before the edit to the last one it
+        # touches are parsed again.
+        before = max(bisect.bisect_right(self._starts, first) - 2, 0)
+        after = bisect.bisect_right(self._starts, max(min(touched, last), first))
+        region_start = self._starts[before] if before < len(self._starts) and \
+            self._starts[before] <= first else 0
+        if region_start == 0:
+            before = 0
+        region_end = self._starts[after] + delta if after < len(self._starts) \
+            else len(self._lines)
+        try:
+            starts, blocks = self._parse(region_start, region_end)
+        except SyntaxError:
+            self._dirty = True
+            return
+        self._starts[before:after] = starts
+        self._blocks[before:after] = blocks
+        if delta:
+            following = before + len(starts)
+            for index in range(following, len(self._starts)):
+                self._starts[index] += delta
+                self._blocks[index] = self._moved(self._blocks[index], delta)
+
+
+class Documents(object):
+    """IncrementalSymbols of the documents open in the server mode, up to
+    `max_documents` of the most recently used ones."""
+
+    def __init__(self, max_documents=32):
+        self.max_documents = max_documents
+        self._documents = collections.OrderedDict()
+
+    def open(self, path, source):
+        """Keep a document, even if it does not parse yet so that changes
+        can be applied to it."""
+        self.close(path)
+        document = self._documents[path] = IncrementalSymbols(source)
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+        document.parse()
+        return document
+
+    def get(self, path):
+        document = self._documents.pop(path)
+        self._documents[path] = document
+        return document
+
+    def close(self, path):
+        self._documents.pop(path, None)
 
 
 def provide_symbols(source):
@@ -70,20 +337,16 @@ def provide_symbols(source):
     ending line number and whether the statement is a single line.
 
     """
-    tree = ast.parse(source)
-    visitor = Visitor()
-    visitor.visit(tree)
-    sys.stdout.write(json.dumps(visitor.symbols))
+    sys.stdout.write(json.dumps(get_symbols(source)))
     sys.stdout.flush()
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        contents = sys.argv[2]
-    else:
-        with open(sys.argv[1], "r") as source:
-            contents = source.read()
+def read_source(path):
+    with open(path, "r") as source:
+        return decode_source(source.read())
 
+
+def decode_source(contents):
     try:
         default_encoding = sys.getdefaultencoding()
         encoded_contents = contents.encode(default_encoding, 'surrogateescape')
@@ -92,4 +355,223 @@ if __name__ == "__main__":
         pass
     if isinstance(contents, bytes):
         contents = contents.decode('utf8')
+    return contents
+
+
+def handle_request(request, documents=None):
+    """Get the symbols of the file of a request.
+
+    Requests have the `path` of the file, along with its `source` when the
+    document has unsaved changes. Responses have the `id` of the request and
+    the `symbols`, or an `error` when the file cannot be read or parsed.
+
+    With `documents`, the symbols of documents sent with their source are
+    kept. Later requests can send the `changes` made to them instead, see
+    `IncrementalSymbols.apply_changes`, and `"close": true` once the
+    document is closed.
+    """
+    response = {"id": request.get("id")}
+    try:
+        if documents is not None and request.get("close"):
+            documents.close(request["path"])
+        elif documents is not None and "changes" in request:
+            try:
+                document = documents.get(request["path"])
+            except KeyError:
+                raise ValueError("Document {0} is not open, send its source".format(
+                    request["path"]))
+            document.apply_changes(request["changes"])
+            response["symbols"] = document.symbols
+        elif documents is not None and request.get("source") is not None:
+            response["symbols"] = documents.open(
+                request["path"], request["source"]).symbols
+        else:
+            if request.get("source") is not None:
+                source = request["source"]
+            else:
+                source = read_source(request["path"])
+            response["symbols"] = get_symbols(source)
+    except Exception as ex:
+        response["error"] = "{0}: {1}".format(type(ex).__name__, ex)
+    return response
+
+
+def serve(input=None, output=None):
+    """Answer requests for symbols, one JSON object per line, until the
+    input is closed.
+
+    The process is kept for all documents, and the contents of unsaved
+    documents are sent along with the requests instead of as arguments.
+    """
+    if input is None:
+        input = io.open(sys.stdin.fileno(), encoding='utf-8')
+    if output is None:
+        output = sys.stdout
+    documents = Documents()
+    for line in iter(input.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            response = handle_request(json.loads(line), documents)
+        except ValueError as ex:
+            response = {"id": None, "error": "Invalid request: {0}".format(ex)}
+        output.write(json.dumps(response) + "\n")
+        output.flush()
+
+
+class SymbolCache(object):
+    """Symbols of the files seen before, kept in a JSON file.
+
+    Files are parsed again when their modification time or size changed
+    and their content hash is different.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        # Path -> {"mtime", "size", "hash", "symbols"}.
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with io.open(path, encoding='utf-8') as cache_file:
+                    self.entries = json.load(cache_file)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def unchanged(self, path, stat):
+        entry = self.entries.get(path)
+        if entry is not None and entry["mtime"] == stat.st_mtime \
+                and entry["size"] == stat.st_size:
+            return entry
+        return None
+
+    def save(self):
+        if self._path is None:
+            return
+        for path in list(self.entries):
+            if not os.path.exists(path):
+                del self.entries[path]
+        temp_path = "{0}.{1}.tmp".format(self._path, os.getpid())
+        with open(temp_path, "w") as cache_file:
+            json.dump(self.entries, cache_file)
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(temp_path, self._path)
+
+
+def file_symbols(task):
+    """Get the symbols of a file, unless its content hash is the known one.
+
+    Runs in the worker processes of the batch mode.
+    """
+    path, known_hash = task
+    result = {"path": path}
+    try:
+        stat = os.stat(path)
+        with open(path, "rb") as source:
+            contents = source.read()
+        result.update(mtime=stat.st_mtime, size=stat.st_size,
+                      hash=hashlib.sha1(contents).hexdigest())
+        if result["hash"] != known_hash:
+            # Parsing bytes honors the encoding declared by the file.
+            result["symbols"] = get_symbols(contents)
+    except Exception as ex:
+        result["error"] = "{0}: {1}".format(type(ex).__name__, ex)
+    return result
+
+
+def find_files(patterns):
+    """Python files of the directories, files and globs given."""
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = (os.path.join(root, name)
+                     for root, _, names in os.walk(pattern)
+                     for name in sorted(names) if name.endswith(".py"))
+        else:
+            paths = sorted(glob.glob(pattern)) or [pattern]
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+def provide_batch_symbols(paths, output, jobs=None, cache=None):
+    """Write the symbols of many files, one JSON line per file.
+
+    Files are parsed in parallel across a pool of `jobs` processes, lines
+    are written as files are done so not in the order given. Files that
+    did not change since they were cached are not parsed again, their
+    lines have `"cached": true`.
+    """
+    cache = cache or SymbolCache()
+    tasks = []
+    for path in paths:
+        try:
+            entry = cache.unchanged(path, os.stat(path))
+        except OSError:
+            entry = None
+        if entry is not None:
+            write_result(output, {"path": path, "symbols": entry["symbols"],
+                                  "cached": True})
+        else:
+            known = cache.entries.get(path)
+            tasks.append((path, known["hash"] if known else None))
+
+    jobs = jobs or multiprocessing.cpu_count()
+    if jobs == 1 or len(tasks) < 2:
+        results = (file_symbols(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap_unordered(file_symbols, tasks, chunksize=4)
+    try:
+        for result in results:
+            path = result["path"]
+            if "error" not in result:
+                if "symbols" not in result:
+                    result["symbols"] = cache.entries[path]["symbols"]
+                    result["cached"] = True
+                cache.entries[path] = {
+                    "mtime": result.pop("mtime"), "size": result.pop("size"),
+                    "hash": result.pop("hash"), "symbols": result["symbols"]}
+            write_result(output, result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    cache.save()
+
+
+def write_result(output, result):
+    output.write(json.dumps(result) + "\n")
+    output.flush()
+
+
+def batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="symbolProvider.py --batch",
+        description="Get the symbols of many files, one JSON line per file.")
+    parser.add_argument("patterns", nargs="+",
+                        help="files, directories or glob patterns")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of processes parsing files")
+    parser.add_argument("--cache", default=None,
+                        help="file to keep the symbols of unchanged files in")
+    args = parser.parse_args(argv)
+    provide_batch_symbols(list(find_files(args.patterns)), sys.stdout,
+                          args.jobs, SymbolCache(args.cache))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--server"]:
+        serve()
+        sys.exit(0)
+    if sys.argv[1:2] == ["--batch"]:
+        batch(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) == 3:
+        contents = decode_source(sys.argv[2])
+    else:
+        contents = read_source(sys.argv[1])
     provide_symbols(contents)
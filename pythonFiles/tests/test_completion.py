@@ -0,0 +1,1456 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import inspect
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+import completion
+
+
+class TestArguments(object):
+    """Tests for the command line handling of the completion server."""
+
+    def test_positionalArguments(self):
+        options, args = completion._parse_arguments(['custom', '/jedi', 'numpy,os'])
+        assert options == {}
+        assert args == ['custom', '/jedi', 'numpy,os']
+
+    def test_options(self):
+        options, args = completion._parse_arguments(['--workers=4', 'numpy'])
+        assert options == {'workers': '4'}
+        assert args == ['numpy']
+
+
+class TestRequestQueue(object):
+    """Tests for cancelling and superseding queued requests."""
+
+    def test_cancelQueuedRequest(self):
+        requests = completion.RequestQueue()
+        requests.put({'id': 1, 'lookup': 'usages'})
+        requests.put({'id': 2, 'lookup': 'completions'})
+
+        assert requests.cancel(1) == {'id': 1, 'lookup': 'usages'}
+        assert requests.get()['id'] == 2
+
+    def test_cancelRunningRequest(self):
+        requests = completion.RequestQueue()
+        requests.put({'id': 1, 'lookup': 'usages'})
+        request = requests.get()
+
+        assert requests.cancel(1) is None
+        assert requests.done(request)
+
+    def test_cancelUnknownRequest(self):
+        requests = completion.RequestQueue()
+        request = {'id': 1, 'lookup': 'usages'}
+        requests.put(request)
+        requests.get()
+
+        assert requests.cancel(2) is None
+        assert not requests.done(request)
+
+    def test_cancelledKeepsRequestRunning(self):
+        requests = completion.RequestQueue()
+        requests.put({'id': 1, 'lookup': 'usages'})
+        request = requests.get()
+
+        assert not requests.cancelled(request)
+        requests.cancel(1)
+        assert requests.cancelled(request)
+        assert requests.cancelled(request)
+        assert requests.done(request)
+
+    def test_runningRequestSuperseded(self):
+        requests = completion.RequestQueue(supersede=True)
+        requests.put({'id': 1, 'lookup': 'completions', 'path': 'a.py'})
+        request = requests.get()
+        requests.put({'id': 2, 'lookup': 'completions', 'path': 'b.py'})
+
+        assert not requests.cancelled(request)
+        requests.put({'id': 3, 'lookup': 'completions', 'path': 'a.py'})
+        assert requests.cancelled(request)
+        assert not requests.done(request)
+
+    def test_noSupersedingByDefault(self):
+        requests = completion.RequestQueue()
+        requests.put({'id': 1, 'lookup': 'completions', 'path': 'a.py'})
+
+        assert requests.put({'id': 2, 'lookup': 'completions', 'path': 'a.py'}) == []
+
+    def test_supersedeSameLookupAndPath(self):
+        requests = completion.RequestQueue(supersede=True)
+        requests.put({'id': 1, 'lookup': 'completions', 'path': 'a.py'})
+        requests.put({'id': 2, 'lookup': 'tooltip', 'path': 'a.py'})
+        requests.put({'id': 3, 'lookup': 'completions', 'path': 'b.py'})
+        requests.put({'id': 4, 'lookup': 'usages', 'path': 'a.py'})
+
+        superseded = requests.put({'id': 5, 'lookup': 'completions', 'path': 'a.py'})
+        assert [r['id'] for r in superseded] == [1]
+        assert [requests.get()['id'] for _ in range(4)] == [2, 3, 4, 5]
+
+    def test_usagesAreNeverSuperseded(self):
+        requests = completion.RequestQueue(supersede=True)
+        requests.put({'id': 1, 'lookup': 'usages', 'path': 'a.py'})
+
+        assert requests.put({'id': 2, 'lookup': 'usages', 'path': 'a.py'}) == []
+
+
+    def test_supersedeSameBatch(self):
+        requests = completion.RequestQueue(supersede=True)
+        batch = ['tooltip', 'arguments']
+        requests.put({'id': 1, 'lookups': batch, 'path': 'a.py'})
+        requests.put({'id': 2, 'lookup': 'tooltip', 'path': 'a.py'})
+
+        superseded = requests.put({'id': 3, 'lookups': batch, 'path': 'a.py'})
+        assert [r['id'] for r in superseded] == [1]
+
+    def test_batchWithUsagesNeverSuperseded(self):
+        requests = completion.RequestQueue(supersede=True)
+        batch = ['tooltip', 'usages']
+        requests.put({'id': 1, 'lookups': batch, 'path': 'a.py'})
+
+        assert requests.put({'id': 2, 'lookups': batch, 'path': 'a.py'}) == []
+
+class TestDocumentStore(object):
+    """Tests for keeping open documents in sync."""
+
+    def _change(self, start, end, text):
+        return {
+            'range': {
+                'start': {'line': start[0], 'character': start[1]},
+                'end': {'line': end[0], 'character': end[1]},
+            },
+            'text': text,
+        }
+
+    def test_openAndClose(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'import os\n', 1)
+        assert documents.get('a.py').source == 'import os\n'
+
+        documents.close('a.py')
+        assert documents.get('a.py') is None
+
+    def test_insertText(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'import os\nos.\n', 1)
+        documents.change('a.py', [self._change((1, 3), (1, 3), 'pa')], 2)
+
+        document = documents.get('a.py', 2)
+        assert document.source == 'import os\nos.pa\n'
+        assert document.version == 2
+
+    def test_replaceAcrossLines(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'a = 1\r\nb = 2\r\nc = 3\r\n', 1)
+        documents.change('a.py', [self._change((0, 4), (2, 1), '10\r\nd')], 2)
+
+        assert documents.get('a.py').source == 'a = 10\r\nd = 3\r\n'
+
+    def test_appendAtEnd(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'import os\n', 1)
+        documents.change('a.py', [
+            self._change((1, 0), (1, 0), 'os'),
+            self._change((1, 2), (1, 2), '.\n'),
+        ], 2)
+
+        assert documents.get('a.py').source == 'import os\nos.\n'
+
+    def test_replaceWholeDocument(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'import os\n', 1)
+        documents.change('a.py', [{'text': 'import sys\n'}], 2)
+
+        assert documents.get('a.py').source == 'import sys\n'
+
+    def test_versionMismatch(self):
+        documents = completion.DocumentStore()
+        documents.open('a.py', 'import os\n', 1)
+
+        with pytest.raises(ValueError):
+            documents.get('a.py', 2)
+
+    def test_versionOfDocumentNotOpen(self):
+        documents = completion.DocumentStore()
+
+        assert documents.get('a.py') is None
+        with pytest.raises(ValueError):
+            documents.get('a.py', 1)
+
+    def test_changeDocumentNotOpen(self):
+        documents = completion.DocumentStore()
+
+        with pytest.raises(ValueError):
+            documents.change('a.py', [{'text': 'import sys\n'}], 2)
+
+
+class FakeScript(object):
+
+    def __init__(self, source=None, line=None, column=None, path=None,
+                 sys_path=None, environment=None):
+        self._code_lines = source.splitlines(True)
+        self._pos = line, column
+        self._evaluator = object()
+
+
+class FakeJedi(object):
+    Script = FakeScript
+
+
+class TestScriptCache(object):
+    """Tests for reusing scripts across lookups."""
+
+    @pytest.fixture(autouse=True)
+    def fake_jedi(self, monkeypatch):
+        monkeypatch.setattr(completion, 'jedi', FakeJedi, raising=False)
+
+    def _script(self, cache, source, line=1, column=0, path='a.py'):
+        with cache.script(source, line, column, path, ['/lib'], None) as script:
+            return script
+
+    def test_reuseScriptForSameSource(self):
+        cache = completion.ScriptCache()
+        first = self._script(cache, 'import os\nos.\n', 2, 3)
+        second = self._script(cache, 'import os\nos.\n', 1, 0)
+
+        assert first._pos == (2, 3)
+        assert second._pos == (1, 0)
+        assert first._code_lines is second._code_lines
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_changedSourceIsMiss(self):
+        cache = completion.ScriptCache()
+        self._script(cache, 'import os\n')
+        self._script(cache, 'import sys\n')
+
+        assert cache.stats()['misses'] == 2
+
+    def test_invalidPosition(self):
+        cache = completion.ScriptCache()
+
+        with pytest.raises(ValueError):
+            self._script(cache, 'import os\n', 1, 20)
+
+    def test_evictLeastRecentlyUsed(self):
+        cache = completion.ScriptCache(max_entries=2)
+        self._script(cache, 'a = 1\n')
+        self._script(cache, 'b = 1\n')
+        self._script(cache, 'a = 1\n')
+        self._script(cache, 'c = 1\n')
+        self._script(cache, 'a = 1\n')
+
+        stats = cache.stats()
+        assert stats['entries'] == 2
+        assert stats['evictions'] == 1
+        assert stats['hits'] == 2
+
+    def test_evictOverSizeLimit(self):
+        cache = completion.ScriptCache(max_bytes=10)
+        self._script(cache, 'a = 1\n')
+        self._script(cache, 'b = 1\n')
+
+        stats = cache.stats()
+        assert stats['entries'] == 1
+        assert stats['bytes'] == 6
+
+    def test_reuseCachedScript(self):
+        cache = completion.ScriptCache()
+        script = self._script(cache, 'a = 1\n')
+
+        assert cache.holds(script)
+        with cache.reuse(script) as cached:
+            assert cached
+
+    def test_reuseDroppedScript(self):
+        cache = completion.ScriptCache(max_entries=1)
+        script = self._script(cache, 'a = 1\n')
+        self._script(cache, 'b = 1\n')
+
+        assert not cache.holds(script)
+        with cache.reuse(script) as cached:
+            assert not cached
+
+    def test_cachingTurnedOff(self):
+        cache = completion.ScriptCache(max_entries=0)
+        self._script(cache, 'a = 1\n')
+
+        assert cache.stats()['entries'] == 0
+
+
+class TestCachedScriptInference(object):
+    """Tests for inferring as much with cached scripts as with new ones."""
+
+    SOURCE = ('import os\n'
+              '\n'
+              'if os.path.exists("/etc/hosts"):\n'
+              '    with open("/etc/hosts") as f:\n'
+              '        for line in f.readlines():\n'
+              '            content = line.upper()\n'
+              '\n'
+              'import time\n'
+              'time.sleep\n')
+
+    @pytest.fixture
+    def jedi(self, monkeypatch):
+        jedi = pytest.importorskip('jedi')
+        if not jedi.__version__.startswith('0.12.'):
+            pytest.skip('completion.py is shipped with Jedi 0.12')
+        monkeypatch.setattr(completion, 'jedi', jedi, raising=False)
+        return jedi
+
+    def _lookups(self, script):
+        return ([d.name for d in script.goto_definitions()],
+                [c.name for c in script.completions()],
+                [s.name for s in script.call_signatures()],
+                [d.name for d in script.goto_assignments()])
+
+    def test_manyLookupsOnCachedScript(self, jedi, tmpdir):
+        path = str(tmpdir.join('doc.py'))
+        lines = self.SOURCE.splitlines()
+        positions = [(line, len(text)) for line, text in enumerate(lines, 1)]
+        positions.append((6, 30))
+        expected = dict((position, self._lookups(jedi.Script(
+            self.SOURCE, position[0], position[1], path, sys_path=sys.path)))
+            for position in positions)
+        cache = completion.ScriptCache()
+
+        for _ in range(5):
+            for position in positions:
+                with cache.script(self.SOURCE, position[0], position[1], path,
+                                  list(sys.path), None) as script:
+                    assert self._lookups(script) == expected[position]
+        assert cache.stats()['misses'] == 1
+        assert 'upper' in expected[(6, 30)][1]
+
+
+class TestParserCacheGuard(object):
+    """Tests for keeping parso from changing trees in use."""
+
+    @pytest.fixture
+    def parsed(self, monkeypatch):
+        modules = {'a.py': object()}
+        monkeypatch.setattr(completion, '_parsed_modules',
+                            lambda path: [modules] if path in modules else [])
+        return modules
+
+    def test_updateInPlaceWhenAlone(self, parsed):
+        guard = completion.ParserCacheGuard()
+        with guard.lookup():
+            with guard.parsing('a.py') as in_place:
+                assert in_place
+        assert 'a.py' in parsed
+
+    def test_newTreeWhileOthersRun(self, parsed):
+        guard = completion.ParserCacheGuard()
+        with guard.lookup(), guard.lookup():
+            with guard.parsing('a.py') as in_place:
+                assert not in_place
+        assert 'a.py' not in parsed
+
+    def test_inPlaceNotAllowed(self, parsed):
+        guard = completion.ParserCacheGuard()
+        with guard.parsing('a.py', allow_in_place=False) as in_place:
+            assert not in_place
+        assert 'a.py' not in parsed
+
+    def test_notParsedBefore(self, parsed):
+        guard = completion.ParserCacheGuard()
+        with guard.parsing('b.py') as in_place:
+            assert not in_place
+
+    def test_inPlaceUpdateDropsCachedScripts(self, parsed, monkeypatch):
+        monkeypatch.setattr(completion, 'jedi', FakeJedi, raising=False)
+        cache = completion.ScriptCache()
+        with cache.script('a = 1\n', 1, 0, 'b.py', [], None):
+            pass
+        with cache.script('a = 2\n', 1, 0, 'a.py', [], None):
+            pass
+
+        assert cache.stats()['entries'] == 1
+        assert cache.stats()['bytes'] == 6
+
+
+class TestRanking(object):
+    """Tests for ordering completions by the name being completed."""
+
+    def test_wordBefore(self):
+        script = FakeScript('import os\nos.pa  \n')
+        script._pos = (2, 5)
+
+        assert completion._word_before(script) == 'pa'
+
+    def test_prefixBeforeFuzzy(self):
+        names = ['pathsep', 'a_path', 'Path', 'pardir', 'path']
+
+        assert completion._ranked(names, 'pat', lambda n: n) == \
+            ['pathsep', 'path', 'Path', 'a_path', 'pardir']
+
+    def test_noMatchLast(self):
+        names = ['sep', 'spa', 'xyz']
+
+        assert completion._ranked(names, 'sp', lambda n: n) == ['spa', 'sep', 'xyz']
+
+
+class TestSearchPathResolver(object):
+    """Tests for working out and remembering the search path of a file."""
+
+    def _make_package(self, tmpdir):
+        package = tmpdir.mkdir('top').mkdir('package')
+        package.join('__init__.py').write('')
+        package.dirpath().join('__init__.py').write('')
+        return package
+
+    def test_topLevelModule(self, tmpdir):
+        package = self._make_package(tmpdir)
+        resolver = completion.SearchPathResolver([])
+        module = str(package.join('module.py'))
+
+        assert resolver.top_level_module(module) == str(tmpdir.join('top'))
+
+    def test_notInPackage(self, tmpdir):
+        resolver = completion.SearchPathResolver([])
+        module = str(tmpdir.join('module.py'))
+
+        assert resolver.top_level_module(module) == module
+
+    def test_sysPath(self, tmpdir):
+        package = self._make_package(tmpdir)
+        resolver = completion.SearchPathResolver(['/lib'])
+
+        sys_path = resolver.sys_path(['/extra'], str(package.join('module.py')))
+        assert sys_path == [str(tmpdir.join('top')), '/extra', '/lib']
+
+    def test_sysPathIsShared(self, tmpdir):
+        package = self._make_package(tmpdir)
+        resolver = completion.SearchPathResolver(['/lib'])
+
+        first = resolver.sys_path([], str(package.join('a.py')))
+        second = resolver.sys_path([], str(package.join('b.py')))
+        assert first is second
+        assert resolver.sys_path(['/extra'], str(package.join('a.py'))) is not first
+
+    def test_packagesAreRemembered(self, tmpdir, monkeypatch):
+        package = self._make_package(tmpdir)
+        resolver = completion.SearchPathResolver([])
+        module = str(package.join('module.py'))
+        resolver.top_level_module(module)
+
+        def isfile(path):
+            raise AssertionError('Looked for ' + path)
+        monkeypatch.setattr(completion.os.path, 'isfile', isfile)
+        assert resolver.top_level_module(module) == str(tmpdir.join('top'))
+
+    def test_newPackageIsFound(self, tmpdir):
+        package = self._make_package(tmpdir)
+        resolver = completion.SearchPathResolver([], revalidate_after=0)
+        module = str(package.join('module.py'))
+        resolver.top_level_module(module)
+
+        tmpdir.join('__init__.py').write('')
+        assert resolver.top_level_module(module) == str(tmpdir)
+
+
+class TestImportProfile(object):
+    """Tests for counting the modules imported in a workspace."""
+
+    def test_recordImports(self):
+        profile = completion.ImportProfile()
+        profile.record('a.py', 'import os, sys as system\nfrom numpy import array\n')
+        profile.record('b.py', 'import numpy.linalg  # comment\nfrom . import spam\n'
+                               'def f():\n    import os\n')
+
+        assert profile.most_imported(10) == ['os', 'numpy', 'numpy.linalg', 'sys']
+        assert profile.most_imported(1) == ['os']
+
+    def test_recordFileOnce(self):
+        profile = completion.ImportProfile()
+        profile.record('a.py', 'import os\n')
+        profile.record('a.py', 'import os\nimport sys\n')
+
+        assert profile.most_imported(10) == ['os']
+
+    def test_saveAndLoad(self, tmpdir):
+        path = str(tmpdir.join('profile.json'))
+        profile = completion.ImportProfile(path)
+        profile.record('a.py', 'import os\nimport sys\n')
+        profile.record('b.py', 'import sys\n')
+        profile.save()
+
+        profile = completion.ImportProfile(path)
+        assert profile.most_imported(10) == ['sys', 'os']
+
+    def test_ignoreInvalidProfile(self, tmpdir):
+        path = tmpdir.join('profile.json')
+        path.write('{"version": 0, "modules": {"os": 1}}')
+
+        assert completion.ImportProfile(str(path)).most_imported(10) == []
+
+    def test_preloadOrder(self):
+        profile = completion.ImportProfile()
+        profile.record('a.py', 'import os\nimport sys\n')
+        profile.record('b.py', 'import sys\n')
+        preloader = completion.ModulePreloader(['numpy', 'os'], profile, count=2)
+
+        assert preloader._modules == ['numpy', 'os', 'sys']
+
+
+class TestCompletionIndex(object):
+    """Tests for the persistent index of installed modules."""
+
+    @pytest.fixture
+    def site_packages(self, tmpdir):
+        site_packages = tmpdir.mkdir('site-packages')
+        site_packages.join('installed.py').write('a = 1\n')
+        return site_packages
+
+    def _index(self, tmpdir, site_packages):
+        return completion.CompletionIndex(str(tmpdir.join('index')),
+                                          [str(site_packages)])
+
+    def test_findInstalled(self, tmpdir, site_packages):
+        index = self._index(tmpdir, site_packages)
+        location = index.find_installed('installed', [str(site_packages)])
+
+        assert location[0] == str(site_packages.join('installed.py'))
+
+    def test_shadowedByWorkspace(self, tmpdir, site_packages):
+        workspace = tmpdir.mkdir('workspace')
+        workspace.join('installed.py').write('b = 1\n')
+        index = self._index(tmpdir, site_packages)
+
+        assert index.find_installed(
+            'installed', [str(workspace), str(site_packages)]) is None
+
+    def test_builtinModule(self, tmpdir, site_packages):
+        index = self._index(tmpdir, site_packages)
+
+        assert index.find_installed('sys', []) == ['sys', None]
+
+    def test_putAndGet(self, tmpdir, site_packages):
+        index = self._index(tmpdir, site_packages)
+        location = index.find_installed('installed', [str(site_packages)])
+        index.put('installed', location, 'attributes', [{'text': 'a'}])
+
+        index = self._index(tmpdir, site_packages)
+        assert index.get('installed', location, 'attributes') == [{'text': 'a'}]
+        assert index.get('installed', location, 'import_names') is None
+
+    def test_modifiedModule(self, tmpdir, site_packages):
+        index = self._index(tmpdir, site_packages)
+        location = index.find_installed('installed', [str(site_packages)])
+        index.put('installed', location, 'attributes', [{'text': 'a'}])
+
+        assert index.get('installed', [location[0], location[1] + 1],
+                         'attributes') is None
+
+    def test_newIndexForNewDistributions(self, tmpdir, site_packages):
+        index = self._index(tmpdir, site_packages)
+        location = index.find_installed('installed', [str(site_packages)])
+        index.put('installed', location, 'attributes', [{'text': 'a'}])
+        site_packages.mkdir('package-1.0.dist-info')
+
+        index = self._index(tmpdir, site_packages)
+        assert index.get('installed', location, 'attributes') is None
+
+
+def _completion_server(index=None):
+    """JediCompletion serving one workspace context, without reading stdin."""
+    server = completion.JediCompletion.__new__(completion.JediCompletion)
+    server._config = threading.local()
+    server._config.context = completion.WorkspaceContext(
+        None, None, [], completion.ScriptCache(), index=index)
+    server._config.case_insensitive = False
+    server._config.fuzzy_matcher = False
+    return server
+
+
+class IndexScript(object):
+    """Script completing an attribute of the sys module."""
+    path = None
+    _pos = (1, 5)
+    _code_lines = ['sys.p']
+    _module_node = None
+
+
+class TestIndexLookups(object):
+    """Tests for answering completions from the index."""
+
+    indexed = [{'text': 'path', 'type': 'variable', 'raw_type': 'instance',
+                'rightLabel': 'path', 'docstring': 'Module search path.',
+                'signature': ''},
+               {'text': 'platform', 'type': 'variable', 'raw_type': 'instance',
+                'rightLabel': 'platform', 'docstring': '', 'signature': ''},
+               {'text': 'version', 'type': 'variable', 'raw_type': 'instance',
+                'rightLabel': 'version', 'docstring': '', 'signature': ''}]
+
+    @pytest.fixture
+    def server(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(completion, '_module_bound_by_import',
+                            lambda module_node, name: name)
+        index = completion.CompletionIndex(str(tmpdir), [])
+        index.put('sys', ['sys', None], 'attributes', self.indexed)
+        return _completion_server(index)
+
+    def test_completionsWithoutDetails(self, server):
+        results = server._process_lookup(
+            IndexScript(), 'completions', {'id': 1}, [])
+
+        assert [r['text'] for r in results] == ['path', 'platform']
+        assert results[0] == {'text': 'path', 'type': 'variable',
+                              'raw_type': 'instance', 'rightLabel': 'path'}
+
+    def test_resolveLazyCompletions(self, server):
+        results = server._process_lookup(
+            IndexScript(), 'completions', {'id': 1, 'lazy': True}, [])
+        resolved = server._resolve_completion(
+            {'completionId': 1, 'text': 'path'})
+
+        assert results[0] == {'text': 'path', 'type': 'variable',
+                              'raw_type': 'instance'}
+        assert resolved == [self.indexed[0]]
+
+    def test_parserErrorRunsOnScript(self, server, monkeypatch):
+        def fail(module_node, name):
+            raise ValueError('no path for name')
+
+        monkeypatch.setattr(completion, '_module_bound_by_import', fail)
+
+        assert server._lookup_index(IndexScript(), 'completions', []) is None
+
+    def test_indexingErrorRunsOnScript(self, server, monkeypatch):
+        def fail(kind, module, name):
+            raise KeyError(module)
+
+        monkeypatch.setattr(server, '_index_results', fail)
+        script = IndexScript()
+        script._code_lines = ['sys.path']
+
+        assert server._lookup_index(script, 'tooltip', []) is None
+
+
+class TestBatchedLookups(object):
+    """Tests for running the lookups of a batch on one script."""
+
+    @pytest.fixture
+    def server(self, monkeypatch):
+        monkeypatch.setattr(completion, 'jedi', FakeJedi, raising=False)
+        server = _completion_server()
+        server.scripts = []
+
+        def process_lookup(script, lookup, request, sys_path):
+            if lookup == 'arguments':
+                raise ValueError('no call signature')
+            server.scripts.append(script)
+            return [lookup]
+
+        server._process_lookup = process_lookup
+        return server
+
+    def _request(self, **kwargs):
+        request = {'id': 1, 'source': 'import os\nos.path\n', 'path': 'a.py',
+                   'line': 1, 'column': 3}
+        request.update(kwargs)
+        return request
+
+    def test_oneScriptForAllLookups(self, server):
+        results = server._process_lookups(
+            self._request(), ['tooltip', 'definitions', 'completions'], [])
+
+        assert results == {'tooltip': ['tooltip'],
+                           'definitions': ['definitions'],
+                           'completions': ['completions']}
+        evaluators = set(script._evaluator for script in server.scripts)
+        assert len(evaluators) == 1
+        assert server._config.context.scripts.stats()['misses'] == 1
+
+    def test_failingLookupHasNoResults(self, server):
+        results = server._process_lookups(
+            self._request(), ['tooltip', 'arguments', 'definitions'], [])
+
+        assert results == {'tooltip': ['tooltip'], 'arguments': [],
+                           'definitions': ['definitions']}
+
+    def test_singleLookupFails(self, server):
+        with pytest.raises(ValueError):
+            server._process_lookups(self._request(), ['arguments'], [])
+
+
+class FakeName(object):
+
+    def __init__(self, name, type='statement', description=''):
+        self.name = name
+        self.type = type
+        self.description = description
+
+
+class FakeSignature(object):
+
+    def __init__(self, *params):
+        self.params = params
+
+
+class CompletionScript(object):
+    """Script completing the word before the end of its only line."""
+
+    def __init__(self, line, completions, signatures=()):
+        self._code_lines = [line]
+        self._pos = 1, len(line)
+        self._completions = completions
+        self._signatures = signatures
+
+    def completions(self):
+        return self._completions
+
+    def call_signatures(self):
+        return self._signatures
+
+
+class TestCompletionResults(object):
+    """Tests for serializing, limiting and streaming completions."""
+
+    def _completions(self, server, script, request):
+        request = dict(request, id=1)
+        return server._process_lookup(script, 'completions', request, [])
+
+    def test_argumentsMergedWithCompletions(self):
+        script = CompletionScript('print(', [
+            FakeName('end'), FakeName('sep'), FakeName('os', 'module')],
+            [FakeSignature(FakeName('end', description='param end'),
+                           FakeName('sep', description='param sep=None'))])
+        results = self._completions(_completion_server(), script, {})
+
+        assert [r['text'] for r in results] == ['end', 'sep=', 'os']
+        assert results[0]['type'] == 'value'
+        assert results[0]['raw_type'] == 'statement'
+        assert results[1]['type'] == 'property'
+        assert results[1]['snippet'] == 'sep=${1:None}$0'
+        assert results[2]['type'] == 'import'
+
+    def test_maxResults(self):
+        script = CompletionScript('x.pa', [
+            FakeName('capitalize'), FakeName('pack'), FakeName('Path'),
+            FakeName('path')])
+        results = self._completions(_completion_server(), script,
+                                    {'maxResults': 2})
+
+        assert [r['text'] for r in results] == ['pack', 'path']
+
+    def test_streamResults(self, pipes):
+        requests, responses = pipes
+        server = _completion_server()
+        completion.RequestDispatcher.__init__(server)
+        script = CompletionScript('x.pa', [
+            FakeName('capitalize'), FakeName('pack'), FakeName('Path'),
+            FakeName('path')])
+        results = self._completions(server, script,
+                                    {'maxResults': 2, 'stream': True})
+        incomplete, = _responses(responses, 1)
+
+        assert incomplete['id'] == 1
+        assert incomplete['incomplete'] is True
+        assert [r['text'] for r in incomplete['results']] == ['pack', 'path']
+        assert [r['text'] for r in results] == ['pack', 'path', 'Path',
+                                                'capitalize']
+
+    def test_noStreamingWhenCancelled(self, pipes):
+        requests, responses = pipes
+        server = _completion_server()
+        completion.RequestDispatcher.__init__(server)
+        server._requests.put({'id': 1, 'lookup': 'completions'})
+        server._requests.get()
+        server._requests.cancel(1)
+        script = CompletionScript('x.pa', [FakeName('pack'), FakeName('path')])
+        results = self._completions(server, script,
+                                    {'maxResults': 1, 'stream': True})
+        server._write_response('{"id":2}')
+
+        assert [r['text'] for r in results] == ['pack', 'path']
+        assert _responses(responses, 1) == [{'id': 2}]
+
+    def test_noStreamingInBatch(self, pipes):
+        requests, responses = pipes
+        server = _completion_server()
+        completion.RequestDispatcher.__init__(server)
+        script = CompletionScript('x.pa', [FakeName('pack'), FakeName('path')])
+        results = self._completions(server, script, {
+            'maxResults': 1, 'stream': True, 'lookups': ['completions']})
+        server._write_response('{"id":2}')
+
+        assert [r['text'] for r in results] == ['pack']
+        assert _responses(responses, 1) == [{'id': 2}]
+
+
+class ResolvableName(FakeName):
+
+    params = (FakeName('path', description='param path'),)
+
+    def docstring(self):
+        return 'Documentation of %s.' % self.name
+
+
+class TestResolveCompletion(object):
+    """Tests for resolving completions sent with only their name."""
+
+    @pytest.fixture
+    def server(self, monkeypatch):
+        monkeypatch.setattr(completion, 'jedi', FakeJedi, raising=False)
+        server = _completion_server()
+        server._config.context.scripts = completion.ScriptCache(max_entries=1)
+        self._sent(server, 1, 'import os\nos.\n')
+        return server
+
+    def _sent(self, server, identifier, source):
+        """Send lazy completions for the source as the request."""
+        context = server._config.context
+        with context.scripts.script(source, 2, 3, 'a.py', [], None) as script:
+            context.resolvable = (identifier, script,
+                                  {'listdir': ResolvableName('listdir', 'function')},
+                                  completion.time.time())
+
+    def _resolve(self, server, identifier=1, text='listdir'):
+        return server._resolve_completion({'completionId': identifier,
+                                           'text': text})
+
+    def test_resolve(self, server):
+        assert self._resolve(server) == [{
+            'text': 'listdir', 'type': 'function', 'raw_type': 'function',
+            'rightLabel': '', 'docstring': 'Documentation of listdir.',
+            'signature': 'listdir(path)'}]
+
+    def test_unknownCompletion(self, server):
+        assert self._resolve(server, text='getcwd') == []
+        assert self._resolve(server, identifier=2) == []
+
+    def test_replacedResults(self, server):
+        self._sent(server, 2, 'import os\nos.\n')
+
+        assert self._resolve(server, identifier=1) == []
+        assert self._resolve(server, identifier=2) != []
+
+    def test_scriptDropped(self, server):
+        with server._config.context.scripts.script(
+                'import sys\n', 1, 0, 'b.py', [], None):
+            pass
+
+        assert self._resolve(server) == []
+
+    def test_timeout(self, server, monkeypatch):
+        now = completion.time.time()
+        monkeypatch.setattr(completion.time, 'time',
+                            lambda: now + server.resolve_timeout + 1)
+
+        assert self._resolve(server) == []
+
+
+class TestReferenceIndex(object):
+    """Tests for the index of the names modules refer to."""
+
+    @pytest.fixture
+    def root(self, tmpdir):
+        root = tmpdir.mkdir('root')
+        root.join('a.py').write('def helper():\n    pass\n')
+        root.mkdir('app').join('main.py').write('from a import helper\n')
+        root.mkdir('.venv').join('b.py').write('helper = 1\n')
+        return root
+
+    @pytest.fixture(autouse=True)
+    def stop_indexes(self, monkeypatch):
+        indexes = []
+        start = completion.ReferenceIndex.start
+
+        def started(index):
+            indexes.append(index)
+            start(index)
+
+        monkeypatch.setattr(completion.ReferenceIndex, 'start', started)
+        yield
+        for index in indexes:
+            index.stop()
+
+    def _built(self, root, directory=None, rescan_after=5.0):
+        index = completion.ReferenceIndex(str(root), directory, rescan_after)
+        index.start()
+        assert index.ready.wait(5)
+        return index
+
+    def _paths(self, *paths):
+        return set(os.path.normcase(str(path)) for path in paths)
+
+    def test_candidates(self, root):
+        index = self._built(root)
+
+        assert index.candidates('helper') == self._paths(
+            root.join('a.py'), root.join('app', 'main.py'))
+        assert index.candidates('pass') == self._paths(root.join('a.py'))
+        assert index.candidates('missing') == set()
+
+    def test_notReadyBeforeBuilt(self, root):
+        index = completion.ReferenceIndex(str(root))
+
+        assert index.candidates('helper') is None
+
+    def test_contains(self, root, tmpdir):
+        index = completion.ReferenceIndex(str(root))
+
+        assert str(root.join('app', 'main.py')) in index
+        assert str(tmpdir.join('other.py')) not in index
+
+    def test_refreshChangedModules(self, root):
+        index = self._built(root)
+        index.ready.clear()
+        root.join('app', 'main.py').write('import os\n')
+        root.join('c.py').write('helper()\n')
+        root.join('a.py').remove()
+        index.refresh()
+        assert index.ready.wait(5)
+
+        assert index.candidates('helper') == self._paths(root.join('c.py'))
+
+    def test_rescanInBackground(self, root):
+        index = self._built(root, rescan_after=0.05)
+        root.join('c.py').write('helper()\n')
+        for _ in range(100):
+            if len(index.candidates('helper')) == 3:
+                break
+            completion.time.sleep(0.05)
+
+        assert index.candidates('helper') == self._paths(
+            root.join('a.py'), root.join('app', 'main.py'), root.join('c.py'))
+
+    def test_stop(self, root):
+        index = self._built(root, rescan_after=0.01)
+        index.stop()
+        completion.time.sleep(0.1)
+        index.ready.clear()
+        completion.time.sleep(0.1)
+
+        assert not index.ready.is_set()
+
+    def test_searchDoesNotScan(self, root, monkeypatch):
+        index = self._built(root, rescan_after=60)
+        scans = []
+        monkeypatch.setattr(index, '_scan', lambda: scans.append(1))
+        index.candidates('helper')
+
+        assert scans == []
+
+    def test_keptOnDisk(self, root, tmpdir):
+        directory = str(tmpdir.join('references'))
+        self._built(root, directory)
+        index = completion.ReferenceIndex(str(root), directory)
+        index._load()
+
+        assert index._modules['helper'] == self._paths(
+            root.join('a.py'), root.join('app', 'main.py'))
+
+
+class TestUsageSearch(object):
+    """Pins the Jedi internals patched to narrow usages down."""
+
+    @pytest.fixture
+    def imports(self, monkeypatch):
+        jedi = pytest.importorskip('jedi')
+        if not jedi.__version__.startswith('0.12.'):
+            pytest.skip('completion.py is shipped with Jedi 0.12')
+        from jedi.evaluate import imports
+        monkeypatch.setattr(completion, 'jedi', jedi, raising=False)
+        monkeypatch.setattr(imports, 'get_modules_containing_name',
+                            imports.get_modules_containing_name)
+        monkeypatch.setattr(imports, '_load_module', imports._load_module)
+        return imports
+
+    def _arguments(self, function):
+        try:
+            return inspect.getfullargspec(function).args
+        except AttributeError:
+            return inspect.getargspec(function).args
+
+    def test_patchedFunctions(self, imports):
+        assert self._arguments(imports.get_modules_containing_name) == [
+            'evaluator', 'modules', 'name']
+        assert self._arguments(imports._load_module)[:5] == [
+            'evaluator', 'path', 'code', 'sys_path', 'module_name']
+        assert self._arguments(imports.sys_path.dotted_path_in_sys_path) == [
+            'sys_path', 'module_path']
+        assert isinstance(completion._narrow_usage_search(),
+                          completion._UsageSearch)
+
+    def test_narrowedUsages(self, imports, tmpdir):
+        root = tmpdir.mkdir('root')
+        root.join('a.py').write('def helper():\n    pass\n')
+        root.join('b.py').write('from a import helper\nhelper()\n')
+        root.join('c.py').write('other = 1\n')
+        references = completion.ReferenceIndex(str(root))
+        references.start()
+        assert references.ready.wait(5)
+        references.stop()
+        search = completion._narrow_usage_search()
+        loaded = []
+        load_module = imports._load_module
+
+        def load(evaluator, path=None, *args, **kwargs):
+            loaded.append(os.path.basename(path))
+            return load_module(evaluator, path, *args, **kwargs)
+
+        imports._load_module = load
+        with search.narrowed(references):
+            usages = completion.jedi.Script(
+                root.join('a.py').read(), 1, 5, str(root.join('a.py')),
+                sys_path=[str(root)]).usages()
+
+        assert sorted((os.path.basename(u.module_path), u.line)
+                      for u in usages) == [('a.py', 1), ('b.py', 1), ('b.py', 2)]
+        assert 'c.py' not in loaded
+
+
+class TestWorkspaceContexts(object):
+    """Tests for keeping isolated state for each workspace root."""
+
+    def _contexts(self, **kwargs):
+        def create(identifier, python_path):
+            return completion.WorkspaceContext(
+                identifier, None, ['/lib'], completion.ScriptCache(), python_path)
+        return completion.WorkspaceContexts(create, **kwargs)
+
+    def _get(self, contexts, identifier, config=None):
+        with contexts.context(identifier, config) as context:
+            return context
+
+    def test_contextForEachRoot(self):
+        contexts = self._contexts()
+        first = self._get(contexts, 'a')
+
+        assert self._get(contexts, 'a') is first
+        assert self._get(contexts, 'b') is not first
+
+    def test_keepLastConfig(self):
+        contexts = self._contexts()
+        self._get(contexts, 'a', {'extraPaths': ['/extra']})
+
+        assert self._get(contexts, 'a').config == {'extraPaths': ['/extra']}
+
+    def test_newContextForOtherInterpreter(self):
+        contexts = self._contexts()
+        first = self._get(contexts, 'a', {'pythonPath': '/bin/python'})
+
+        assert self._get(contexts, 'a', {'pythonPath': '/bin/python'}) is first
+        second = self._get(contexts, 'a', {'pythonPath': '/bin/python3'})
+        assert second is not first
+        assert second.python_path == '/bin/python3'
+
+    def test_evictLeastRecentlyUsed(self):
+        contexts = self._contexts(max_contexts=2)
+        self._get(contexts, 'a')
+        self._get(contexts, 'b')
+        self._get(contexts, 'a')
+        self._get(contexts, 'c')
+
+        assert [c['workspace'] for c in contexts.stats()] == ['a', 'c']
+        assert contexts.evictions == 1
+
+    def test_activeContextIsKept(self):
+        contexts = self._contexts(max_contexts=1)
+        with contexts.context('a'):
+            self._get(contexts, 'b')
+
+            assert [c['workspace'] for c in contexts.stats()] == ['a', 'b']
+
+
+class TestRequestSettings(object):
+    """Tests for settings that differ between concurrent requests."""
+
+    def test_settingPerThread(self):
+        class Settings(object):
+            case_insensitive_completion = True
+            cache_directory = '/cache'
+
+        settings = completion._RequestSettings(Settings)
+        settings.set('case_insensitive_completion', False)
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(settings.case_insensitive_completion))
+        thread.start()
+        thread.join()
+
+        assert settings.case_insensitive_completion is False
+        assert seen == [True]
+        assert settings.cache_directory == '/cache'
+
+
+class TestRequestMetrics(object):
+    """Tests for the timings and statistics of requests."""
+
+    def test_offByDefault(self):
+        metrics = completion.RequestMetrics()
+        request = {'id': 1}
+        metrics.received(request, 0.1)
+        with metrics.request(request) as recorded:
+            with metrics.phase('script'):
+                pass
+            metrics.note('scriptCacheHit', True)
+
+        assert recorded is None
+        assert request == {'id': 1}
+
+    def test_phasesAndNotes(self):
+        metrics = completion.RequestMetrics()
+        metrics.configure('response')
+        request = {'id': 1, 'lookup': 'tooltip', 'source': 'abc'}
+        metrics.received(request, 0.5)
+        with metrics.request(request) as recorded:
+            with metrics.phase('lookups'):
+                with metrics.phase('script'):
+                    pass
+                assert metrics.timed('inference', len, 'ab') == 2
+                metrics.timed('inference', len, 'ab')
+            metrics.note('scriptCacheHit', False)
+
+        phases = recorded['phases']
+        assert sorted(phases) == ['decode', 'inference', 'queue', 'script',
+                                  'serialize']
+        assert phases['decode'] == 0.5
+        assert recorded['lookup'] == 'tooltip'
+        assert recorded['sourceBytes'] == 3
+        assert recorded['scriptCacheHit'] is False
+        assert recorded['total'] >= phases['script']
+        assert '_received' not in request
+
+    def test_logFile(self, tmpdir):
+        log = tmpdir.join('metrics.log')
+        metrics = completion.RequestMetrics()
+        metrics.configure(str(log))
+        with metrics.request({'id': 7, 'lookups': ['tooltip']}):
+            pass
+
+        assert not metrics.in_response
+        recorded = json.loads(log.read())
+        assert recorded['id'] == 7
+        assert recorded['lookup'] == ['tooltip']
+
+    def test_keepSlowestProfiles(self, tmpdir, monkeypatch):
+        profiles = completion.SlowestProfiles(str(tmpdir), count=2)
+        durations = iter([0.0, 3.0, 0.0, 1.0, 0.0, 2.0, 0.0, 4.0])
+        monkeypatch.setattr(completion.time, 'time', lambda: next(durations))
+        for identifier in range(4):
+            with profiles.profile({'id': identifier, 'lookup': 'usages'}):
+                pass
+
+        assert sorted(name.split('-')[-1] for name in os.listdir(str(tmpdir))) == [
+            '0.prof', '3.prof']
+
+
+class TestRequestRecorder(object):
+    """Tests for recording requests to replay them."""
+
+    def _recorded(self, recording):
+        return [json.loads(line)['request'] for line in recording.readlines()]
+
+    def test_record(self, tmpdir):
+        recording = tmpdir.join('requests.jsonl')
+        recorder = completion.RequestRecorder(str(recording))
+        documents = completion.DocumentStore()
+        recorder.record({'id': 1, 'source': 'a.', 'path': 'a.py'}, documents)
+        recorder.record({'id': 2, 'lookup': 'cancel'}, documents)
+
+        lines = [json.loads(line) for line in recording.readlines()]
+        assert [line['request']['id'] for line in lines] == [1, 2]
+        assert lines[0]['time'] == 0
+        assert lines[1]['time'] >= 0
+
+    def test_timingsNotRecorded(self, tmpdir):
+        recording = tmpdir.join('requests.jsonl')
+        recorder = completion.RequestRecorder(str(recording))
+        request = {'id': 1, 'source': 'a.', '_received': (0.0, 0.1)}
+        recorder.record(request, completion.DocumentStore())
+
+        assert self._recorded(recording) == [{'id': 1, 'source': 'a.'}]
+        assert '_received' in request
+
+    def test_snapshotFilesNotSent(self, tmpdir):
+        source = tmpdir.join('a.py')
+        source.write('import os\n')
+        recording = tmpdir.join('requests.jsonl')
+        recorder = completion.RequestRecorder(str(recording))
+        documents = completion.DocumentStore()
+        documents.open(str(tmpdir.join('b.py')), 'b = 1\n')
+        recorder.record({'id': 1, 'path': str(source)}, documents)
+        recorder.record({'id': 2, 'path': str(tmpdir.join('b.py'))}, documents)
+
+        requests = self._recorded(recording)
+        assert requests[0]['source'] == 'import os\n'
+        assert 'source' not in requests[1]
+
+
+class TestResponseOutput(object):
+    """Tests for writing the responses."""
+
+    def test_compactJson(self, monkeypatch):
+        monkeypatch.setattr(completion, 'ujson', None)
+
+        assert completion._dumps({'id': 1, 'results': ['a/b']}) in (
+            '{"id":1,"results":["a/b"]}', '{"results":["a/b"],"id":1}')
+
+    def test_partialWrites(self, monkeypatch):
+        written = []
+
+        def write(fd, data):
+            written.append(bytes(data[:3]))
+            return len(written[-1])
+
+        dispatcher = completion.RequestDispatcher.__new__(completion.RequestDispatcher)
+        dispatcher._output = 1
+        dispatcher._output_lock = threading.Lock()
+        monkeypatch.setattr(completion.os, 'write', write)
+        dispatcher._write_response(u'{"id":1}')
+        dispatcher._write_response(b'{"id":2}')
+
+        assert b''.join(written) == b'{"id":1}\n{"id":2}\n'
+
+
+@pytest.fixture
+def pipes(monkeypatch):
+    """Connect the stdin and the responses of a dispatcher to pipes.
+
+    Yields:
+        File the requests are written to and file the responses are read
+        from.
+    """
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+    monkeypatch.setattr(completion.sys, 'stdin', os.fdopen(request_read))
+    monkeypatch.setattr(completion, '_redirect_stdout', lambda: response_write)
+    requests = os.fdopen(request_write, 'w')
+    responses = os.fdopen(response_read)
+    yield requests, responses
+    if not requests.closed:
+        requests.close()
+    responses.close()
+
+
+def _send(requests, *messages):
+    for message in messages:
+        requests.write(json.dumps(message) + '\n')
+    requests.flush()
+
+
+def _responses(responses, count):
+    """Read the next responses to requests, skipping the events."""
+    read = []
+    while len(read) < count:
+        response = json.loads(responses.readline())
+        if 'id' in response:
+            read.append(response)
+    return read
+
+
+class TestServe(object):
+    """Tests for serving requests on the worker threads."""
+
+    def _watch(self, process, workers=2):
+        server = completion.JediCompletion.__new__(completion.JediCompletion)
+        completion.RequestDispatcher.__init__(server)
+        server._worker_count = workers
+        server._preloader = completion.ModulePreloader()
+        server._process_request = process
+        thread = threading.Thread(target=server.watch)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_slowLookupDoesNotHoldUpOthers(self, pipes):
+        requests, responses = pipes
+        release = threading.Event()
+
+        def process(request):
+            if request['lookup'] == 'usages':
+                release.wait(10)
+            return {'id': request['id'], 'results': [request['source']]}
+
+        thread = self._watch(process)
+        _send(requests, {'id': 1, 'lookup': 'usages', 'source': 'slow'},
+              {'id': 2, 'lookup': 'completions', 'source': 'fast'})
+        first = _responses(responses, 1)
+        release.set()
+        second = _responses(responses, 1)
+        requests.close()
+        thread.join(10)
+
+        assert first == [{'id': 2, 'results': ['fast']}]
+        assert second == [{'id': 1, 'results': ['slow']}]
+        assert not thread.is_alive()
+
+    def test_errorResponse(self, pipes):
+        requests, responses = pipes
+
+        def process(request):
+            if request['id'] == 1:
+                raise ValueError('broken')
+            return {'id': request['id'], 'results': []}
+
+        thread = self._watch(process, workers=1)
+        _send(requests, {'id': 1, 'source': 'a'}, {'id': 2, 'source': 'b'})
+        read = _responses(responses, 2)
+        requests.close()
+        thread.join(10)
+
+        assert read == [
+            {'id': 1, 'results': [], 'error': 'broken'},
+            {'id': 2, 'results': []}]
+
+    def test_metricsInResponse(self, pipes, monkeypatch):
+        requests, responses = pipes
+        metrics = completion.RequestMetrics()
+        metrics.configure('response')
+        monkeypatch.setattr(completion, 'request_metrics', metrics)
+
+        def process(request):
+            return {'id': request['id'], 'results': ['"},{']}
+
+        thread = self._watch(process, workers=1)
+        _send(requests, {'id': 1, 'lookup': 'tooltip', 'source': 'a'})
+        response, = _responses(responses, 1)
+        requests.close()
+        thread.join(10)
+
+        assert response['results'] == ['"},{']
+        assert response['metrics']['lookup'] == 'tooltip'
+        assert 'total' in response['metrics']
+
+
+class TestDispatch(object):
+    """Tests for handling control messages and queueing lookups."""
+
+    def test_lookupInDocumentNotOpen(self, pipes):
+        requests, responses = pipes
+        dispatcher = completion.RequestDispatcher()
+        dispatcher._dispatch({'id': 1, 'path': 'a.py', 'version': 1,
+                              'line': 0, 'column': 0})
+
+        response, = _responses(responses, 1)
+        assert response['id'] == 1
+        assert 'not open' in response['error']
+
+    def test_lookupInOpenDocument(self, pipes):
+        dispatcher = completion.RequestDispatcher()
+        dispatcher._dispatch({'id': 1, 'lookup': 'open', 'path': 'a.py',
+                              'source': 'import os\n', 'version': 1})
+        dispatcher._dispatch({'id': 2, 'path': 'a.py', 'version': 1,
+                              'line': 0, 'column': 0})
+
+        assert dispatcher._requests.get()['source'] == 'import os\n'
+
+    def test_changeDocumentNotOpen(self, pipes):
+        requests, responses = pipes
+        dispatcher = completion.RequestDispatcher()
+        dispatcher._dispatch({'id': 1, 'lookup': 'change', 'path': 'a.py',
+                              'changes': [{'text': 'a'}], 'version': 2})
+
+        response, = _responses(responses, 1)
+        assert response['id'] == 1
+        assert 'not open' in response['error']
+
+
+# Worker process answering with its pid, `slow` lookups take a second,
+# `hang` ones never end and `crash` ones make it exit.
+FAKE_WORKER = """
+import json, os, sys, time
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    lookup = request.get('lookup')
+    if lookup == 'crash':
+        os._exit(1)
+    time.sleep({'slow': 1, 'hang': 60}.get(lookup, 0))
+    sys.stdout.write(json.dumps({'id': request['id'],
+                                 'results': [os.getpid()]}) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+class TestSupervisor(object):
+    """Tests for handing requests out to worker processes."""
+
+    @pytest.fixture
+    def supervise(self, pipes):
+        requests, responses = pipes
+        started = []
+
+        def supervise(**kwargs):
+            supervisor = completion.Supervisor(
+                [sys.executable, '-c', FAKE_WORKER], **kwargs)
+            thread = threading.Thread(target=supervisor.watch)
+            thread.daemon = True
+            thread.start()
+            started.append((supervisor, thread))
+            return supervisor
+
+        yield supervise
+        requests.close()
+        for supervisor, thread in started:
+            thread.join(10)
+            for worker in supervisor._workers + supervisor._spares:
+                worker.kill()
+
+    def _pids(self, supervisor):
+        with supervisor._condition:
+            return [w.process.pid for w in supervisor._workers]
+
+    def test_requestIdsKept(self, pipes, supervise):
+        requests, responses = pipes
+        supervisor = supervise(processes=2, spares=0, timeout=None)
+        _send(requests, {'id': 'a'}, {'id': 7}, {'id': 'a-7'})
+
+        read = _responses(responses, 3)
+        assert sorted(str(r['id']) for r in read) == ['7', 'a', 'a-7']
+        assert all(r['results'][0] in self._pids(supervisor) for r in read)
+
+    def test_timedOutWorkerReplaced(self, pipes, supervise):
+        requests, responses = pipes
+        supervisor = supervise(processes=1, spares=1, timeout=0.5)
+        pids = self._pids(supervisor)
+        _send(requests, {'id': 1, 'lookup': 'hang'})
+        timed_out, = _responses(responses, 1)
+        _send(requests, {'id': 2})
+        answered, = _responses(responses, 1)
+
+        assert timed_out['id'] == 1
+        assert 'Timed out' in timed_out['error']
+        assert answered['id'] == 2
+        assert answered['results'][0] not in pids
+        assert pids[0] not in self._pids(supervisor)
+        assert len(supervisor._spares) == 1
+
+    def test_crashedWorkerReplaced(self, pipes, supervise):
+        requests, responses = pipes
+        supervisor = supervise(processes=1, spares=0, timeout=None)
+        pids = self._pids(supervisor)
+        _send(requests, {'id': 1, 'lookup': 'crash'})
+        crashed, = _responses(responses, 1)
+        _send(requests, {'id': 2})
+        answered, = _responses(responses, 1)
+
+        assert crashed['id'] == 1
+        assert 'exited' in crashed['error']
+        assert answered['id'] == 2
+        assert answered['results'][0] not in pids
+
+    def test_resolveDoesNotHoldUpOthers(self, pipes, supervise):
+        requests, responses = pipes
+        supervise(processes=2, spares=0, timeout=None)
+        _send(requests, {'id': 1, 'path': 'a.py', 'lazy': True})
+        lazy, = _responses(responses, 1)
+        _send(requests, {'id': 2, 'path': 'a.py', 'lookup': 'slow'},
+              {'id': 3, 'lookup': 'resolve', 'completionId': 1},
+              {'id': 4, 'path': 'b.py'})
+        read = _responses(responses, 3)
+
+        assert [r['id'] for r in read] == [4, 2, 3]
+        assert read[1]['results'] == lazy['results']
+        assert read[2]['results'] == lazy['results']
+        assert read[0]['results'] != lazy['results']
@@ -1,6 +1,8 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import io
+import json
 import pytest
 import sys
 import textwrap
@@ -109,3 +111,90 @@ class TestNormalizationScript(object):
         normalizeForInterpreter.normalize_lines(src)
         result = capsys.readouterr()
         assert result.out == expectedResult
+
+
+    def test_globalStatementBlocks(self):
+        src = textwrap.dedent("""\
+            x = 1
+
+            y = [1,
+
+                 2]
+            z = 3; w = 4
+            v = 5
+            if x:
+                def f():
+
+                    pass
+            u = 6
+            """
+        )
+        expectedResult = textwrap.dedent("""\
+            x = 1
+
+            y = [1,
+                 2]
+
+            z = 3; w = 4
+            v = 5
+
+            if x:
+                def f():
+                    pass
+
+            u = 6
+            """
+        )
+        assert normalizeForInterpreter.normalize(src) == expectedResult
+
+
+    def test_decoratedStatements(self):
+        src = textwrap.dedent("""\
+            x = 1
+            @decorator
+
+            @decorator(1)
+            def show_something():
+
+                print("Something")
+            """
+        )
+        expectedResult = textwrap.dedent("""\
+            x = 1
+
+            @decorator
+            @decorator(1)
+            def show_something():
+                print("Something")
+            """
+        )
+        assert normalizeForInterpreter.normalize(src) == expectedResult
+
+
+class TestServer(object):
+    """Tests for normalizing code sent over stdin/stdout."""
+
+    @pytest.mark.skipif(sys.version_info.major == 2,
+                    reason="normalizeForInterpreter not working for 2.7, see GH #4805")
+    def test_serve(self):
+        src = textwrap.dedent("""\
+            x = 1
+
+            if x:
+
+                print(x)
+            """
+        )
+        requests = [{'id': 1, 'code': src}, {'id': 2, 'code': 'def ('}]
+        input = io.StringIO(u'\n'.join(json.dumps(r) for r in requests) +
+                            u'\n\nnot json\n')
+        output = io.StringIO()
+
+        normalizeForInterpreter.serve(input, output)
+
+        responses = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [r.get('id') for r in responses] == [1, 2, None]
+        assert responses[0]['normalized'] == 'x = 1\n\nif x:\n    print(x)\n'
+        assert 'error' in responses[1]
+        assert 'normalized' not in responses[1]
+        assert 'error' in responses[2]
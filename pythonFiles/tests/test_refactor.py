@@ -0,0 +1,176 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('rope')
+
+
+@pytest.fixture
+def root(tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('a.py').write('def helper():\n    pass\n')
+    root.join('b.py').write('from a import helper\nhelper()\n')
+    return root
+
+
+@pytest.fixture
+def refactor(root, monkeypatch):
+    """refactor module for the root, which takes it from the command line."""
+    monkeypatch.setattr(sys, 'argv', ['refactor.py', str(root)])
+    sys.modules.pop('refactor', None)
+    refactor = importlib.import_module('refactor')
+    yield refactor
+    sys.modules.pop('refactor', None)
+
+
+@pytest.fixture
+def refactoring(refactor, monkeypatch):
+    """RopeRefactoring writing its responses to a list."""
+    read, write = os.pipe()
+    os.close(write)
+    monkeypatch.setattr(sys, 'stdin', os.fdopen(read))
+    refactoring = refactor.RopeRefactoring()
+    refactoring.responses = []
+    monkeypatch.setattr(refactoring, '_write_response',
+                        lambda response: refactoring.responses.append(json.loads(response)))
+    yield refactoring
+    refactoring._close()
+
+
+def _rename(refactoring, root, identifier=1, progress=False):
+    return {'id': identifier, 'lookup': 'rename', 'file': str(root.join('a.py')),
+            'start': 4, 'name': 'renamed', 'indent_size': 4,
+            'progress': progress}
+
+
+def _edit(path, text):
+    """Change a file and its modification time, which rope goes by."""
+    mtime = os.path.getmtime(str(path))
+    path.write(text)
+    os.utime(str(path), (mtime + 10, mtime + 10))
+
+
+def _renamed_lines(response):
+    return sorted(line for result in response['results']
+                  for line in result['diff'].splitlines()
+                  if line.startswith('+') and not line.startswith('+++'))
+
+
+class TestOpenProject(object):
+    """Tests for keeping the rope project open across refactorings."""
+
+    def test_projectKeptOpen(self, refactoring, root):
+        refactoring._process_request(_rename(refactoring, root, 1))
+        project = refactoring._project
+        refactoring._process_request(_rename(refactoring, root, 2))
+
+        assert refactoring._project is project
+        assert [r['id'] for r in refactoring.responses] == [1, 2]
+
+    def test_editedFilePickedUp(self, refactoring, root):
+        refactoring._process_request(_rename(refactoring, root, 1))
+        _edit(root.join('b.py'), 'from a import helper\nhelper()\nhelper()\n')
+        refactoring._process_request(_rename(refactoring, root, 2))
+
+        assert _renamed_lines(refactoring.responses[-1]) == [
+            '+def renamed():', '+from a import renamed', '+renamed()', '+renamed()']
+
+    def test_editedFilePickedUpAfterReport(self, refactoring, root):
+        refactoring._process_request(_rename(refactoring, root, 1))
+        _edit(root.join('b.py'), 'from a import helper\n')
+        refactoring._process_request({'lookup': 'files_changed',
+                                      'changed': [str(root.join('b.py'))]})
+        refactoring._process_request(_rename(refactoring, root, 2))
+        _edit(root.join('b.py'), 'from a import helper\nhelper()\n')
+        refactoring._process_request(_rename(refactoring, root, 3))
+
+        assert _renamed_lines(refactoring.responses[-2]) == [
+            '+def renamed():', '+from a import renamed']
+        assert _renamed_lines(refactoring.responses[-1]) == [
+            '+def renamed():', '+from a import renamed', '+renamed()']
+
+
+class TestCancel(object):
+    """Tests for cancelling refactorings."""
+
+    def _work(self, refactoring):
+        worker = threading.Thread(target=refactoring._work)
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def test_cancelRunningRefactoring(self, refactoring, root):
+        callback = refactoring._progress_callback
+
+        def progress_callback(identifier):
+            write = callback(identifier)
+            cancelled = []
+
+            def cancel(progress):
+                # The cancel request comes in while the rename runs.
+                write(progress)
+                if not cancelled:
+                    cancelled.append(identifier)
+                    refactoring._queue_request(json.dumps(
+                        {'id': identifier, 'lookup': 'cancel'}))
+            return cancel
+
+        refactoring._progress_callback = progress_callback
+        worker = self._work(refactoring)
+        refactoring._queue_request(json.dumps(_rename(refactoring, root, 1, progress=True)))
+        refactoring._queue_request(json.dumps(_rename(refactoring, root, 2)))
+        responses = []
+        for _ in range(300):
+            responses = [r for r in refactoring.responses if 'progress' not in r]
+            if len(responses) == 2:
+                break
+            time.sleep(0.1)
+        refactoring._stop(cancel=False)
+        worker.join(30)
+
+        assert responses[0] == {'id': 1, 'results': [], 'cancelled': True}
+        assert responses[1]['id'] == 2
+        assert _renamed_lines(responses[1]) == [
+            '+def renamed():', '+from a import renamed', '+renamed()']
+        assert not worker.is_alive()
+
+    def test_cancelQueuedRefactoring(self, refactoring, root):
+        refactoring._queue_request(json.dumps(_rename(refactoring, root, 1)))
+        refactoring._queue_request(json.dumps({'id': 1, 'lookup': 'cancel'}))
+        worker = self._work(refactoring)
+        refactoring._stop(cancel=False)
+        worker.join(30)
+
+        assert refactoring.responses == [{'id': 1, 'results': [], 'cancelled': True}]
+
+
+class TestStop(object):
+    """Tests for stopping the refactoring process."""
+
+    def test_projectClosedWhenWorkerHangs(self, refactoring, monkeypatch):
+        hung = threading.Event()
+        closed = []
+
+        class Project(object):
+            def close(self):
+                closed.append(True)
+
+        monkeypatch.setattr(signal, 'signal', lambda signum, handler: None)
+        monkeypatch.setattr(refactoring, '_work', lambda: hung.wait(30))
+        monkeypatch.setattr(refactoring, '_write_response', lambda response: None)
+        refactoring._project = Project()
+        refactoring.stop_timeout = 0.1
+        refactoring.watch()
+        hung.set()
+
+        assert closed == [True]
+        assert refactoring._project is None
@@ -0,0 +1,267 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import ast
+import io
+import json
+import textwrap
+
+import pytest
+
+import symbolProvider
+
+
+SOURCE = textwrap.dedent(u"""\
+    class Tests(object):
+        def test_one(self):
+            pass
+
+    def helper():
+        pass
+    """)
+
+
+RANGES = textwrap.dedent(u"""\
+    class Tests(object):
+        @decorated
+        def test_if(self):
+            if a:
+                pass
+            elif b:
+                pass
+            else:
+                return [1,
+                        2]
+
+        def test_try(self):
+            try:
+                pass
+            except Exception:
+                pass
+            finally:
+                x = 1  # comment
+
+    def outer():
+        def inner():
+            return 'caf\u00e9'
+        return inner; inner()
+    """)
+
+
+def _ranges(source, end_positions=True):
+    tree = ast.parse(source)
+    if not end_positions:
+        for node in ast.walk(tree):
+            node.end_lineno = node.end_col_offset = None
+    visitor = symbolProvider.Visitor(symbolProvider.get_source_lines(source))
+    visitor.visit(tree)
+    return dict((symbol['name'], symbol['range'])
+                for symbols in visitor.symbols.values() for symbol in symbols)
+
+
+def _end(range):
+    return range['end']['line'], range['end']['character']
+
+
+class TestEndPositions(object):
+    """Tests for the ranges of symbols."""
+
+    @pytest.mark.parametrize('end_positions', [True, False])
+    def test_endOfLastBlock(self, end_positions):
+        ranges = _ranges(RANGES, end_positions)
+
+        assert _end(ranges['test_if']) == (9, 22)
+        assert _end(ranges['test_try']) == (17, 17)
+        assert _end(ranges['Tests']) == (17, 17)
+        assert _end(ranges['outer']) == (22, 25)
+
+    def test_startOfDecorated(self):
+        ranges = _ranges(RANGES)
+
+        assert ranges['test_if']['start']['character'] == 4
+
+    @pytest.mark.parametrize('end_positions', [True, False])
+    def test_charactersNotBytes(self, end_positions):
+        ranges = _ranges(u"def f(): return '\u00e9\u00e9'\n", end_positions)
+
+        assert _end(ranges['f']) == (0, 20)
+
+    def test_sameWithoutEndPositions(self):
+        with open(symbolProvider.__file__) as source:
+            source = source.read()
+
+        assert _ranges(source, False) == _ranges(source)
+
+
+class TestServer(object):
+    """Tests for answering requests for symbols over stdin/stdout."""
+
+    def test_sourceOfUnsavedDocument(self):
+        response = symbolProvider.handle_request(
+            {'id': 1, 'path': 'missing.py', 'source': SOURCE})
+
+        assert response['id'] == 1
+        assert [s['name'] for s in response['symbols']['classes']] == ['Tests']
+        assert [s['name'] for s in response['symbols']['methods']] == ['test_one']
+        assert [s['name'] for s in response['symbols']['functions']] == ['helper']
+
+    def test_sourceFromFile(self, tmpdir):
+        path = tmpdir.join('test_file.py')
+        path.write(SOURCE)
+
+        response = symbolProvider.handle_request({'id': 2, 'path': str(path)})
+
+        assert response['symbols'] == symbolProvider.get_symbols(SOURCE)
+
+    def test_errors(self):
+        response = symbolProvider.handle_request(
+            {'id': 3, 'path': 'missing.py', 'source': 'def ('})
+
+        assert response['id'] == 3
+        assert response['error'].startswith('SyntaxError')
+        assert 'symbols' not in response
+
+    def test_serve(self):
+        requests = [{'id': 1, 'path': 'a.py', 'source': SOURCE},
+                    {'id': 2, 'path': 'b.py', 'source': u'x = 1\n'}]
+        input = io.StringIO(u'\n'.join(json.dumps(r) for r in requests) +
+                            u'\n\nnot json\n')
+        output = io.StringIO() if str is not bytes else io.BytesIO()
+
+        symbolProvider.serve(input, output)
+
+        responses = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [r['id'] for r in responses] == [1, 2, None]
+        assert responses[1]['symbols'] == {
+            'classes': [], 'methods': [], 'functions': []}
+        assert 'error' in responses[2]
+
+
+class TestBatch(object):
+    """Tests for getting the symbols of many files."""
+
+    def _run(self, paths, cache, jobs=1):
+        output = io.StringIO() if str is not bytes else io.BytesIO()
+        symbolProvider.provide_batch_symbols(paths, output, jobs, cache)
+        return dict((r['path'], r) for r in
+                    (json.loads(line) for line in output.getvalue().splitlines()))
+
+    def test_findFiles(self, tmpdir):
+        tmpdir.join('a.py').write('')
+        tmpdir.mkdir('sub').join('b.py').write('')
+        tmpdir.join('c.txt').write('')
+
+        found = list(symbolProvider.find_files(
+            [str(tmpdir), str(tmpdir.join('*.py'))]))
+
+        assert found == [str(tmpdir.join('a.py')), str(tmpdir.join('sub', 'b.py'))]
+
+    def test_resultPerFile(self, tmpdir):
+        tmpdir.join('a.py').write(SOURCE)
+        tmpdir.join('b.py').write('def (')
+        paths = [str(tmpdir.join('a.py')), str(tmpdir.join('b.py'))]
+
+        results = self._run(paths, symbolProvider.SymbolCache(), jobs=2)
+
+        assert results[paths[0]]['symbols'] == symbolProvider.get_symbols(SOURCE)
+        assert results[paths[1]]['error'].startswith('SyntaxError')
+
+    def test_skipUnchangedFiles(self, tmpdir, monkeypatch):
+        source = tmpdir.join('a.py')
+        source.write(SOURCE)
+        cache_path = str(tmpdir.join('cache.json'))
+        self._run([str(source)], symbolProvider.SymbolCache(cache_path))
+        parsed = []
+        monkeypatch.setattr(symbolProvider, 'get_symbols',
+                            lambda source: parsed.append(source) or {})
+
+        # Same modification time, then same content.
+        results = self._run([str(source)], symbolProvider.SymbolCache(cache_path))
+        source.setmtime(source.mtime() + 10)
+        touched = self._run([str(source)], symbolProvider.SymbolCache(cache_path))
+
+        assert results[str(source)]['cached']
+        assert touched[str(source)]['cached']
+        assert [s['name'] for s in touched[str(source)]['symbols']['classes']] == ['Tests']
+        assert parsed == []
+
+        source.write('x = 1\n')
+        changed = self._run([str(source)], symbolProvider.SymbolCache(cache_path))
+        assert 'cached' not in changed[str(source)]
+        assert len(parsed) == 1
+
+
+def _change(line, text, end_line=None, character=0, end_character=0):
+    return {'range': {'start': {'line': line, 'character': character},
+                      'end': {'line': line if end_line is None else end_line,
+                              'character': end_character}},
+            'text': text}
+
+
+class TestIncrementalSymbols(object):
+    """Tests for updating the symbols of edited documents."""
+
+    def _document(self, source=SOURCE):
+        document = symbolProvider.IncrementalSymbols(source)
+        document.parse()
+        return document
+
+    def _source(self, document):
+        return u''.join(document._lines)
+
+    def test_sameAsFullParse(self):
+        document = self._document()
+        document.apply_changes([_change(3, u'def added():\n    pass\n\n')])
+        document.apply_changes([_change(1, u'test_renamed', character=8,
+                                        end_character=16)])
+
+        source = self._source(document)
+        assert 'def added' in source and 'def test_renamed' in source
+        assert document.symbols == symbolProvider.get_symbols(source)
+
+    def test_parseTouchedStatementsOnly(self, monkeypatch):
+        source = u''.join(u'def f{0}():\n    pass\n'.format(i) for i in range(10))
+        document = self._document(source)
+        parsed = []
+        parse = document._parse
+        monkeypatch.setattr(document, '_parse', lambda start, end: parsed.append(
+            document._lines[start:end]) or parse(start, end))
+
+        document.apply_changes([_change(11, u'    return 1\n', end_line=12)])
+
+        assert parsed == [[u'def f4():\n', u'    pass\n',
+                           u'def f5():\n', u'    return 1\n']]
+        assert document.symbols == symbolProvider.get_symbols(self._source(document))
+
+    def test_editMergingStatements(self):
+        document = self._document()
+        # Indenting `def helper` makes it a method of `Tests`.
+        document.apply_changes([_change(
+            4, u'    def helper(self):\n        pass\n', end_line=6)])
+
+        assert [s['name'] for s in document.symbols['methods']] == [
+            'test_one', 'helper']
+        assert document.symbols == symbolProvider.get_symbols(self._source(document))
+
+    def test_syntaxErrorThenFixed(self):
+        document = self._document()
+        with pytest.raises(SyntaxError):
+            document.apply_changes([_change(4, u'def helper(:\n', end_line=5)])
+        document.apply_changes([_change(4, u'def helper():\n', end_line=5)])
+
+        assert document.symbols == symbolProvider.get_symbols(self._source(document))
+
+    def test_server(self):
+        documents = symbolProvider.Documents()
+        opened = symbolProvider.handle_request(
+            {'id': 1, 'path': 'a.py', 'source': SOURCE}, documents)
+        changed = symbolProvider.handle_request(
+            {'id': 2, 'path': 'a.py', 'changes': [_change(0, u'\n')]}, documents)
+        symbolProvider.handle_request({'id': 3, 'path': 'a.py', 'close': True},
+                                      documents)
+        closed = symbolProvider.handle_request(
+            {'id': 4, 'path': 'a.py', 'changes': [_change(0, u'\n')]}, documents)
+
+        assert changed['symbols']['classes'][0]['range']['start']['line'] == \
+            opened['symbols']['classes'][0]['range']['start']['line'] + 1
+        assert 'not open' in closed['error']